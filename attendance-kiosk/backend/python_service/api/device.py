@@ -142,7 +142,6 @@ def _write_local_kiosk(conn, kiosk_id, name, serial, assigned_room, ip, mac, sta
         "INSERT OR REPLACE INTO kiosks_fs (fs_id, name, serialNumber, assignedRoomId, ipAddress, macAddress, status, installedAt, updatedAt, raw_doc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
         (kiosk_id, name, serial or "", assigned_room, ip, mac, status, installed_at, updated_at, json.dumps(raw) if raw is not None else None),
     )
-    conn.commit()
 
 
 def register_device_auto():
@@ -158,8 +157,8 @@ def register_device_auto():
     try:
         serial = _read_rpi_serial()
         hostname = socket.gethostname()
-        conn = state.get_db()
-        _ensure_kiosk_table(conn)
+        state.ensure_schema(_ensure_kiosk_table)
+        conn = state.get_read_db()
         cur = conn.cursor()
 
         # 1) check local DB first (use kiosks_fs as single local kiosk table)
@@ -222,7 +221,7 @@ def register_device_auto():
                     installedAt = data.get("installedAt") or now
                     updatedAt = data.get("updatedAt") or now
                     # persist locally into kiosks_fs
-                    _write_local_kiosk(conn, kiosk_id, name, serial, assignedRoomId, ip, mac, status, installedAt, updatedAt, data)
+                    state.run_write(_write_local_kiosk, kiosk_id, name, serial, assignedRoomId, ip, mac, status, installedAt, updatedAt, data)
                     return {
                         "id": kiosk_id,
                         "name": name,
@@ -265,7 +264,7 @@ def register_device_auto():
 
         # persist locally into kiosks_fs
         try:
-            _write_local_kiosk(conn, kiosk_id, name, serial, None, None, None, status, installedAt, updatedAt, {"auto_registered": True})
+            state.run_write(_write_local_kiosk, kiosk_id, name, serial, None, None, None, status, installedAt, updatedAt, {"auto_registered": True})
         except Exception:
             pass
 
@@ -320,8 +319,8 @@ def http_update_network_info():
     try:
         serial = _read_rpi_serial()
         hostname = socket.gethostname()
-        conn = state.get_db()
-        _ensure_kiosk_table(conn)
+        state.ensure_schema(_ensure_kiosk_table)
+        conn = state.get_read_db()
         cur = conn.cursor()
 
         # detect network info locally
@@ -363,18 +362,14 @@ def http_update_network_info():
             status = row[6] or status
             raw = row[9] if len(row) > 9 else None
 
-        # persist locally (INSERT OR REPLACE)
+        # persist locally (INSERT OR REPLACE) through the db writer
         try:
-            cur.execute(
+            state.execute_write(
                 "INSERT OR REPLACE INTO kiosks_fs (fs_id, name, serialNumber, assignedRoomId, ipAddress, macAddress, status, installedAt, updatedAt, raw_doc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                 (kiosk_id or _next_kiosk_id(conn), name, serial or "", assigned_room, ip, mac, status, installedAt, updatedAt, raw if raw is not None else None),
             )
-            conn.commit()
         except Exception:
-            try:
-                conn.rollback()
-            except Exception:
-                pass
+            pass
 
         # attempt to update Firestore kiosk doc if available
         db_fs = getattr(sync, "db_fs", None) if sync is not None else None
@@ -410,8 +405,8 @@ def http_device_info():
         serial = _read_rpi_serial()
         if not serial:
             return {"kiosk": None}
-        conn = state.get_db()
-        _ensure_kiosk_table(conn)
+        state.ensure_schema(_ensure_kiosk_table)
+        conn = state.get_read_db()
         cur = conn.cursor()
         cur.execute("SELECT fs_id, name, serialNumber, assignedRoomId, ipAddress, macAddress, status, installedAt, updatedAt FROM kiosks_fs WHERE serialNumber = ?", (serial,))
         row = cur.fetchone()
@@ -0,0 +1,686 @@
+"""In-process stand-in for the Firestore client (FIRESTORE_BACKEND=fake).
+
+Implements the part of the google-cloud-firestore API the kiosk uses over an
+in-memory dict: collection/document refs (nested subcollections included),
+get/stream/where/order_by/limit, set (merge)/update/delete, batch/commit,
+ArrayUnion/ArrayRemove and collection or query on_snapshot listeners. It
+lets sync_firestore, the partial and realtime syncs, the outbox and the
+notification uploader run offline, in tests and under the load harness.
+
+  FAKE_FIRESTORE_LATENCY_MS  added to every round trip (read RPC, write, commit)
+  FAKE_FIRESTORE_JITTER_MS   uniform random extra latency
+  FAKE_FIRESTORE_FAIL_RATE   probability a round trip raises ServiceUnavailable
+  FAKE_FIRESTORE_SEED        "school" (synthetic dataset, see school_dataset),
+                             a JSON file {collection: {doc_id: doc}}, or empty
+  FAKE_FIRESTORE_SCHOOL      school_dataset sizes, e.g.
+                             "teachers=10,classes=20,students=300,per_class=30"
+
+Failures can also be injected per call: fail_next(n), set_offline(True)
+and break_listeners(). GET /debug/fake-firestore reports the counters; main.py
+only mounts it when FIRESTORE_BACKEND=fake.
+"""
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from datetime import datetime, timedelta, timezone
+import copy
+import enum
+import json
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+
+router = APIRouter()
+
+BATCH_LIMIT = 500
+
+
+# Named like google.api_core.exceptions so callers (outbox._is_connectivity_error)
+# classify them the same way as the real client's errors.
+class ServiceUnavailable(Exception):
+    pass
+
+
+class NotFound(Exception):
+    pass
+
+
+class InvalidArgument(Exception):
+    pass
+
+
+class ArrayUnion:
+    def __init__(self, values):
+        self.values = list(values)
+
+
+class ArrayRemove:
+    def __init__(self, values):
+        self.values = list(values)
+
+
+class ChangeType(enum.Enum):
+    ADDED = 1
+    REMOVED = 2
+    MODIFIED = 3
+
+
+class DocumentChange:
+    def __init__(self, type, document):
+        self.type = type
+        self.document = document
+
+
+class WriteResult:
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _get_field(data, field_path):
+    cur = data
+    for part in field_path.split("."):
+        if not isinstance(cur, dict) or part not in cur:
+            return None, False
+        cur = cur[part]
+    return cur, True
+
+
+def _matches(value, op, expected):
+    # values of different types never match a range filter, as in Firestore
+    try:
+        if op == "==":
+            return value == expected
+        if op == "!=":
+            return value != expected
+        if op == "<":
+            return value < expected
+        if op == "<=":
+            return value <= expected
+        if op == ">":
+            return value > expected
+        if op == ">=":
+            return value >= expected
+        if op == "in":
+            return value in expected
+        if op == "not-in":
+            return value not in expected
+        if op == "array_contains" or op == "array-contains":
+            return isinstance(value, list) and expected in value
+        if op == "array_contains_any" or op == "array-contains-any":
+            return isinstance(value, list) and any(v in value for v in expected)
+    except TypeError:
+        return False
+    raise InvalidArgument(f"unsupported operator: {op}")
+
+
+def _resolve(old, new):
+    """Apply transforms in new against the stored value old."""
+    if isinstance(new, ArrayUnion) or type(new).__name__ == "ArrayUnion":
+        out = list(old) if isinstance(old, list) else []
+        for v in getattr(new, "values", None) or getattr(new, "_values", ()):
+            if v not in out:
+                out.append(v)
+        return out
+    if isinstance(new, ArrayRemove) or type(new).__name__ == "ArrayRemove":
+        drop = list(getattr(new, "values", None) or getattr(new, "_values", ()))
+        return [v for v in old if v not in drop] if isinstance(old, list) else []
+    if isinstance(new, dict):
+        return {k: _resolve((old or {}).get(k) if isinstance(old, dict) else None, v) for k, v in new.items()}
+    return copy.deepcopy(new)
+
+
+def _merge(dst, src):
+    for k, v in src.items():
+        if isinstance(v, dict) and isinstance(dst.get(k), dict):
+            _merge(dst[k], v)
+        else:
+            dst[k] = _resolve(dst.get(k), v)
+
+
+def _update(dst, src):
+    # update() takes dotted field paths and replaces map values wholesale
+    for path, v in src.items():
+        parts = path.split(".")
+        cur = dst
+        for part in parts[:-1]:
+            if not isinstance(cur.get(part), dict):
+                cur[part] = {}
+            cur = cur[part]
+        cur[parts[-1]] = _resolve(cur.get(parts[-1]), v)
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, create_time=None, update_time=None, read_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+        self.create_time = create_time
+        self.update_time = update_time
+        self.read_time = read_time
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        if self._data is None:
+            return None
+        value, _found = _get_field(self._data, field_path)
+        return copy.deepcopy(value)
+
+
+class Query:
+    def __init__(self, client, path, filters=(), orders=(), limit=None):
+        self._client = client
+        self._path = path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        _matches(None, op_string, [])  # reject unknown operators up front
+        return Query(self._client, self._path, self._filters + ((field_path, op_string, value),), self._orders, self._limit)
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        return Query(self._client, self._path, self._filters, self._orders + ((field_path, direction),), self._limit)
+
+    def limit(self, count):
+        return Query(self._client, self._path, self._filters, self._orders, count)
+
+    def _match(self, data):
+        for field_path, op, expected in self._filters:
+            value, found = _get_field(data, field_path)
+            if not found or not _matches(value, op, expected):
+                return False
+        for field_path, _direction in self._orders:
+            if not _get_field(data, field_path)[1]:
+                return False
+        return True
+
+    def _select(self):
+        """Matching (doc_id, record) pairs in query order; caller holds the lock."""
+        docs = [(doc_id, rec) for doc_id, rec in self._client._collection(self._path).items() if self._match(rec[0])]
+        docs.sort(key=lambda item: item[0])
+        for field_path, direction in reversed(self._orders):
+            desc = str(direction).upper().startswith("DESC")
+            try:
+                docs.sort(key=lambda item: _get_field(item[1][0], field_path)[0], reverse=desc)
+            except TypeError:
+                docs.sort(key=lambda item: str(_get_field(item[1][0], field_path)[0]), reverse=desc)
+        if self._limit is not None:
+            docs = docs[:self._limit]
+        return docs
+
+    def stream(self, transaction=None):
+        self._client._round_trip()
+        read_time = _now()
+        with self._client._lock:
+            snaps = [
+                DocumentSnapshot(self._client.document(f"{self._path}/{doc_id}"), copy.deepcopy(rec[0]), rec[1], rec[2], read_time)
+                for doc_id, rec in self._select()
+            ]
+            self._client._count("reads", max(1, len(snaps)))
+        return iter(snaps)
+
+    def get(self, transaction=None):
+        return list(self.stream())
+
+    def on_snapshot(self, callback):
+        return self._client._watch(self, callback)
+
+
+class CollectionReference(Query):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.id = path.rsplit("/", 1)[-1]
+        self.path = path
+
+    @property
+    def parent(self):
+        if "/" not in self.path:
+            return None
+        return self._client.document(self.path.rsplit("/", 1)[0])
+
+    def document(self, document_id=None):
+        return DocumentReference(self._client, f"{self.path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, document_data, document_id=None):
+        ref = self.document(document_id)
+        return ref.set(document_data).update_time, ref
+
+    def list_documents(self):
+        with self._client._lock:
+            ids = sorted(self._client._collection(self.path))
+        return [self.document(doc_id) for doc_id in ids]
+
+
+class DocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self):
+        return CollectionReference(self._client, self.path.rsplit("/", 1)[0])
+
+    def collection(self, collection_id):
+        return CollectionReference(self._client, f"{self.path}/{collection_id}")
+
+    def get(self, field_paths=None, transaction=None):
+        self._client._round_trip()
+        coll, doc_id = self.path.rsplit("/", 1)
+        with self._client._lock:
+            rec = self._client._collection(coll).get(doc_id)
+            self._client._count("reads", 1)
+            if rec is None:
+                return DocumentSnapshot(self, None, read_time=_now())
+            return DocumentSnapshot(self, copy.deepcopy(rec[0]), rec[1], rec[2], _now())
+
+    def set(self, document_data, merge=False):
+        return self._client._commit([("set", self, document_data, merge)])[0]
+
+    def update(self, field_updates):
+        return self._client._commit([("update", self, field_updates, False)])[0]
+
+    def delete(self):
+        return self._client._commit([("delete", self, None, False)])[0]
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._ops = []
+
+    def __len__(self):
+        return len(self._ops)
+
+    def set(self, reference, document_data, merge=False):
+        self._ops.append(("set", reference, document_data, merge))
+
+    def create(self, reference, document_data):
+        self._ops.append(("create", reference, document_data, False))
+
+    def update(self, reference, field_updates):
+        self._ops.append(("update", reference, field_updates, False))
+
+    def delete(self, reference):
+        self._ops.append(("delete", reference, None, False))
+
+    def commit(self):
+        ops, self._ops = self._ops, []
+        return self._client._commit(ops)
+
+
+class Watch:
+    def __init__(self, client, query, callback):
+        self._client = client
+        self._query = query
+        self._callback = callback
+        self._closed = False
+        self._seen = set()
+
+    @property
+    def is_active(self):
+        return not self._closed
+
+    def unsubscribe(self):
+        self._closed = True
+        self._client._unwatch(self)
+
+
+class FakeFirestore:
+    """Thread-safe in-memory Firestore client."""
+
+    ArrayUnion = ArrayUnion
+    ArrayRemove = ArrayRemove
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, fail_rate=0.0, rng_seed=None):
+        self.latency_ms = float(latency_ms)
+        self.jitter_ms = float(jitter_ms)
+        self.fail_rate = float(fail_rate)
+        self._rng = random.Random(rng_seed)
+        self._lock = threading.RLock()
+        self._data = {}  # collection path -> {doc id: [data, create_time, update_time]}
+        self._watches = []
+        self._events = None
+        self._fail_next = []
+        self._offline = False
+        self.stats = {"round_trips": 0, "reads": 0, "writes": 0, "commits": 0, "failures": 0, "listen_events": 0}
+
+    # --- client API -------------------------------------------------------
+
+    def collection(self, collection_path, *more):
+        return CollectionReference(self, "/".join((collection_path,) + more))
+
+    def document(self, document_path, *more):
+        return DocumentReference(self, "/".join((document_path,) + more))
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def collections(self):
+        with self._lock:
+            names = sorted(p for p in self._data if "/" not in p)
+        return [CollectionReference(self, n) for n in names]
+
+    # --- test controls ----------------------------------------------------
+
+    def fail_next(self, count=1, exc=None):
+        """Make the next count round trips raise exc (default ServiceUnavailable)."""
+        with self._lock:
+            self._fail_next.extend([exc] * count)
+
+    def set_offline(self, offline=True):
+        """While offline every round trip raises ServiceUnavailable."""
+        self._offline = bool(offline)
+
+    def break_listeners(self):
+        """Close every open listener, as when the listen stream drops."""
+        with self._lock:
+            watches, self._watches = self._watches, []
+        for w in watches:
+            w._closed = True
+
+    def load(self, dataset):
+        """Insert {collection path: {doc id: data}} without latency, failures or events."""
+        now = _now()
+        with self._lock:
+            for path, docs in dataset.items():
+                coll = self._collection(path)
+                for doc_id, data in docs.items():
+                    coll[str(doc_id)] = [copy.deepcopy(data), now, now]
+
+    def dump(self, collection_path=None):
+        """Return {collection path: {doc id: data}} (or one collection's docs)."""
+        with self._lock:
+            if collection_path is not None:
+                return {k: copy.deepcopy(v[0]) for k, v in self._data.get(collection_path, {}).items()}
+            return {p: {k: copy.deepcopy(v[0]) for k, v in docs.items()} for p, docs in self._data.items() if docs}
+
+    def reset(self):
+        with self._lock:
+            self._data.clear()
+            self._fail_next = []
+            for key in self.stats:
+                self.stats[key] = 0
+
+    # --- internals --------------------------------------------------------
+
+    def _collection(self, path):
+        return self._data.setdefault(path, {})
+
+    def _count(self, key, n=1):
+        self.stats[key] += n
+
+    def _round_trip(self):
+        delay = self.latency_ms + (self._rng.uniform(0, self.jitter_ms) if self.jitter_ms > 0 else 0.0)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+        with self._lock:
+            self.stats["round_trips"] += 1
+            exc = None
+            if self._fail_next:
+                exc = self._fail_next.pop(0) or ServiceUnavailable("fake firestore: injected failure")
+            elif self._offline:
+                exc = ServiceUnavailable("fake firestore: offline")
+            elif self.fail_rate > 0 and self._rng.random() < self.fail_rate:
+                exc = ServiceUnavailable("fake firestore: injected failure")
+            if exc is not None:
+                self.stats["failures"] += 1
+                raise exc
+
+    def _commit(self, ops):
+        if len(ops) > BATCH_LIMIT:
+            raise InvalidArgument(f"maximum {BATCH_LIMIT} writes allowed per request")
+        self._round_trip()
+        now = _now()
+        with self._lock:
+            # validate first so a failing write leaves the whole commit unapplied
+            for kind, ref, _data, _merge_flag in ops:
+                coll, doc_id = ref.path.rsplit("/", 1)
+                exists = doc_id in self._data.get(coll, {})
+                if kind == "update" and not exists:
+                    raise NotFound(f"No document to update: {ref.path}")
+                if kind == "create" and exists:
+                    raise InvalidArgument(f"Document already exists: {ref.path}")
+            touched = {}
+            for kind, ref, data, merge in ops:
+                coll_path, doc_id = ref.path.rsplit("/", 1)
+                coll = self._collection(coll_path)
+                rec = coll.get(doc_id)
+                if kind == "delete":
+                    coll.pop(doc_id, None)
+                elif rec is None:
+                    coll[doc_id] = [_resolve(None, dict(data)), now, now]
+                else:
+                    if kind == "update":
+                        _update(rec[0], data)
+                    elif merge:
+                        _merge(rec[0], data)
+                    else:
+                        rec[0] = _resolve(None, dict(data))
+                    rec[2] = now
+                touched.setdefault(coll_path, set()).add(doc_id)
+            self.stats["writes"] += len(ops)
+            self.stats["commits"] += 1
+            self._notify(touched, now)
+        return [WriteResult(now) for _ in ops]
+
+    def _watch(self, query, callback):
+        w = Watch(self, query, callback)
+        with self._lock:
+            self._watches.append(w)
+            if self._events is None:
+                self._events = queue.Queue()
+                threading.Thread(target=self._dispatch_loop, name="fake-firestore-listen", daemon=True).start()
+            self._notify({query._path: None}, _now(), only=w)
+        return w
+
+    def _unwatch(self, w):
+        with self._lock:
+            if w in self._watches:
+                self._watches.remove(w)
+
+    def _notify(self, touched, read_time, only=None):
+        """Queue change events for listeners on the touched collections; lock held."""
+        for w in ([only] if only is not None else self._watches):
+            if w._closed or w._query._path not in touched:
+                continue
+            matching = {doc_id: rec for doc_id, rec in w._query._select()}
+            ids = touched[w._query._path]
+            ids = set(matching) | w._seen if ids is None else ids
+            changes = []
+            for doc_id in sorted(ids):
+                ref = self.document(f"{w._query._path}/{doc_id}")
+                if doc_id in matching:
+                    rec = matching[doc_id]
+                    kind = ChangeType.MODIFIED if doc_id in w._seen else ChangeType.ADDED
+                    changes.append(DocumentChange(kind, DocumentSnapshot(ref, copy.deepcopy(rec[0]), rec[1], rec[2], read_time)))
+                elif doc_id in w._seen:
+                    changes.append(DocumentChange(ChangeType.REMOVED, DocumentSnapshot(ref, None, read_time=read_time)))
+            w._seen = set(matching)
+            # the first snapshot is delivered even when empty
+            if changes or only is not None:
+                docs = [DocumentSnapshot(self.document(f"{w._query._path}/{i}"), copy.deepcopy(r[0]), r[1], r[2], read_time)
+                        for i, r in matching.items()]
+                self._events.put((w, docs, changes, read_time))
+
+    def _dispatch_loop(self):
+        # callbacks run on their own thread, like the real client's listen stream
+        while True:
+            w, docs, changes, read_time = self._events.get()
+            if w._closed:
+                continue
+            try:
+                w._callback(docs, changes, read_time)
+                with self._lock:
+                    self.stats["listen_events"] += len(changes)
+            except Exception as e:
+                print(f"fake firestore: listener callback failed: {e}")
+
+
+# --- seeded dataset -------------------------------------------------------
+
+_FIRST = ("Ana", "Ben", "Carla", "Dan", "Ella", "Felix", "Gina", "Hugo", "Iris", "Jon", "Kara", "Leo",
+          "Mia", "Noel", "Olga", "Paul", "Rina", "Sam", "Tess", "Vic")
+_LAST = ("Reyes", "Santos", "Cruz", "Garcia", "Mendoza", "Torres", "Flores", "Ramos", "Lopez", "Castro",
+         "Rivera", "Aquino", "Bautista", "Navarro", "Villanueva")
+_SUBJECTS = ("Mathematics", "Science", "English", "Filipino", "History", "Computer", "Music", "PE")
+_DAYS = ("Mon,Wed,Fri", "Tue,Thu", "Mon,Tue,Wed,Thu,Fri")
+
+
+def school_dataset(teachers=10, classes=20, students=300, per_class=30, rooms=10, kiosks=1,
+                   kiosk_serial=None, seed=0):
+    """Deterministic synthetic school as {collection: {doc_id: doc}}.
+
+    Ids are teacher-001, class-001, student-0001, room-01 and kiosk-01.
+    Classes are assigned to teachers and rooms round robin; each class gets
+    per_class students (a student can be in several classes, listed in its
+    'classes' array). Docs carry no profilePicUrl, so syncing them downloads
+    nothing. kiosk-01 uses kiosk_serial when given.
+    """
+    rng = random.Random(seed)
+    base = datetime(2026, 1, 5, 7, 0, tzinfo=timezone.utc)
+    rooms = max(1, rooms)
+    teachers = max(1, teachers)
+
+    def _stamp(i):
+        return base + timedelta(seconds=i)
+
+    def _person(i, prefix):
+        first, last = rng.choice(_FIRST), rng.choice(_LAST)
+        return {
+            "firstname": first,
+            "middlename": "",
+            "lastname": last,
+            "school_email": f"{first}.{last}.{prefix}{i}@school.test".lower(),
+            "personal_email": None,
+            "status": "active",
+            "temp_password": None,
+            "profilePicUrl": None,
+            "createdAt": _stamp(i),
+            "updatedAt": _stamp(i),
+        }
+
+    data = {"rooms": {}, "kiosks": {}, "teachers": {}, "classes": {}, "students": {}}
+    for i in range(1, rooms + 1):
+        data["rooms"][f"room-{i:02d}"] = {
+            "roomname": f"Room {100 + i}",
+            "kioskId": f"kiosk-{i:02d}" if i <= kiosks else None,
+            "assignedTeachers": [],
+            "currentsessionId": None,
+            "isActive": True,
+            "updatedAt": _stamp(i),
+        }
+    for i in range(1, kiosks + 1):
+        data["kiosks"][f"kiosk-{i:02d}"] = {
+            "name": f"Kiosk {i}",
+            "serialNumber": kiosk_serial if (i == 1 and kiosk_serial) else f"FAKE{i:012d}",
+            "assignedRoomId": f"room-{(i - 1) % rooms + 1:02d}",
+            "ipAddress": None,
+            "macAddress": None,
+            "status": "active",
+            "installedAt": _stamp(i).isoformat(),
+            "updatedAt": _stamp(i).isoformat(),
+        }
+    for i in range(1, teachers + 1):
+        data["teachers"][f"teacher-{i:03d}"] = _person(i, "t")
+    student_ids = [f"student-{i:04d}" for i in range(1, students + 1)]
+    for i in range(1, students + 1):
+        doc = _person(i, "s")
+        doc.update({"guardianname": f"{rng.choice(_FIRST)} {doc['lastname']}", "guardiancontact": f"0917{i:07d}", "classes": []})
+        data["students"][student_ids[i - 1]] = doc
+    for i in range(1, classes + 1):
+        class_id = f"class-{i:03d}"
+        room_id = f"room-{(i - 1) % rooms + 1:02d}"
+        teacher_id = f"teacher-{(i - 1) % teachers + 1:03d}"
+        hour = 7 + (i - 1) % 9
+        grade, section = 7 + (i - 1) % 4, "ABCDEFGH"[((i - 1) // 4) % 8]
+        subject = _SUBJECTS[(i - 1) % len(_SUBJECTS)]
+        data["classes"][class_id] = {
+            "name": f"{subject} {grade}-{section}",
+            "gradeLevel": str(grade),
+            "section": section,
+            "subjectName": subject,
+            "roomId": room_id,
+            "roomNumber": data["rooms"][room_id]["roomname"],
+            "teacherId": teacher_id,
+            "days": _DAYS[(i - 1) % len(_DAYS)],
+            "time_start": f"{hour:02d}:00",
+            "time_end": f"{hour:02d}:50",
+            "createdAt": _stamp(i),
+            "updatedAt": _stamp(i),
+        }
+        if teacher_id not in data["rooms"][room_id]["assignedTeachers"]:
+            data["rooms"][room_id]["assignedTeachers"].append(teacher_id)
+        # contiguous blocks keep a class's roster stable across dataset sizes
+        start = ((i - 1) * per_class) % max(1, students)
+        for k in range(min(per_class, students)):
+            data["students"][student_ids[(start + k) % students]]["classes"].append(class_id)
+    return data
+
+
+def seed_school(client, **kwargs):
+    """Load school_dataset(**kwargs) into client; returns the dataset."""
+    dataset = school_dataset(**kwargs)
+    client.load(dataset)
+    return dataset
+
+
+def parse_school_spec(spec):
+    """'teachers=10,students=300' -> {'teachers': 10, 'students': 300} (kiosk_serial stays a string)."""
+    out = {}
+    for part in (spec or "").split(","):
+        key, sep, val = part.partition("=")
+        key = key.strip()
+        if not sep or not key:
+            continue
+        out[key] = val.strip() if key == "kiosk_serial" else int(val)
+    return out
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except Exception:
+        return float(default)
+
+
+def from_env():
+    """Build a FakeFirestore configured from the FAKE_FIRESTORE_* variables."""
+    client = FakeFirestore(
+        latency_ms=_env_float("FAKE_FIRESTORE_LATENCY_MS", "0"),
+        jitter_ms=_env_float("FAKE_FIRESTORE_JITTER_MS", "0"),
+        fail_rate=_env_float("FAKE_FIRESTORE_FAIL_RATE", "0"),
+    )
+    seed = (os.environ.get("FAKE_FIRESTORE_SEED") or "").strip()
+    try:
+        if seed == "school":
+            seed_school(client, **parse_school_spec(os.environ.get("FAKE_FIRESTORE_SCHOOL")))
+        elif seed:
+            with open(seed) as f:
+                client.load(json.load(f))
+    except Exception as e:
+        print(f"fake firestore: seeding failed: {e}")
+    return client
+
+
+@router.get("/debug/fake-firestore")
+def debug_fake_firestore():
+    from . import sync
+    client = getattr(sync, "db_fs", None)
+    if not isinstance(client, FakeFirestore):
+        return JSONResponse(content={"error": "not_found"}, status_code=404)
+    with client._lock:
+        counts = {path: len(docs) for path, docs in client._data.items() if "/" not in path}
+        return {"stats": dict(client.stats), "collections": counts, "listeners": len(client._watches),
+                "latency_ms": client.latency_ms, "fail_rate": client.fail_rate, "offline": client._offline}
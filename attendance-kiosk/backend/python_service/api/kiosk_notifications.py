@@ -1,8 +1,10 @@
 from fastapi import APIRouter
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 import time
 import os
 import json
+import threading
+from typing import Optional
 
 from . import state
 from . import sync as _sync
@@ -11,175 +13,338 @@ import sqlite3
 router = APIRouter()
 
 
-def insert_local_and_maybe_remote(props: dict):
-    """Insert a local kiosk notification into sqlite.
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except Exception:
+        return float(default)
 
-    This is best-effort: it will insert the row locally and return.
-    If a notif with the same `notif_id` already exists, the insert is ignored.
-    """
+
+# the uploader sends at most once per NOTIF_UPLOAD_INTERVAL seconds
+UPLOAD_INTERVAL = _env_float('NOTIF_UPLOAD_INTERVAL', '5')
+UPLOAD_BACKOFF_MAX = _env_float('NOTIF_UPLOAD_BACKOFF_MAX', '300')
+# the same title/type/kiosk within this window bumps the earlier row's count
+DEDUP_SECONDS = _env_float('NOTIF_DEDUP_SECONDS', '300')
+FIRESTORE_BATCH_LIMIT = 500
+# retention: synced rows older than NOTIF_RETENTION_DAYS or beyond the newest
+# NOTIF_MAX_ROWS are deleted every NOTIF_RETENTION_INTERVAL seconds (0 disables a
+# cap); pending rows are kept until the uploader has pushed them
+RETENTION_DAYS = _env_float('NOTIF_RETENTION_DAYS', '30')
+RETENTION_MAX_ROWS = int(_env_float('NOTIF_MAX_ROWS', '5000'))
+RETENTION_INTERVAL = _env_float('NOTIF_RETENTION_INTERVAL', '3600')
+VACUUM_PAGES = int(_env_float('NOTIF_VACUUM_PAGES', '500'))
+
+# type filters by minimum severity (?severity=warning -> warning and alert)
+SEVERITY_TYPES = {
+    'info': ('info', 'success', 'warning', 'alert'),
+    'warning': ('warning', 'alert'),
+    'alert': ('alert',),
+}
+
+_wake = threading.Event()
+_uploader = {"last_sent_at": 0.0, "failures": 0, "last_error": None, "uploaded": 0, "retention_at": 0.0, "removed": 0}
+
+# pre-serialized latest page per limit; _list_version is bumped on every change
+_list_cache = {}
+_list_lock = threading.Lock()
+_list_version = 0
+
+
+def _invalidate_list():
+    global _list_version
+    with _list_lock:
+        _list_version += 1
+        _list_cache.clear()
+
+
+def _insert_notification(conn, props):
+    cur = conn.cursor()
+    notif_id = props.get('notif_id') or f"notif-{int(time.time())}"
+    kiosk_id = props.get('kiosk_id')
+    room = props.get('room')
+    # If kiosk_id or room not provided, attempt to read from local kiosks_fs table
     try:
-        conn = state.get_db()
-        cur = conn.cursor()
-        notif_id = props.get('notif_id') or f"notif-{int(time.time())}"
-        kiosk_id = props.get('kiosk_id')
-        room = props.get('room')
-        # If kiosk_id or room not provided, attempt to read from local kiosks_fs table
-        try:
-            if (not kiosk_id or not room):
-                try:
-                    cur.execute("SELECT fs_id, assignedRoomId FROM kiosks_fs LIMIT 1")
-                    r = cur.fetchone()
-                    if r:
-                        if not kiosk_id:
-                            kiosk_id = r[0]
-                        if not room:
-                            room = r[1]
-                except Exception:
-                    pass
-        except Exception:
-            pass
-        title = props.get('title') or props.get('msg') or ''
-        ntype = props.get('type') or 'info'
-        details = props.get('details')
-        # store details as JSON string for flexibility
-        details_s = None
-        try:
-            details_s = json.dumps(details) if details is not None else None
-        except Exception:
+        if (not kiosk_id or not room):
             try:
-                details_s = str(details)
+                cur.execute("SELECT fs_id, assignedRoomId FROM kiosks_fs LIMIT 1")
+                r = cur.fetchone()
+                if r:
+                    if not kiosk_id:
+                        kiosk_id = r[0]
+                    if not room:
+                        room = r[1]
             except Exception:
-                details_s = None
+                pass
+    except Exception:
+        pass
+    title = props.get('title') or props.get('msg') or ''
+    ntype = props.get('type') or 'info'
+    details = props.get('details')
+    # store details as JSON string for flexibility
+    details_s = None
+    try:
+        details_s = json.dumps(details) if details is not None else None
+    except Exception:
+        try:
+            details_s = str(details)
+        except Exception:
+            details_s = None
 
-        timestamp = props.get('timestamp') or time.strftime("%Y-%m-%dT%H:%M:%S%z")
-        createdAt = props.get('createdAt') or timestamp
+    timestamp = props.get('timestamp') or time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    createdAt = props.get('createdAt') or timestamp
+    now_ts = time.time()
+    occurrences = 1
 
-        # Use INSERT OR IGNORE to avoid duplicate notif_id entries
+    # Collapse repeats (e.g. internet lost/restored flapping) into the earlier
+    # row: it is re-inserted under the same notif_id with a higher count so it
+    # sorts as the latest event and is re-uploaded over the same Firestore doc.
+    if DEDUP_SECONDS > 0:
         cur.execute(
-            "INSERT OR IGNORE INTO kiosk_notifications (notif_id,kiosk_id,room,title,type,details,timestamp,createdAt) VALUES (?,?,?,?,?,?,?,?)",
-            (notif_id, kiosk_id, room, title, ntype, details_s, timestamp, createdAt),
+            "SELECT id, notif_id, createdAt, COALESCE(occurrences, 1) FROM kiosk_notifications WHERE title = ? AND type = ? AND kiosk_id IS ? AND last_occurred_ts >= ? ORDER BY id DESC LIMIT 1",
+            (title, ntype, kiosk_id, now_ts - DEDUP_SECONDS),
         )
-        conn.commit()
-        try:
-            conn.close()
-        except Exception:
-            pass
-        # After inserting locally, attempt to push all pending notifications to Firestore
-        try:
-            if getattr(_sync, 'db_fs', None):
-                _push_pending_to_firestore(_sync.db_fs)
-        except Exception:
-            pass
-        return True
+        prev = cur.fetchone()
+        if prev:
+            cur.execute("DELETE FROM kiosk_notifications WHERE id = ?", (prev[0],))
+            notif_id = prev[1]
+            createdAt = prev[2] or createdAt
+            occurrences = prev[3] + 1
+
+    # Use INSERT OR IGNORE to avoid duplicate notif_id entries
+    cur.execute(
+        "INSERT OR IGNORE INTO kiosk_notifications (notif_id,kiosk_id,room,title,type,details,timestamp,createdAt,occurrences,last_occurred_ts) VALUES (?,?,?,?,?,?,?,?,?,?)",
+        (notif_id, kiosk_id, room, title, ntype, details_s, timestamp, createdAt, occurrences, now_ts),
+    )
+    return True
+
+
+def insert_local_and_maybe_remote(props: dict):
+    """Insert a local kiosk notification into sqlite.
+
+    Only the local insert happens on the caller's thread; the background
+    uploader pushes pending rows to Firestore in batches.
+    If a notif with the same `notif_id` already exists, the insert is ignored.
+    """
+    try:
+        state.run_write(_insert_notification, props)
     except Exception:
-        try:
-            if conn:
-                conn.close()
-        except Exception:
-            pass
         return False
+    _invalidate_list()
+    _wake.set()
+    return True
+
+
+def _mark_synced(conn, synced):
+    # rows collapsed while the batch was in flight were re-inserted under a new id and stay pending
+    conn.executemany("UPDATE kiosk_notifications SET fs_id = ?, sync_status = 'synced' WHERE id = ?", synced)
 
 
 def _push_pending_to_firestore(db_fs):
-    """Push local pending kiosk_notifications rows to Firestore.
+    """Push pending kiosk_notifications rows to Firestore in batch writes.
 
-    Uses notif_id as the Firestore document id (if available) to avoid duplicates.
-    Updates local row with fs_id and sync_status='synced' on success.
+    Uses notif_id as the Firestore document id so re-sending (or re-sending a
+    collapsed row with a higher count) overwrites instead of duplicating.
+    Returns the number of rows uploaded; raises if a batch commit fails.
     """
     if not db_fs:
-        return
-    conn = None
+        return 0
+    conn = state.get_read_db()
     try:
-        conn = state.get_db()
-        cur = conn.cursor()
-        # select rows that haven't been synced (sync_status != 'synced' or fs_id is null)
-        cur.execute("SELECT id, notif_id, kiosk_id, room, title, type, details, timestamp, createdAt FROM kiosk_notifications WHERE sync_status != 'synced' OR fs_id IS NULL")
-        rows = cur.fetchall()
-        for r in rows:
-            local_id = r[0]
-            notif_id = r[1] or f"notif-{int(time.time())}-{local_id}"
-            kiosk_id = r[2]
-            room = r[3]
-            title = r[4]
-            ntype = r[5]
-            details_s = r[6]
-            timestamp = r[7]
-            createdAt = r[8]
-            # parse details JSON if present
-            details = None
-            try:
-                if details_s:
-                    import json as _json
-                    details = _json.loads(details_s)
-            except Exception:
-                details = details_s
-
-            # Build Firestore doc data
-            doc = {
-                'notif_id': notif_id,
-                'kiosk_id': kiosk_id,
-                'room': room,
-                'title': title,
-                'type': ntype,
-                'details': details,
-                'timestamp': timestamp,
-                'createdAt': createdAt,
-            }
+        rows = conn.execute(
+            "SELECT id, notif_id, kiosk_id, room, title, type, details, timestamp, createdAt, COALESCE(occurrences, 1) FROM kiosk_notifications WHERE sync_status = 'pending' ORDER BY id LIMIT ?",
+            (FIRESTORE_BATCH_LIMIT,),
+        ).fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return 0
+    batch = db_fs.batch()
+    synced = []
+    for r in rows:
+        local_id = r[0]
+        notif_id = r[1] or f"notif-{int(time.time())}-{local_id}"
+        # parse details JSON if present
+        details = None
+        try:
+            if r[6]:
+                details = json.loads(r[6])
+        except Exception:
+            details = r[6]
+        doc = {
+            'notif_id': notif_id,
+            'kiosk_id': r[2],
+            'room': r[3],
+            'title': r[4],
+            'type': r[5],
+            'details': details,
+            'timestamp': r[7],
+            'createdAt': r[8],
+            'occurrences': r[9],
+        }
+        batch.set(db_fs.collection('kiosk_notifications').document(str(notif_id)), doc)
+        synced.append((str(notif_id), local_id))
+    batch.commit()
+    state.run_write(_mark_synced, synced)
+    _invalidate_list()
+    return len(synced)
+
+
+def _enforce_retention(conn):
+    removed = 0
+    if RETENTION_DAYS > 0:
+        cutoff = time.time() - RETENTION_DAYS * 86400.0
+        removed += conn.execute(
+            "DELETE FROM kiosk_notifications WHERE sync_status = 'synced' AND last_occurred_ts < ?", (cutoff,)
+        ).rowcount
+    if RETENTION_MAX_ROWS > 0:
+        removed += conn.execute(
+            "DELETE FROM kiosk_notifications WHERE sync_status = 'synced' AND id <= (SELECT id FROM kiosk_notifications ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (RETENTION_MAX_ROWS,),
+        ).rowcount
+    return removed
+
+
+def _incremental_vacuum(conn):
+    """Return freed pages to the filesystem a few at a time.
+
+    Only databases created with auto_vacuum=INCREMENTAL (state._create_schema)
+    can; older ones keep reusing their free pages (see DB_CONVERT_AUTO_VACUUM).
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return
+    conn.execute(f"PRAGMA incremental_vacuum({max(1, VACUUM_PAGES)})").fetchall()
+
+
+def run_retention():
+    """Apply the retention caps and vacuum; returns the number of rows removed."""
+    removed = state.run_write(_enforce_retention)
+    if removed:
+        _invalidate_list()
+    state.run_write(_incremental_vacuum)
+    _uploader["retention_at"] = time.time()
+    _uploader["removed"] += removed
+    return removed
+
+
+def _upload_loop():
+    while True:
+        _wake.wait(UPLOAD_INTERVAL)
+        _wake.clear()
+        if RETENTION_INTERVAL > 0 and time.time() - _uploader["retention_at"] >= RETENTION_INTERVAL:
             try:
-                # Use notif_id as document id to make this idempotent
-                db_fs.collection('kiosk_notifications').document(str(notif_id)).set(doc)
-                # mark local row as synced
-                try:
-                    cur.execute("UPDATE kiosk_notifications SET fs_id = ?, sync_status = 'synced' WHERE id = ?", (str(notif_id), local_id))
-                    conn.commit()
-                except Exception:
-                    try:
-                        conn.rollback()
-                    except Exception:
-                        pass
-            except Exception:
-                # leave as pending
-                continue
+                run_retention()
+            except Exception as e:
+                print("kiosk_notifications retention failed:", e)
+                _uploader["retention_at"] = time.time()
+        # rate limit: at most one upload round per interval, longer after failures
+        delay = UPLOAD_INTERVAL
+        if _uploader["failures"]:
+            delay = min(UPLOAD_BACKOFF_MAX, UPLOAD_INTERVAL * (2 ** _uploader["failures"]))
+        wait = _uploader["last_sent_at"] + delay - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        db_fs = getattr(_sync, 'db_fs', None)
+        if not db_fs:
+            continue
+        _uploader["last_sent_at"] = time.time()
+        try:
+            # drain in batch-sized rounds
+            while True:
+                n = _push_pending_to_firestore(db_fs)
+                _uploader["uploaded"] += n
+                if n < FIRESTORE_BATCH_LIMIT:
+                    break
+            _uploader["failures"] = 0
+            _uploader["last_error"] = None
+        except Exception as e:
+            _uploader["failures"] += 1
+            _uploader["last_error"] = str(e)
+
+
+try:
+    threading.Thread(target=_upload_loop, name="notif-uploader", daemon=True).start()
+except Exception:
+    pass
+
+
+def _row_to_item(r):
+    details = r[6]
+    try:
+        details = json.loads(details) if details else None
     except Exception:
         pass
+    return {
+        'id': r[0],
+        'notif_id': r[1],
+        'kiosk_id': r[2],
+        'room': r[3],
+        'title': r[4],
+        'type': r[5],
+        'details': details,
+        'timestamp': r[7],
+        'createdAt': r[8],
+        'fs_id': r[9],
+        'occurrences': r[10],
+    }
+
+
+def _query_notifications(limit, before_id=None, since_id=None, types=None):
+    where = []
+    params = []
+    if before_id is not None:
+        where.append("id < ?")
+        params.append(before_id)
+    if since_id is not None:
+        where.append("id > ?")
+        params.append(since_id)
+    if types:
+        where.append(f"type IN ({','.join('?' * len(types))})")
+        params.extend(types)
+    sql = "SELECT id,notif_id,kiosk_id,room,title,type,details,timestamp,createdAt,fs_id,COALESCE(occurrences,1) FROM kiosk_notifications"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+    conn = state.get_read_db()
+    try:
+        return [_row_to_item(r) for r in conn.execute(sql, params).fetchall()]
     finally:
         try:
-            if conn:
-                conn.close()
+            conn.close()
         except Exception:
             pass
 
 
 @router.get("/kiosk_notifications")
-def list_notifications(limit: int = 100):
-    """Return recent kiosk notifications (most recent first)."""
+def list_notifications(limit: int = 100, before_id: Optional[int] = None, since_id: Optional[int] = None,
+                       type: Optional[str] = None, severity: Optional[str] = None):
+    """Return kiosk notifications, most recent first.
+
+    before_id pages back (keyset), since_id returns only newer rows, type is a
+    comma-separated list and severity a minimum level (info/warning/alert).
+    The unfiltered latest page is served from a pre-serialized cache.
+    """
     try:
-        conn = state.get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT notif_id,kiosk_id,room,title,type,details,timestamp,createdAt,fs_id FROM kiosk_notifications ORDER BY id DESC LIMIT ?", (limit,))
-        rows = cur.fetchall()
-        res = []
-        for r in rows:
-            details = r[5]
-            try:
-                details = json.loads(details) if details else None
-            except Exception:
-                pass
-            res.append({
-                'notif_id': r[0],
-                'kiosk_id': r[1],
-                'room': r[2],
-                'title': r[3],
-                'type': r[4],
-                'details': details,
-                'timestamp': r[6],
-                'createdAt': r[7],
-                'fs_id': r[8],
-            })
-        try:
-            conn.close()
-        except Exception:
-            pass
-        return res
+        limit = max(1, min(int(limit), 1000))
+        types = [t.strip() for t in type.split(',') if t.strip()] if type else []
+        if severity:
+            allowed = SEVERITY_TYPES.get(severity.strip().lower())
+            if allowed is None:
+                return JSONResponse(content={"error": "unknown_severity"}, status_code=400)
+            types = [t for t in types if t in allowed] if types else list(allowed)
+            if not types:
+                return []
+        if before_id is not None or since_id is not None or types:
+            return _query_notifications(limit, before_id, since_id, types)
+
+        with _list_lock:
+            version = _list_version
+            body = _list_cache.get(limit)
+        if body is None:
+            body = json.dumps(_query_notifications(limit)).encode()
+            with _list_lock:
+                if _list_version == version:
+                    _list_cache[limit] = body
+        return Response(content=body, media_type="application/json")
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
@@ -19,10 +19,20 @@ def _safe_id(doc_id: str) -> str:
     return "".join(c for c in (doc_id or "") if (c.isalnum() or c in "-_"))
 
 
-def save_profile_photo(doc_id: str, role: str, img_bytes: bytes) -> str:
+def local_photo_file(doc_id: str, role: str) -> str:
+    """Return the filesystem path of a saved profile photo (may not exist)."""
+    safe = _safe_id(doc_id)
+    if not safe:
+        return ""
+    folder = TEACHERS_DIR if role == "teachers" else STUDENTS_DIR
+    return os.path.join(folder, f"{safe}.jpg")
+
+
+def save_profile_photo(doc_id: str, role: str, img_bytes: bytes, overwrite: bool = False) -> str:
     """Save image bytes to local photos folder and return a local URL path.
 
     role: "students" or "teachers"
+    overwrite: replace an existing file (used when the remote photo changed)
     returns path like: /images/{role}/{docid}.jpg (or empty string on failure)
     """
     if not doc_id or not img_bytes:
@@ -34,10 +44,10 @@ def save_profile_photo(doc_id: str, role: str, img_bytes: bytes) -> str:
     try:
         os.makedirs(folder, exist_ok=True)
         path = os.path.join(folder, f"{safe}.jpg")
-        # If the file already exists, preserve it and do not overwrite.
-        if os.path.exists(path):
+        # If the file already exists, preserve it unless asked to overwrite.
+        if os.path.exists(path) and not overwrite:
             return f"/photos/{role}/{safe}.jpg"
-        # write bytes atomically for new files
+        # write bytes atomically
         tmp = path + ".tmp"
         with open(tmp, "wb") as f:
             f.write(img_bytes)
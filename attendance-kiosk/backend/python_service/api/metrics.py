@@ -0,0 +1,322 @@
+"""In-process Prometheus metrics for the kiosk backend.
+
+A deliberately small collector set (no prometheus_client dependency):
+counters, gauges and fixed-bucket histograms keyed by a tuple of label
+values. Recording is a dict lookup plus a few integer updates under one
+lock, cheap enough to leave on in production on a Pi. GET /metrics renders
+the Prometheus text exposition format (0.0.4).
+"""
+from fastapi import APIRouter
+from fastapi.responses import Response
+from bisect import bisect_left
+import functools
+import sqlite3
+import threading
+import time
+
+router = APIRouter()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds; covers sub-millisecond SQLite queries up to slow HTTP calls
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# seconds; Firestore sync / outbox drains
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# row counts
+SIZE_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _samples(self):
+        return []
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Monotonic counter. By convention the name ends in _total."""
+    kind = "counter"
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            series = list(self._series.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in series]
+
+
+class Gauge(_Metric):
+    """Point-in-time value. With fn, the value is computed at scrape time.
+
+    fn returns a number (unlabelled gauge) or a {label tuple: value} dict.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), fn=None):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._series[labels] = value
+
+    def _samples(self):
+        if self.fn is not None:
+            try:
+                res = self.fn()
+            except Exception:
+                return []
+            series = list(res.items()) if isinstance(res, dict) else ([((), res)] if res is not None else [])
+        else:
+            with self._lock:
+                series = list(self._series.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in series]
+
+
+class Histogram(_Metric):
+    """Fixed-bucket histogram; observe() is one bisect and three increments."""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+
+    def observe(self, value, labels=()):
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            s[0][idx] += 1
+            s[1] += value
+            s[2] += 1
+
+    def time(self, labels=()):
+        """Decorator timing each call of the wrapped function."""
+        def deco(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, labels)
+            return wrapper
+        return deco
+
+    def _samples(self):
+        with self._lock:
+            series = [(k, list(s[0]), s[1], s[2]) for k, s in self._series.items()]
+        out = []
+        for labels, counts, total, count in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = 'le="' + _format_value(bound) + '"'
+                out.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            out.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            out.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return out
+
+
+def render():
+    with _registry_lock:
+        metrics = list(_registry)
+    parts = []
+    for m in metrics:
+        try:
+            parts.append(m.render())
+        except Exception:
+            pass
+    return "\n".join(parts) + "\n"
+
+
+# --- metric definitions -----------------------------------------------------
+
+PROCESS_START = Gauge("kiosk_process_start_time_seconds", "Start time of the backend process since the unix epoch.")
+PROCESS_START.set(time.time())
+
+# recognition pipeline (api/recognition.py)
+INFER_STAGE_SECONDS = Histogram(
+    "kiosk_infer_stage_seconds",
+    "Inference thread time per stage (detect, embed, match).",
+    ("stage",),
+)
+FRAME_LATENCY_SECONDS = Histogram(
+    "kiosk_frame_result_latency_seconds",
+    "Time from frame capture until its recognition result is published.",
+)
+JPEG_ENCODE_SECONDS = Histogram(
+    "kiosk_jpeg_encode_seconds",
+    "JPEG encode time for the camera feed.",
+)
+FRAMES_DROPPED = Counter(
+    "kiosk_frames_dropped_total",
+    "Frames replaced in a pipeline queue before a worker picked them up.",
+    ("queue",),
+)
+MATCHES = Counter(
+    "kiosk_face_matches_total",
+    "Faces matched against registered embeddings.",
+    ("kind",),
+)
+UNKNOWN_FACES = Counter(
+    "kiosk_face_unknown_total",
+    "Faces with an embedding that matched no teacher or student.",
+)
+
+# HTTP (HTTPMetricsMiddleware)
+HTTP_SECONDS = Histogram(
+    "kiosk_http_request_seconds",
+    "HTTP request latency by route template.",
+    ("method", "route", "status"),
+)
+
+# SQLite (state._connect / get_read_db / writer)
+SQLITE_QUERY_SECONDS = Histogram(
+    "kiosk_sqlite_query_seconds",
+    "SQLite statement execution time by statement kind.",
+    ("op",),
+)
+SQLITE_WRITE_BATCH_SECONDS = Histogram(
+    "kiosk_sqlite_write_batch_seconds",
+    "Writer thread time per group-committed batch, including the commit.",
+)
+
+# Firestore sync and outbox
+SYNC_SECONDS = Histogram(
+    "kiosk_sync_seconds",
+    "Firestore -> SQLite sync duration.",
+    ("kind",),
+    buckets=SLOW_BUCKETS,
+)
+OUTBOX_DRAIN_SECONDS = Histogram(
+    "kiosk_outbox_drain_seconds",
+    "Duration of one outbox drain run.",
+    buckets=SLOW_BUCKETS,
+)
+OUTBOX_DRAIN_ROWS = Histogram(
+    "kiosk_outbox_drain_rows",
+    "Outbox rows handled by one drain run.",
+    buckets=SIZE_BUCKETS,
+)
+
+
+# --- SQLite instrumentation -------------------------------------------------
+
+_SQL_OPS = {"SELECT": "select", "INSERT": "insert", "UPDATE": "update", "DELETE": "delete", "WITH": "select"}
+
+
+def _sql_op(sql):
+    try:
+        return _SQL_OPS.get(sql.lstrip()[:6].split(None, 1)[0].upper(), "other")
+    except Exception:
+        return "other"
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            SQLITE_QUERY_SECONDS.observe(time.perf_counter() - start, (_sql_op(sql),))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            SQLITE_QUERY_SECONDS.observe(time.perf_counter() - start, (_sql_op(sql),))
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection factory whose statements feed SQLITE_QUERY_SECONDS."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # Connection.execute() does not go through cursor(); route it explicitly
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+# --- HTTP instrumentation ---------------------------------------------------
+
+class HTTPMetricsMiddleware:
+    """Plain ASGI middleware timing each request by its matched route template.
+
+    Unmatched paths are folded into one label value so scanners cannot blow
+    up the series count.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope.get("type") != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = {"code": 500}
+
+        async def _send(message):
+            if message.get("type") == "http.response.start":
+                status["code"] = message.get("status", 500)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            HTTP_SECONDS.observe(
+                time.perf_counter() - start,
+                (scope.get("method", ""), path, str(status["code"])),
+            )
+
+
+@router.get("/metrics")
+def metrics_endpoint():
+    return Response(content=render(), media_type=CONTENT_TYPE)
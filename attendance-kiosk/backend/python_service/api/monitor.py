@@ -1,22 +1,68 @@
+"""Device health monitor.
+
+Each probe (internet, power/undervolt, temperature) runs on a small thread
+pool with its own interval and timeout, so a hanging HTTP request or
+vcgencmd call never delays the other samples. A probe that overruns its
+timeout is recorded as failed and is not re-submitted until the stuck call
+returns; its late result then replaces the failure. State transitions (internet lost/restored, overheating, low
+voltage) are handed to a single transition worker, which resolves the kiosk
+id, writes notifications and runs the post-reconnect sync off the sampling
+path.
+
+Probe targets are configurable (MONITOR_INTERNET_URLS, MONITOR_INTERNET_SOCKET,
+MONITOR_THERMAL_PATH) so a local stub server can stand in for the internet.
+"""
+import queue
+import socket
 import threading
 import time
 import subprocess
 import requests
 import time as _time
 import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+try:
+    import numpy as np
+except Exception:
+    np = None
 
 from . import state
 
 router = APIRouter()
 
-# Public status object updated by the monitor loop
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except Exception:
+        return float(default)
+
+
+INTERNET_URLS = [u.strip() for u in os.environ.get(
+    'MONITOR_INTERNET_URLS',
+    'https://clients3.google.com/generate_204,http://clients3.google.com/generate_204',
+).split(',') if u.strip()]
+# host:port for the socket fallback; empty disables it
+INTERNET_SOCKET = os.environ.get('MONITOR_INTERNET_SOCKET', '8.8.8.8:53').strip()
+# per request; the probe deadline below covers every URL plus the socket
+INTERNET_REQUEST_TIMEOUT = _env_float('MONITOR_INTERNET_REQUEST_TIMEOUT', '2')
+THERMAL_PATH = os.environ.get('MONITOR_THERMAL_PATH', '/sys/class/thermal/thermal_zone0/temp')
+HOT_C_THRESHOLD = _env_float('HOT_C_THRESHOLD', '75')
+SCHEDULER_TICK = 0.25
+
+# Public status object updated by the probes
 status = {
     "online": None,
     "undervolt": None,
     "temp_c": None,
     "hot": None,
     "last_checked": None,
+    "throttled": None,
+    "probes": {},
 }
 
 
@@ -24,7 +70,7 @@ def _get_local_kiosk_and_room():
     kiosk_id_local = None
     room_id_local = None
     try:
-        conn_loc = state.get_db()
+        conn_loc = state.get_read_db()
         cur_loc = conn_loc.cursor()
         try:
             cur_loc.execute("SELECT fs_id, assignedRoomId FROM kiosks_fs LIMIT 1")
@@ -71,54 +117,57 @@ def _get_local_kiosk_and_room():
 def _check_internet(timeout=2.0):
     """Return True if a simple HTTP request indicates internet connectivity."""
     try:
-        # lightweight endpoint that returns 204 on success (prefer HTTPS)
-        try:
-            r = requests.get("https://clients3.google.com/generate_204", timeout=timeout)
-            if r.status_code == 204 or (200 <= r.status_code < 400):
-                return True
-        except Exception:
-            # try HTTP as a fallback
+        # lightweight endpoints that return 204 on success (HTTPS first, then HTTP)
+        for url in INTERNET_URLS:
             try:
-                r = requests.get("http://clients3.google.com/generate_204", timeout=timeout)
+                r = requests.get(url, timeout=timeout)
                 if r.status_code == 204 or (200 <= r.status_code < 400):
                     return True
             except Exception:
                 pass
-        # fallback: attempt a lightweight socket connect to a public DNS (port 53)
-        try:
-            import socket
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(timeout)
-            s.connect(("8.8.8.8", 53))
-            s.close()
-            return True
-        except Exception:
-            return False
+        # fallback: attempt a lightweight socket connect (public DNS by default)
+        if INTERNET_SOCKET:
+            try:
+                host, _, port = INTERNET_SOCKET.rpartition(':')
+                s = socket.create_connection((host, int(port)), timeout=timeout)
+                s.close()
+                return True
+            except Exception:
+                return False
+        return False
     except Exception:
         return False
 
 
-def _check_undervolt():
+def _probe_internet(_deadline):
+    return _check_internet(INTERNET_REQUEST_TIMEOUT)
+
+
+def _read_throttled(timeout=2.0):
+    """Return the `vcgencmd get_throttled` bit field, or None if unavailable."""
     try:
-        p = subprocess.run(["vcgencmd", "get_throttled"], capture_output=True, text=True, timeout=2)
+        p = subprocess.run(["vcgencmd", "get_throttled"], capture_output=True, text=True, timeout=timeout)
         out = p.stdout.strip()
         if 'throttled=' in out:
-            hx = out.split('throttled=')[-1].strip()
-            try:
-                val = int(hx, 16)
-                undervolt = (val & 0x1) != 0
-                return undervolt
-            except Exception:
-                return False
-        return False
+            return int(out.split('throttled=')[-1].strip(), 16)
     except Exception:
+        pass
+    return None
+
+
+def _check_undervolt(timeout=2.0):
+    val = _read_throttled(timeout)
+    # the raw flags (throttling, frequency capping) feed the history buffer
+    status["throttled"] = val
+    if val is None:
         return False
+    return (val & 0x1) != 0
 
 
-def _check_temp():
+def _check_temp(timeout=None):
     """Return temperature in Celsius as float, or None if unavailable."""
     try:
-        with open('/sys/class/thermal/thermal_zone0/temp', 'r') as f:
+        with open(THERMAL_PATH, 'r') as f:
             val = f.read().strip()
             if val:
                 return int(val) / 1000.0
@@ -127,321 +176,399 @@ def _check_temp():
     return None
 
 
-def _monitor_loop():
+def _notify_outbox(online):
+    """Open/close the outbox circuit breaker on connectivity transitions."""
     try:
-        from . import kiosk_notifications as kn
+        from . import outbox
+        if online:
+            outbox.notify_online()
+        else:
+            outbox.notify_offline()
     except Exception:
-        kn = None
+        pass
 
-    was_online = None
-    was_undervolt = None
-    was_hot = None
 
-    # Run an immediate one-shot health check at thread start so operators
-    # see startup conditions (overheat, low-voltage, no-internet) without
-    # waiting for the first periodic interval.
-    try:
-        try:
-            online = _check_internet()
-        except Exception:
-            online = False
-        try:
-            undervolt = _check_undervolt()
-        except Exception:
-            undervolt = False
-        try:
-            temp_c = _check_temp()
-        except Exception:
-            temp_c = None
+# --- transition worker -------------------------------------------------------
 
-        HOT_C_THRESHOLD = float(os.environ.get('HOT_C_THRESHOLD', '75'))
-        hot = (temp_c is not None and temp_c >= HOT_C_THRESHOLD)
+_transitions = queue.Queue()
 
-        # update public status immediately
-        try:
-            status["online"] = online
-            status["undervolt"] = undervolt
-            status["temp_c"] = temp_c
-            status["hot"] = hot
-            status["last_checked"] = _time.strftime("%Y-%m-%dT%H:%M:%S%z")
-        except Exception:
-            pass
+# event -> (notif_id prefix, title, type, details format); startup events
+# describe conditions already present when the monitor starts
+_NOTIFICATIONS = {
+    'startup_hot': ('startup-device-hot', 'Device overheating', 'warning', 'Device overheating detected at startup {ts}'),
+    'startup_undervolt': ('startup-low-voltage', 'Low voltage detected', 'warning', 'Low voltage detected at startup {ts}'),
+    'startup_offline': ('startup-internet-lost', 'Internet connection lost', 'alert', 'No internet connectivity detected at startup {ts}'),
+    'hot': ('device-hot', 'Device overheating', 'warning', 'Device overheating detected at {ts}'),
+    'temp_normal': ('device-temp-normal', 'Device temperature normalized', 'success', 'Device temperature normalized at {ts}'),
+    'online': ('internet-restored', 'Internet restored', 'success', 'internet restored was a success at {ts}'),
+    'offline': ('internet-lost', 'Internet connection lost', 'alert', 'internet connection lost at {ts}'),
+    'undervolt': ('low-voltage', 'Low voltage detected', 'warning', 'Low voltage detected at {ts}'),
+    'undervolt_cleared': ('low-voltage-restored', 'Low voltage restored', 'success', 'Low voltage condition cleared at {ts}'),
+    'sync_completed': ('sync-completed', 'Sync completed', 'info', 'syncing was completed at {ts}'),
+}
 
-        # emit startup notifications for current problematic conditions
-        if kn:
-            kiosk_id_local, room_id_local = _get_local_kiosk_and_room()
-            ts = _time.strftime("%Y-%m-%dT%H:%M:%S%z")
-            try:
-                if hot:
-                    kn.insert_local_and_maybe_remote({
-                        'notif_id': f'startup-device-hot-{int(time.time())}',
-                        'kiosk_id': kiosk_id_local,
-                        'room': room_id_local,
-                        'title': 'Device overheating',
-                        'type': 'warning',
-                        'details': f'Device overheating detected at startup {ts}',
-                        'timestamp': ts,
-                        'createdAt': ts,
-                    })
-            except Exception:
-                pass
-            try:
-                if undervolt:
-                    kn.insert_local_and_maybe_remote({
-                        'notif_id': f'startup-low-voltage-{int(time.time())}',
-                        'kiosk_id': kiosk_id_local,
-                        'room': room_id_local,
-                        'title': 'Low voltage detected',
-                        'type': 'warning',
-                        'details': f'Low voltage detected at startup {ts}',
-                        'timestamp': ts,
-                        'createdAt': ts,
-                    })
-            except Exception:
-                pass
-            try:
-                if not online:
-                    kn.insert_local_and_maybe_remote({
-                        'notif_id': f'startup-internet-lost-{int(time.time())}',
-                        'kiosk_id': kiosk_id_local,
-                        'room': room_id_local,
-                        'title': 'Internet connection lost',
-                        'type': 'alert',
-                        'details': f'No internet connectivity detected at startup {ts}',
-                        'timestamp': ts,
-                        'createdAt': ts,
-                    })
-            except Exception:
-                pass
 
-            # If we have internet at startup, attempt a sync to pull remote notifications
-            # into the local DB immediately (best-effort).
-            try:
-                if online:
-                    from . import sync
-                    try:
-                        res = sync.sync_firestore()
-                        # If sync succeeded at startup, skip creating a duplicate startup-sync notification here.
-                        # Other monitor/device notifications will cover sync status transitions.
-                        pass
-                    except Exception:
-                        pass
-            except Exception:
-                pass
+def _insert_notification(event, kiosk_id_local, room_id_local):
+    try:
+        from . import kiosk_notifications as kn
+    except Exception:
+        return
+    prefix, title, ntype, details = _NOTIFICATIONS[event]
+    ts = _time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    try:
+        kn.insert_local_and_maybe_remote({
+            'notif_id': f'{prefix}-{int(time.time())}',
+            'kiosk_id': kiosk_id_local,
+            'room': room_id_local,
+            'title': title,
+            'type': ntype,
+            'details': details.format(ts=ts),
+            'timestamp': ts,
+            'createdAt': ts,
+        })
+    except Exception:
+        pass
+
 
-        # prime the previous-state variables so the regular loop treats the
-        # next transitions as changes from this baseline rather than from None.
-        was_online = online
-        was_undervolt = undervolt
-        was_hot = hot
+def _run_sync(kiosk_id_local=None, room_id_local=None, notify=True):
+    try:
+        from . import sync
+        res = sync.sync_firestore()
+        if notify and isinstance(res, dict) and res.get('status') == 'success':
+            _insert_notification('sync_completed', kiosk_id_local, room_id_local)
     except Exception:
-        # ignore any errors in the startup check to avoid stopping the monitor
         pass
 
+
+def _handle_transition(event):
+    kiosk_id_local, room_id_local = _get_local_kiosk_and_room()
+    if event == 'startup_sync':
+        # pull remote state right after boot; the sync reports its own status
+        _run_sync(notify=False)
+        return
+    _insert_notification(event, kiosk_id_local, room_id_local)
+    if event == 'online':
+        # pull remote notifications (and anything missed) into the local DB
+        _run_sync(kiosk_id_local, room_id_local)
+
+
+def _transition_worker():
     while True:
+        event = _transitions.get()
         try:
-            online = _check_internet()
-        except Exception:
-            online = False
+            _handle_transition(event)
+        except Exception as e:
+            print(f"monitor transition {event} failed: {e}")
+
+
+# --- probe scheduler ---------------------------------------------------------
+
+def _on_internet(online, previous):
+    status["online"] = online
+    if previous is None:
+        if not online:
+            _notify_outbox(False)
+            _transitions.put('startup_offline')
+        else:
+            _transitions.put('startup_sync')
+        return
+    if previous is False and online is True:
+        # wake the outbox before the (slower) notification and sync work
+        _notify_outbox(True)
+        _transitions.put('online')
+    elif previous is True and online is False:
+        _notify_outbox(False)
+        _transitions.put('offline')
+
+
+def _on_undervolt(undervolt, previous):
+    status["undervolt"] = undervolt
+    if previous is None:
+        if undervolt:
+            _transitions.put('startup_undervolt')
+    elif previous is False and undervolt is True:
+        _transitions.put('undervolt')
+    elif previous is True and undervolt is False:
+        _transitions.put('undervolt_cleared')
+
+
+def _on_temp(temp_c, previous):
+    # transitions are on the derived hot flag, not the raw temperature
+    prev_hot = status["hot"]
+    hot = (temp_c >= HOT_C_THRESHOLD) if temp_c is not None else None
+    status["temp_c"] = temp_c
+    status["hot"] = hot
+    if previous is None and prev_hot is None:
+        if hot:
+            _transitions.put('startup_hot')
+    elif prev_hot is False and hot is True:
+        _transitions.put('hot')
+    elif prev_hot is True and hot is False:
+        _transitions.put('temp_normal')
+
+
+# name -> probe config and bookkeeping; `failed` is the value recorded on timeout
+_probes = {
+    'internet': {
+        "fn": _probe_internet,
+        "interval": _env_float('MONITOR_INTERNET_INTERVAL', '15'),
+        "timeout": _env_float(
+            'MONITOR_INTERNET_TIMEOUT',
+            str(INTERNET_REQUEST_TIMEOUT * (len(INTERNET_URLS) + (1 if INTERNET_SOCKET else 0)) + 1.0),
+        ),
+        "failed": False,
+        "on_result": _on_internet,
+    },
+    'undervolt': {
+        "fn": _check_undervolt,
+        "interval": _env_float('MONITOR_POWER_INTERVAL', '15'),
+        "timeout": _env_float('MONITOR_POWER_TIMEOUT', '2'),
+        "failed": False,
+        "on_result": _on_undervolt,
+    },
+    'temp': {
+        "fn": _check_temp,
+        "interval": _env_float('MONITOR_TEMP_INTERVAL', '15'),
+        "timeout": _env_float('MONITOR_TEMP_TIMEOUT', '1'),
+        "failed": None,
+        "on_result": _on_temp,
+    },
+}
 
-        try:
-            undervolt = _check_undervolt()
-        except Exception:
-            undervolt = False
 
-        # update public status
+def register_probe(name, fn, interval, timeout, on_result=None, failed=None):
+    """Add a probe: fn(timeout) runs every `interval` seconds; on_result(value, previous)."""
+    _probes[name] = {"fn": fn, "interval": interval, "timeout": timeout, "failed": failed, "on_result": on_result}
+
+
+def _record(name, probe, value, started, timed_out=False, late=False):
+    previous = probe.get("value")
+    info = status["probes"].setdefault(name, {"runs": 0, "timeouts": 0, "late": 0})
+    if late:
+        # the run was already counted (as a timeout); this is its real answer
+        info["late"] = info.get("late", 0) + 1
+    else:
+        info["runs"] += 1
+    info["last_ms"] = round((time.time() - started) * 1000.0, 1)
+    info["last_run"] = _time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    if timed_out:
+        info["timeouts"] += 1
+    if late:
+        # the timeout already dispatched the failure; a slow answer is only
+        # counted, so one slow check is not an offline/online pair. The next
+        # run on time reconciles the value.
+        return
+    probe["value"] = value
+    if probe["on_result"] is not None:
+        # health probes only; the history sampler runs every second
+        status["last_checked"] = info["last_run"]
         try:
-            status["online"] = online
-            status["undervolt"] = undervolt
-            status["temp_c"] = None
-            status["hot"] = None
-            status["last_checked"] = _time.strftime("%Y-%m-%dT%H:%M:%S%z")
+            probe["on_result"](value, previous if probe.get("seen") else None)
+        except Exception as e:
+            print(f"monitor probe {name} handler failed: {e}")
+    probe["seen"] = True
 
-            # periodic temperature check (Raspberry Pi)
-            try:
-                temp_c = _check_temp()
-                if temp_c is not None:
-                    status["temp_c"] = temp_c
-                    HOT_C_THRESHOLD = float(os.environ.get('HOT_C_THRESHOLD', '75'))
-                    hot = temp_c >= HOT_C_THRESHOLD
-                    status["hot"] = hot
-                else:
-                    temp_c = None
-                    hot = None
-            except Exception:
-                temp_c = None
-                hot = None
-
-            # initialize previous state on first run
-            if was_online is None:
-                was_online = online
-            if was_undervolt is None:
-                was_undervolt = undervolt
-            if was_hot is None:
-                was_hot = hot
-
-            # temperature transitions
-            try:
-                if was_hot is False and hot is True:
-                    # overheating detected -> WARN
-                    if kn:
-                        kiosk_id_local, room_id_local = _get_local_kiosk_and_room()
-                        ts = _time.strftime("%Y-%m-%dT%H:%M:%S%z")
-                        try:
-                            kn.insert_local_and_maybe_remote({
-                                'notif_id': f'device-hot-{int(time.time())}',
-                                'kiosk_id': kiosk_id_local,
-                                'room': room_id_local,
-                                'title': 'Device overheating',
-                                'type': 'warning',
-                                'details': f'Device overheating detected at {ts}',
-                                'timestamp': ts,
-                                'createdAt': ts,
-                            })
-                        except Exception:
-                            pass
-                if was_hot is True and hot is False:
-                    # temperature normalized -> success
-                    if kn:
-                        kiosk_id_local, room_id_local = _get_local_kiosk_and_room()
-                        ts = _time.strftime("%Y-%m-%dT%H:%M:%S%z")
-                        try:
-                            kn.insert_local_and_maybe_remote({
-                                'notif_id': f'device-temp-normal-{int(time.time())}',
-                                'kiosk_id': kiosk_id_local,
-                                'room': room_id_local,
-                                'title': 'Device temperature normalized',
-                                'type': 'success',
-                                'details': f'Device temperature normalized at {ts}',
-                                'timestamp': ts,
-                                'createdAt': ts,
-                            })
-                        except Exception:
-                            pass
-            except Exception:
-                pass
-            was_hot = hot
 
-            # network transitions
+def _scheduler_loop():
+    pool = ThreadPoolExecutor(max_workers=len(_probes) + 2, thread_name_prefix='monitor-probe')
+    while True:
+        now = time.time()
+        for name, probe in list(_probes.items()):
             try:
-                if was_online is False and online is True:
-                    # internet restored -> success
-                    if kn:
-                        kiosk_id_local, room_id_local = _get_local_kiosk_and_room()
-                        ts = _time.strftime("%Y-%m-%dT%H:%M:%S%z")
-                        try:
-                            kn.insert_local_and_maybe_remote({
-                                'notif_id': f'internet-restored-{int(time.time())}',
-                                'kiosk_id': kiosk_id_local,
-                                'room': room_id_local,
-                                'title': 'Internet restored',
-                                'type': 'success',
-                                'details': f'internet restored was a success at {ts}',
-                                'timestamp': ts,
-                                'createdAt': ts,
-                            })
-                        except Exception:
-                            pass
-                    # attempt to run a full sync to pull remote notifications into local DB
-                    try:
-                        from . import sync
-                        try:
-                            res = sync.sync_firestore()
-                            # if sync reports success, create an info notification
-                            try:
-                                if isinstance(res, dict) and res.get('status') == 'success':
-                                    try:
-                                        ts2 = _time.strftime("%Y-%m-%dT%H:%M:%S%z")
-                                        kn.insert_local_and_maybe_remote({
-                                            'notif_id': f'sync-completed-{int(time.time())}',
-                                            'kiosk_id': kiosk_id_local,
-                                            'room': room_id_local,
-                                            'title': 'Sync completed',
-                                            'type': 'info',
-                                            'details': f'syncing was completed at {ts2}',
-                                            'timestamp': ts2,
-                                            'createdAt': ts2,
-                                        })
-                                    except Exception:
-                                        pass
-                            except Exception:
-                                pass
-                        except Exception:
-                            pass
-                    except Exception:
-                        pass
-                if was_online is True and online is False:
-                    # internet lost -> alert
-                    if kn:
-                        kiosk_id_local, room_id_local = _get_local_kiosk_and_room()
-                        ts = _time.strftime("%Y-%m-%dT%H:%M:%S%z")
+                fut = probe.get("future")
+                if fut is not None:
+                    if fut.done():
+                        probe["future"] = None
                         try:
-                            kn.insert_local_and_maybe_remote({
-                                'notif_id': f'internet-lost-{int(time.time())}',
-                                'kiosk_id': kiosk_id_local,
-                                'room': room_id_local,
-                                'title': 'Internet connection lost',
-                                'type': 'alert',
-                                'details': f'internet connection lost at {ts}',
-                                'timestamp': ts,
-                                'createdAt': ts,
-                            })
+                            value = fut.result()
                         except Exception:
-                            pass
-            except Exception:
-                pass
-            was_online = online
+                            value = probe["failed"]
+                        # a result arriving after the timeout is counted but not dispatched
+                        _record(name, probe, value, probe["started"], late=bool(probe.get("timed_out")))
+                    elif not probe.get("timed_out") and now - probe["started"] > probe["timeout"]:
+                        # keep sampling on schedule; the stuck call is not re-submitted until it returns
+                        probe["timed_out"] = True
+                        _record(name, probe, probe["failed"], probe["started"], timed_out=True)
+                    continue
+                if now >= probe.get("next_at", 0.0):
+                    probe["started"] = now
+                    probe["timed_out"] = False
+                    probe["next_at"] = now + probe["interval"]
+                    probe["future"] = pool.submit(probe["fn"], probe["timeout"])
+            except Exception as e:
+                print(f"monitor probe {name} failed: {e}")
+        time.sleep(SCHEDULER_TICK)
+
+
+# --- health history ----------------------------------------------------------
+#
+# A 1 Hz sample of device and pipeline health is kept in preallocated NumPy
+# columns (a ring buffer of HISTORY_SECONDS samples). Every ROLLUP_SECONDS
+# samples are averaged into a second, coarser ring so longer windows stay
+# cheap to serve.
+
+HISTORY_COLUMNS = (
+    'temp_c',        # SoC temperature
+    'throttled',     # vcgencmd get_throttled bit field (last power probe)
+    'cpu_pct',       # CPU busy % since the previous sample
+    'load1',         # 1 minute load average
+    'mem_pct',       # memory in use (MemTotal - MemAvailable)
+    'capture_fps',   # frames captured per second
+    'infer_fps',     # frames run through the face model per second
+    'infer_ms',      # mean model latency over the sample interval
+    'infer_q',       # recognition queue depths
+    'encode_q',
+    'write_q',       # database writer queue depth
+)
+# columns rolled up with max (flags) instead of mean
+_MAX_COLUMNS = ('throttled',)
+HISTORY_SECONDS = int(_env_float('MONITOR_HISTORY_SECONDS', '3600'))
+ROLLUP_SECONDS = int(_env_float('MONITOR_ROLLUP_SECONDS', '60'))
+ROLLUP_SLOTS = int(_env_float('MONITOR_ROLLUP_SLOTS', '1440'))
+HISTORY_MAX_POINTS = 300
+
+
+class RingBuffer:
+    """Fixed-size columnar ring buffer of float samples plus a timestamp column."""
+
+    def __init__(self, columns, capacity):
+        self.columns = tuple(columns)
+        self.capacity = max(1, int(capacity))
+        self.ts = np.zeros(self.capacity, dtype=np.float64)
+        self.data = np.full((len(self.columns), self.capacity), np.nan, dtype=np.float32)
+        self.index = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, ts, values):
+        with self.lock:
+            i = self.index
+            self.ts[i] = ts
+            self.data[:, i] = values
+            self.index = (i + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def window(self, seconds, now=None):
+        """Return (ts, data) for samples newer than now - seconds, oldest first."""
+        with self.lock:
+            if self.count == 0:
+                return self.ts[:0].copy(), self.data[:, :0].copy()
+            start = (self.index - self.count) % self.capacity
+            order = (np.arange(self.count) + start) % self.capacity
+            ts = self.ts[order]
+            data = self.data[:, order]
+        cutoff = (now or time.time()) - seconds
+        keep = ts >= cutoff
+        return ts[keep], data[:, keep]
+
+
+def _rollup(ts, data, step):
+    """Downsample (ts, data) in buckets of `step` samples (mean, max for flags)."""
+    n = (ts.shape[0] // step) * step
+    if step <= 1 or n == 0:
+        return ts, data
+    # keep the newest samples; a partial oldest bucket is dropped
+    ts = ts[-n:].reshape(-1, step)
+    data = data[:, -n:].reshape(data.shape[0], -1, step)
+    with warnings.catch_warnings():
+        # all-NaN buckets (metric not available) are expected
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        out = np.nanmean(data, axis=2)
+        for name in _MAX_COLUMNS:
+            i = HISTORY_COLUMNS.index(name)
+            out[i] = np.nanmax(data[i], axis=1)
+    return ts[:, -1], out
+
+
+_history = RingBuffer(HISTORY_COLUMNS, HISTORY_SECONDS) if np is not None else None
+_rollups = RingBuffer(HISTORY_COLUMNS, ROLLUP_SLOTS) if np is not None else None
+_sampler = {"cpu": None, "pipeline": None, "since_rollup": 0}
+
+
+def _read_cpu():
+    try:
+        with open('/proc/stat', 'r') as f:
+            parts = [float(x) for x in f.readline().split()[1:]]
+        idle = parts[3] + (parts[4] if len(parts) > 4 else 0.0)
+        return sum(parts), idle
+    except Exception:
+        return None
 
-            # undervolt transitions
-            try:
-                if was_undervolt is False and undervolt is True:
-                    # undervolt detected -> warning
-                    if kn:
-                        kiosk_id_local, room_id_local = _get_local_kiosk_and_room()
-                        ts = _time.strftime("%Y-%m-%dT%H:%M:%S%z")
-                        try:
-                            kn.insert_local_and_maybe_remote({
-                                'notif_id': f'low-voltage-{int(time.time())}',
-                                'kiosk_id': kiosk_id_local,
-                                'room': room_id_local,
-                                'title': 'Low voltage detected',
-                                'type': 'warning',
-                                'details': f'Low voltage detected at {ts}',
-                                'timestamp': ts,
-                                'createdAt': ts,
-                            })
-                        except Exception:
-                            pass
-                if was_undervolt is True and undervolt is False:
-                    # undervolt restored -> success
-                    if kn:
-                        kiosk_id_local, room_id_local = _get_local_kiosk_and_room()
-                        ts = _time.strftime("%Y-%m-%dT%H:%M:%S%z")
-                        try:
-                            kn.insert_local_and_maybe_remote({
-                                'notif_id': f'low-voltage-restored-{int(time.time())}',
-                                'kiosk_id': kiosk_id_local,
-                                'room': room_id_local,
-                                'title': 'Low voltage restored',
-                                'type': 'success',
-                                'details': f'Low voltage condition cleared at {ts}',
-                                'timestamp': ts,
-                                'createdAt': ts,
-                            })
-                        except Exception:
-                            pass
-            except Exception:
-                pass
 
-        except Exception:
-            # swallow any transient errors in the monitor loop to keep it running
-            pass
+def _read_mem_pct():
+    try:
+        info = {}
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                key, _, rest = line.partition(':')
+                if key in ('MemTotal', 'MemAvailable'):
+                    info[key] = float(rest.split()[0])
+        return 100.0 * (1.0 - info['MemAvailable'] / info['MemTotal'])
+    except Exception:
+        return float('nan')
+
+
+def _sample_history(timeout=None):
+    """Take one history sample (runs as a 1 Hz monitor probe)."""
+    if _history is None:
+        return None
+    now = time.time()
+    nan = float('nan')
+    row = dict.fromkeys(HISTORY_COLUMNS, nan)
+
+    temp_c = _check_temp()
+    row['temp_c'] = temp_c if temp_c is not None else nan
+    row['throttled'] = status.get("throttled") if status.get("throttled") is not None else nan
+    cpu = _read_cpu()
+    prev_cpu = _sampler["cpu"]
+    if cpu is not None and prev_cpu is not None and cpu[0] > prev_cpu[0]:
+        row['cpu_pct'] = 100.0 * (1.0 - (cpu[1] - prev_cpu[1]) / (cpu[0] - prev_cpu[0]))
+    _sampler["cpu"] = cpu
+    try:
+        row['load1'] = os.getloadavg()[0]
+    except Exception:
+        pass
+    row['mem_pct'] = _read_mem_pct()
 
-        time.sleep(15)
+    try:
+        from . import recognition
+        stats = recognition.pipeline_stats
+        cur = (now, stats["captured"], stats["inferred"], stats["infer_ms_total"])
+        prev = _sampler["pipeline"]
+        if prev is not None and cur[0] > prev[0]:
+            dt = cur[0] - prev[0]
+            row['capture_fps'] = (cur[1] - prev[1]) / dt
+            row['infer_fps'] = (cur[2] - prev[2]) / dt
+            if cur[2] > prev[2]:
+                row['infer_ms'] = (cur[3] - prev[3]) / (cur[2] - prev[2])
+        _sampler["pipeline"] = cur
+        row['infer_q'] = recognition._infer_q.qsize()
+        row['encode_q'] = recognition._encode_q.qsize()
+    except Exception:
+        pass
+    try:
+        row['write_q'] = state._write_q.qsize()
+    except Exception:
+        pass
+
+    _history.append(now, [row[c] for c in HISTORY_COLUMNS])
+    _sampler["since_rollup"] += 1
+    if _sampler["since_rollup"] >= ROLLUP_SECONDS:
+        _sampler["since_rollup"] = 0
+        ts, data = _history.window(ROLLUP_SECONDS + 0.5, now)
+        if ts.shape[0]:
+            rts, rdata = _rollup(ts, data, ts.shape[0])
+            _rollups.append(float(rts[-1]), rdata[:, -1])
+    return True
+
+
+if _history is not None:
+    register_probe('history', _sample_history, 1.0, 0.5)
 
 
 try:
-    t = threading.Thread(target=_monitor_loop, daemon=True)
+    threading.Thread(target=_transition_worker, name='monitor-transitions', daemon=True).start()
+    t = threading.Thread(target=_scheduler_loop, name='monitor-scheduler', daemon=True)
     t.start()
 except Exception:
     pass
@@ -453,3 +580,39 @@ def get_monitor_status():
         return {"status": status}
     except Exception:
         return {"status": "error"}
+
+
+@router.get('/monitor/history')
+def get_monitor_history(window: int = 600, step: int = 0):
+    """Columnar health history for the last `window` seconds.
+
+    Windows longer than the 1 Hz buffer are served from the per-minute
+    rollups. `step` (samples per point) defaults to at most 300 points.
+    """
+    if _history is None:
+        return JSONResponse(content={"error": "numpy_unavailable"}, status_code=503)
+    try:
+        window = max(1, int(window))
+        if window <= HISTORY_SECONDS:
+            ts, data = _history.window(window)
+            resolution = 1
+        else:
+            ts, data = _rollups.window(window)
+            resolution = ROLLUP_SECONDS
+        if step <= 0:
+            step = max(1, -(-ts.shape[0] // HISTORY_MAX_POINTS))
+        ts, data = _rollup(ts, data, step)
+        res = {
+            "window": window,
+            "resolution_s": resolution * step,
+            "points": int(ts.shape[0]),
+            "columns": list(HISTORY_COLUMNS),
+            "ts": [round(float(t), 3) for t in ts],
+        }
+        for i, name in enumerate(HISTORY_COLUMNS):
+            # NaN (not sampled) becomes null
+            col = np.round(data[i].astype(np.float64), 2)
+            res[name] = [None if v != v else float(v) for v in col]
+        return res
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
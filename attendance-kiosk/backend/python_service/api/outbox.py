@@ -1,13 +1,26 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
 from fastapi.responses import JSONResponse
 import threading
 import time
 import json
+import os
+import random
 
 from . import state
+from . import metrics
 
 router = APIRouter()
 
+try:
+    MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "10"))
+except Exception:
+    MAX_ATTEMPTS = 10
+try:
+    BACKOFF_BASE = float(os.environ.get("OUTBOX_BACKOFF_BASE", "5"))
+    BACKOFF_MAX = float(os.environ.get("OUTBOX_BACKOFF_MAX", "3600"))
+except Exception:
+    BACKOFF_BASE, BACKOFF_MAX = 5.0, 3600.0
+
 
 def _ensure_outbox_table(conn):
     conn.execute(
@@ -21,13 +34,568 @@ def _ensure_outbox_table(conn):
         )
     """
     )
+    # retry scheduling columns (safe to run repeatedly)
+    try:
+        conn.execute("ALTER TABLE attendance_sessions_outbox ADD COLUMN next_attempt_at REAL DEFAULT 0")
+    except Exception:
+        pass
+    try:
+        conn.execute("ALTER TABLE attendance_sessions_outbox ADD COLUMN last_error TEXT")
+    except Exception:
+        pass
+    # typed operations (see OP_TYPES); existing rows are per-session attendance pushes
+    try:
+        conn.execute("ALTER TABLE attendance_sessions_outbox ADD COLUMN op_type TEXT DEFAULT 'session_attendance'")
+    except Exception:
+        pass
+    try:
+        conn.execute("ALTER TABLE attendance_sessions_outbox ADD COLUMN payload JSON")
+    except Exception:
+        pass
+    # epoch seconds a row was synced (retention); rows synced before the column
+    # existed start their retention period now
+    try:
+        conn.execute("ALTER TABLE attendance_sessions_outbox ADD COLUMN synced_at REAL")
+    except Exception:
+        pass
+    conn.execute(
+        "UPDATE attendance_sessions_outbox SET synced_at = ? WHERE status = 'synced' AND synced_at IS NULL",
+        (time.time(),),
+    )
+    # session doc id stored when a session starts (older databases lack it)
+    try:
+        conn.execute("ALTER TABLE attendance_sessions ADD COLUMN fs_doc_id TEXT")
+    except Exception:
+        pass
+    # rows parked as 'failed' by the old fixed-retry loop: retry or dead-letter them
+    conn.execute(
+        "UPDATE attendance_sessions_outbox SET status = CASE WHEN attempts < ? THEN 'queued' ELSE 'dead' END WHERE status = 'failed'",
+        (MAX_ATTEMPTS,),
+    )
+    # due-time lookups (claim, next wake-up, backlog counts) go through this index,
+    # so next_attempt_at must not be NULL
+    conn.execute("UPDATE attendance_sessions_outbox SET next_attempt_at = 0 WHERE next_attempt_at IS NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status_due ON attendance_sessions_outbox (status, next_attempt_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_session ON attendance_sessions_outbox (local_session_id, status)")
+
+
+# Firestore rejects batched writes with more than 500 operations
+FIRESTORE_BATCH_LIMIT = 500
+try:
+    OUTBOX_WINDOW = int(os.environ.get("OUTBOX_WINDOW_ROWS", "200"))
+except Exception:
+    OUTBOX_WINDOW = 200
+# only used when the next due time cannot be read; otherwise the loop sleeps
+# until a row is due or notify_enqueued()/notify_online() wakes it
+try:
+    OUTBOX_POLL_SECONDS = float(os.environ.get("OUTBOX_POLL_SECONDS", "10"))
+except Exception:
+    OUTBOX_POLL_SECONDS = 10.0
+
+# circuit breaker: while open the loop does not touch Firestore or the table;
+# monitor calls notify_online() when connectivity comes back
+_breaker = {
+    "state": "closed",
+    "failures": 0,
+    "opened_at": None,
+    "retry_at": None,
+    "last_error": None,
+}
+_breaker_lock = threading.Lock()
+_wake = threading.Event()
+
+# synced rows are kept OUTBOX_SYNCED_RETENTION_DAYS for inspection, then
+# deleted (in chunks) every OUTBOX_RETENTION_INTERVAL seconds; 0 keeps them
+try:
+    SYNCED_RETENTION_DAYS = float(os.environ.get("OUTBOX_SYNCED_RETENTION_DAYS", "7"))
+    RETENTION_INTERVAL = float(os.environ.get("OUTBOX_RETENTION_INTERVAL", "3600"))
+except Exception:
+    SYNCED_RETENTION_DAYS, RETENTION_INTERVAL = 7.0, 3600.0
+RETENTION_CHUNK = 5000
+_retention = {"last_run": 0.0, "removed": 0}
+
+# marks arriving within this window are sent together (one ArrayUnion per session)
+try:
+    COALESCE_SECONDS = float(os.environ.get("OUTBOX_COALESCE_MS", "1000")) / 1000.0
+except Exception:
+    COALESCE_SECONDS = 1.0
+_coalesce = {"deadline": None}
+
+
+def _backoff_delay(attempts):
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** max(0, attempts - 1)))
+    # jitter spreads retries of rows that failed together
+    return random.uniform(delay / 2.0, delay)
+
+
+def _is_connectivity_error(e):
+    name = type(e).__name__
+    if name in ("ServiceUnavailable", "DeadlineExceeded", "RetryError", "TransportError", "ConnectionError", "Timeout", "ConnectTimeout", "GatewayTimeout"):
+        return True
+    msg = str(e).lower()
+    return any(k in msg for k in ("unavailable", "deadline", "connection", "timed out", "network"))
+
+
+def _breaker_allows():
+    with _breaker_lock:
+        if _breaker["state"] == "closed":
+            return True
+        if _breaker["retry_at"] is not None and time.time() >= _breaker["retry_at"]:
+            # half-open: let one run probe the connection
+            _breaker["state"] = "half_open"
+            return True
+        return False
+
+
+def _breaker_success():
+    with _breaker_lock:
+        _breaker.update({"state": "closed", "failures": 0, "opened_at": None, "retry_at": None})
+
+
+def _breaker_trip(err):
+    with _breaker_lock:
+        failures = _breaker["failures"] + 1
+        now = time.time()
+        _breaker.update({
+            "state": "open",
+            "failures": failures,
+            "opened_at": _breaker["opened_at"] or now,
+            "retry_at": now + _backoff_delay(failures),
+            "last_error": str(err) if err is not None else None,
+        })
+
+
+def notify_enqueued(coalesce=False):
+    """Wake the outbox loop after rows were committed to attendance_sessions_outbox.
+
+    With coalesce=True (per-student marks) the loop waits up to
+    OUTBOX_COALESCE_MS from the first such call so a burst of marks goes out
+    in one window; a plain call sends immediately.
+    """
+    if coalesce and COALESCE_SECONDS > 0:
+        with _breaker_lock:
+            if _coalesce["deadline"] is None:
+                _coalesce["deadline"] = time.time() + COALESCE_SECONDS
+    else:
+        with _breaker_lock:
+            _coalesce["deadline"] = None
+    _wake.set()
+
+
+def notify_online():
+    """Connectivity restored: close the breaker's wait and wake the outbox loop."""
+    with _breaker_lock:
+        if _breaker["state"] != "closed":
+            _breaker["retry_at"] = time.time()
+    _wake.set()
+
+
+def notify_offline():
+    """Connectivity lost: open the breaker so the loop stops retrying until notified."""
+    with _breaker_lock:
+        if _breaker["state"] == "closed":
+            _breaker.update({
+                "state": "open",
+                "opened_at": time.time(),
+                # still probe now and then in case the connectivity check itself is wrong
+                "retry_at": time.time() + BACKOFF_MAX,
+                "last_error": "offline",
+            })
+
+# one processor at a time (background loop vs. the manual /sync/outbox/process endpoint)
+_process_lock = threading.Lock()
+
+
+def _sanitize(s: str) -> str:
+    if not s:
+        return ""
+    return "".join(c for c in s.replace(" ", "_") if (c.isalnum() or c in "-__")).strip("_")
+
+
+def session_doc_id(local_session_id, class_id, date_field, class_row):
+    """Deterministic session document id: subjectName, section, gradeLevel + date.
+
+    The only place this id is computed; attendance_sessions.fs_doc_id stores
+    the result when a session starts. class_row is state.get_class_meta().
+    """
+    try:
+        class_part = None
+        if class_row:
+            subject, grade, section, cname = class_row
+            parts = []
+            if subject:
+                parts.append(str(subject))
+            if section:
+                parts.append(str(section))
+            if grade:
+                parts.append(str(grade))
+            class_part = "_".join(parts) if parts else (cname or None)
+
+        date_part = (str(date_field).split("T")[0]) if date_field else time.strftime("%Y-%m-%d")
+        if class_part:
+            class_part = _sanitize(class_part)[:120]
+        else:
+            class_part = _sanitize(str(class_id))[:120]
+        return f"{class_part}_{date_part}"
+    except Exception:
+        # fallback to numeric local session id if anything goes wrong
+        return str(local_session_id)
+
+
+# Outbox operation types:
+#   session_attendance   every attendance_entries row of local_session_id ->
+#                        students/{id}/attendance/{session doc}
+#   student_attendance   one student's attendance doc; payload {student_id, doc}
+#   session_upsert       attendance_sessions/{session doc}; payload {doc, merge}
+#   session_history_add  session_history/{doc_id}; payload {doc_id, doc}
+#   session_present_add  add one student to the session doc's studentsPresent;
+#                        payload {student_id}. All such rows of a session in
+#                        one window become a single ArrayUnion update.
+# The session doc id is resolved from local_session_id when the row is sent.
+OP_TYPES = ("session_attendance", "student_attendance", "session_upsert", "session_history_add", "session_present_add")
+
+
+def enqueue_op(conn, op_type, local_session_id, payload=None, now=None):
+    """Insert a typed outbox row using the caller's (writer) connection.
+
+    The table must already exist (state.ensure_schema(_ensure_outbox_table);
+    session._ensure_attendance_table does it). Call notify_enqueued() after
+    the surrounding write committed.
+    """
+    if op_type not in OP_TYPES:
+        raise ValueError(f"unknown outbox op_type: {op_type}")
+    # ops of one session are sent in order: wait out an earlier op's backoff
+    due = conn.execute(
+        "SELECT MAX(next_attempt_at) FROM attendance_sessions_outbox WHERE local_session_id = ? AND status = 'queued'",
+        (local_session_id,),
+    ).fetchone()[0]
+    cur = conn.execute(
+        "INSERT INTO attendance_sessions_outbox (local_session_id, queued_at, status, attempts, op_type, payload, next_attempt_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            local_session_id,
+            now or time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "queued",
+            0,
+            op_type,
+            json.dumps(payload) if payload is not None else None,
+            due or 0,
+        ),
+    )
+    return cur.lastrowid
+
+
+def session_doc_id_for(conn, local_session_id):
+    """Resolve the Firestore session doc id for a local attendance_sessions row."""
+    row = conn.execute(
+        "SELECT fs_doc_id, class_id, date FROM attendance_sessions WHERE id = ?", (local_session_id,)
+    ).fetchone()
+    if not row:
+        return None
+    if row[0]:
+        return row[0]
+    return session_doc_id(local_session_id, row[1], row[2], state.get_class_meta(row[1], conn))
+
+
+def _release_stale_claims(conn):
+    # rows left in 'sending' by an interrupted run go back to the queue
+    conn.execute("UPDATE attendance_sessions_outbox SET status = 'queued' WHERE status = 'sending'")
+
+
+def _claim_window(conn, after_rowid, limit, now):
+    rows = conn.execute(
+        """
+        UPDATE attendance_sessions_outbox SET status = 'sending'
+        WHERE rowid IN (
+            SELECT rowid FROM attendance_sessions_outbox
+            WHERE rowid > ? AND status = 'queued' AND next_attempt_at <= ?
+            ORDER BY rowid ASC LIMIT ?
+        )
+        RETURNING rowid, local_session_id, attempts, COALESCE(op_type, 'session_attendance'), payload
+        """,
+        (after_rowid, now, limit),
+    ).fetchall()
+    return sorted(rows)
+
+
+def _finish_window(conn, synced, retry, missing, released=(), error=None):
+    """Record the outcome of one window.
+
+    synced rows are done; retry rows get attempts + 1 and a jittered
+    next_attempt_at (or move to 'dead' after MAX_ATTEMPTS); rows without a
+    session are dead-lettered; released rows (connectivity failures) go back
+    to the queue untouched.
+    """
+    now = time.time()
+    conn.executemany(
+        "UPDATE attendance_sessions_outbox SET status = 'synced', attempts = attempts + 1, last_error = NULL, synced_at = ? WHERE rowid = ?",
+        [(now, i) for i in synced],
+    )
+    for outbox_id, attempts in retry:
+        attempts_new = (attempts or 0) + 1
+        status_new = "queued" if attempts_new < MAX_ATTEMPTS else "dead"
+        conn.execute(
+            "UPDATE attendance_sessions_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE rowid = ?",
+            (status_new, attempts_new, now + _backoff_delay(attempts_new), error, outbox_id),
+        )
+    conn.executemany(
+        "UPDATE attendance_sessions_outbox SET status = 'dead', attempts = attempts + 1, last_error = 'no_session_row' WHERE rowid = ?",
+        [(i,) for i in missing],
+    )
+    conn.executemany(
+        "UPDATE attendance_sessions_outbox SET status = 'queued' WHERE rowid = ?",
+        [(i,) for i in released],
+    )
+    # later ops of a retried row's session wait with it, so e.g. a delayed
+    # session_upsert set() cannot land after (and wipe) later present adds
+    for outbox_id, _attempts in retry:
+        conn.execute(
+            """
+            UPDATE attendance_sessions_outbox SET next_attempt_at = (
+                SELECT next_attempt_at FROM attendance_sessions_outbox WHERE rowid = :id
+            )
+            WHERE local_session_id = (SELECT local_session_id FROM attendance_sessions_outbox WHERE rowid = :id)
+              AND rowid > :id AND status = 'queued'
+              AND next_attempt_at < (SELECT next_attempt_at FROM attendance_sessions_outbox WHERE rowid = :id)
+            """,
+            {"id": outbox_id},
+        )
+
+
+def _load_window(conn, session_ids, entry_session_ids):
+    """Load sessions and the entries of entry_session_ids for a window in two
+    queries; rows from before fs_doc_id was stored use the class cache."""
+    ids_json = json.dumps(sorted(set(i for i in session_ids if i is not None)))
+    entry_ids_json = json.dumps(sorted(set(i for i in entry_session_ids if i is not None)))
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT id, class_id, teacher_id, date, roomId, timeEnded, fs_doc_id
+        FROM attendance_sessions
+        WHERE id IN (SELECT value FROM json_each(?))
+        """,
+        (ids_json,),
+    )
+    sessions = {}
+    for r in cur.fetchall():
+        doc_id = r[6] or session_doc_id(r[0], r[1], r[3], state.get_class_meta(r[1], conn))
+        sessions[r[0]] = {
+            "class_id": r[1],
+            "teacher_id": r[2],
+            "date": r[3],
+            "roomId": r[4],
+            "timeEnded": r[5],
+            "doc_id": doc_id,
+        }
+    cur.execute(
+        """
+        SELECT session_id, student_id, timeLogged, status
+        FROM attendance_entries
+        WHERE session_id IN (SELECT value FROM json_each(?))
+        ORDER BY session_id, id
+        """,
+        (entry_ids_json,),
+    )
+    entries = {}
+    for session_id, student_id, time_logged, status_val in cur.fetchall():
+        entries.setdefault(session_id, []).append((student_id, time_logged, status_val))
+    return sessions, entries
+
+
+def _array_union(db_fs, values):
+    # the fake client carries its own transform types
+    union = getattr(db_fs, "ArrayUnion", None)
+    if union is None:
+        from firebase_admin import firestore
+        union = firestore.ArrayUnion
+    return union(list(values))
+
+
+def _coalesce_present_adds(claimed):
+    """Fold the session_present_add rows of each session into its first row.
+
+    Returns (claimed, followers) where the leading row's payload lists every
+    student id of the window and followers maps the other row ids to it.
+    """
+    leaders = {}
+    student_ids = {}
+    followers = {}
+    for outbox_id, local_session_id, attempts, op_type, payload in claimed:
+        if op_type != "session_present_add":
+            continue
+        try:
+            student_id = json.loads(payload)["student_id"]
+        except Exception:
+            continue
+        if local_session_id in leaders:
+            followers[outbox_id] = leaders[local_session_id]
+        else:
+            leaders[local_session_id] = outbox_id
+            student_ids[outbox_id] = []
+        lead = leaders[local_session_id]
+        if student_id not in student_ids[lead]:
+            student_ids[lead].append(student_id)
+    out = []
+    for row in claimed:
+        if row[0] in followers:
+            continue
+        if row[0] in student_ids:
+            row = row[:4] + (json.dumps({"student_ids": student_ids[row[0]]}),)
+        out.append(row)
+    return out, followers
+
+
+def _op_writes(db_fs, op_type, sess, entries, payload):
+    """Return the (doc_ref, data, merge) writes for one outbox row."""
+    payload = json.loads(payload) if payload else {}
+    if op_type == "session_attendance":
+        writes = []
+        for student_id, time_logged, status_val in entries:
+            doc_ref = db_fs.collection("students").document(str(student_id)).collection("attendance").document(sess["doc_id"])
+            writes.append((doc_ref, {
+                "classId": sess["class_id"],
+                "teacherId": sess["teacher_id"],
+                "roomId": sess["roomId"],
+                "date": sess["date"],
+                "timeLogged": time_logged if time_logged else None,
+                "status": status_val,
+            }, False))
+        return writes
+    if op_type == "student_attendance":
+        doc_ref = db_fs.collection("students").document(str(payload["student_id"])).collection("attendance").document(sess["doc_id"])
+        return [(doc_ref, payload["doc"], False)]
+    if op_type == "session_upsert":
+        doc_ref = db_fs.collection("attendance_sessions").document(sess["doc_id"])
+        return [(doc_ref, payload["doc"], bool(payload.get("merge")))]
+    if op_type == "session_history_add":
+        doc_ref = db_fs.collection("session_history").document(payload["doc_id"])
+        return [(doc_ref, payload["doc"], False)]
+    if op_type == "session_present_add":
+        doc_ref = db_fs.collection("attendance_sessions").document(sess["doc_id"])
+        return [(doc_ref, {"studentsPresent": _array_union(db_fs, payload["student_ids"])}, True)]
+    raise ValueError(f"unknown outbox op_type: {op_type}")
+
+
+def _push_window(db_fs, claimed, sessions, entries, results):
+    """Pack per-student attendance docs from all sessions into full batches.
+
+    Returns (synced_ids, retry, missing_ids, released_ids, error). A row
+    counts as synced only when every batch holding one of its writes
+    committed. After a connectivity error no further batches are sent and
+    the unsynced rows are released without spending an attempt.
+    """
+    all_claimed = claimed
+    claimed, followers = _coalesce_present_adds(claimed)
+    missing = []
+    failed = set()
+    pending = {}  # outbox id -> number of its batches not yet committed
+    batch = None
+    batch_rows = set()
+    batch_count = 0
+    error = {"last": None, "connectivity": None}
+
+    def _commit(b, rows):
+        if error["connectivity"] is not None:
+            failed.update(rows)
+            return
+        try:
+            b.commit()
+            for oid in rows:
+                pending[oid] -= 1
+        except Exception as e:
+            print(f"Outbox batch commit failed ({len(rows)} sessions): {e}")
+            failed.update(rows)
+            error["last"] = str(e)
+            if _is_connectivity_error(e):
+                error["connectivity"] = e
+
+    for outbox_id, local_session_id, attempts, op_type, payload in claimed:
+        sess = sessions.get(local_session_id)
+        if not sess and op_type != "session_history_add":
+            missing.append(outbox_id)
+            results.append({"outbox_id": outbox_id, "status": "no_session_row"})
+            continue
+        try:
+            writes = _op_writes(db_fs, op_type, sess, entries.get(local_session_id, []), payload)
+        except Exception as e:
+            # malformed payload: retrying cannot help
+            missing.append(outbox_id)
+            results.append({"outbox_id": outbox_id, "status": "bad_payload", "error": str(e)})
+            continue
+        pending[outbox_id] = 0
+        for doc_ref, data, merge in writes:
+            if batch is None:
+                batch = db_fs.batch()
+                batch_rows = set()
+                batch_count = 0
+            if merge:
+                batch.set(doc_ref, data, merge=True)
+            else:
+                batch.set(doc_ref, data)
+            if outbox_id not in batch_rows:
+                batch_rows.add(outbox_id)
+                pending[outbox_id] += 1
+            batch_count += 1
+            if batch_count >= FIRESTORE_BATCH_LIMIT:
+                _commit(batch, batch_rows)
+                batch = None
+    if batch is not None and batch_count:
+        _commit(batch, batch_rows)
+
+    synced = []
+    retry = []
+    released = []
+    for outbox_id, local_session_id, attempts, op_type, payload in claimed:
+        if outbox_id not in pending:
+            continue
+        if outbox_id in failed or pending[outbox_id] > 0:
+            if error["connectivity"] is not None:
+                released.append(outbox_id)
+            else:
+                retry.append((outbox_id, attempts))
+            results.append({"outbox_id": outbox_id, "status": "error", "error": error["last"] or "batch_commit_failed"})
+        else:
+            synced.append(outbox_id)
+            sess = sessions.get(local_session_id)
+            results.append({"outbox_id": outbox_id, "status": "synced", "op_type": op_type, "session_doc_id": sess["doc_id"] if sess else None})
+
+    # coalesced rows share the outcome of the row that carried their update
+    outcome = {}
+    for i in synced:
+        outcome[i] = "synced"
+    for i, _a in retry:
+        outcome[i] = "retry"
+    for i in released:
+        outcome[i] = "released"
+    for i in missing:
+        outcome[i] = "missing"
+    for outbox_id, local_session_id, attempts, op_type, payload in all_claimed:
+        lead = followers.get(outbox_id)
+        if lead is None:
+            continue
+        res = outcome.get(lead)
+        if res == "synced":
+            synced.append(outbox_id)
+        elif res == "retry":
+            retry.append((outbox_id, attempts))
+        elif res == "missing":
+            missing.append(outbox_id)
+        else:
+            released.append(outbox_id)
+        results.append({"outbox_id": outbox_id, "status": "coalesced", "into": lead, "result": res})
+    return synced, retry, missing, released, error["connectivity"]
 
 
 def process_outbox_once():
     """Attempt to push queued attendance outbox entries to Firestore (best-effort).
 
-    Writes per-student attendance documents under /students/{studentId}/attendance/{sessionId}.
-    Marks outbox rows as 'synced' on success or increments attempts on failure.
+    Sends the typed operations in OP_TYPES (per-session and per-student
+    attendance docs, session documents, session_history entries).
+    Rows are claimed a window at a time; sessions, classes and entries for the
+    window are loaded with set-based queries and the writes of several
+    sessions share full Firestore batches. Rows are marked 'synced' only when
+    their batches committed; otherwise they are rescheduled with exponential
+    backoff and jitter, and dead-lettered after OUTBOX_MAX_ATTEMPTS. A
+    connectivity failure opens the circuit breaker and ends the run.
     """
     try:
         from . import sync
@@ -35,164 +603,173 @@ def process_outbox_once():
         sync = None
 
     db_fs = getattr(sync, "db_fs", None) if sync is not None else None
+    if not db_fs:
+        return [{"status": "no_firestore_client"}]
 
-    conn = state.get_db()
-    _ensure_outbox_table(conn)
-    cur = conn.cursor()
+    if not _breaker_allows():
+        return [{"status": "circuit_open", "retry_at": _breaker["retry_at"]}]
 
-    cur.execute(
-        "SELECT rowid as id, local_session_id, queued_at, status, attempts FROM attendance_sessions_outbox WHERE status = ? OR (status = ? AND attempts < ?) ORDER BY rowid ASC",
-        ("queued", "failed", 5),
-    )
-    rows = cur.fetchall()
+    state.ensure_schema(_ensure_outbox_table)
     results = []
-
-    for outbox in rows:
-        outbox_id, local_session_id, queued_at, status, attempts = outbox
-        try:
-            # load session metadata
-            s_cur = conn.cursor()
-            s_cur.execute(
-                "SELECT class_id, teacher_id, date, roomId, timeEnded FROM attendance_sessions WHERE id = ?",
-                (local_session_id,)
-            )
-            srow = s_cur.fetchone()
-
-            if not srow:
-                cur.execute(
-                    "UPDATE attendance_sessions_outbox SET status = ?, attempts = ? WHERE rowid = ?",
-                    ("failed", (attempts or 0) + 1, outbox_id),
-                )
-                conn.commit()
-                results.append({"outbox_id": outbox_id, "status": "no_session_row"})
-                continue
-
-            class_id, teacher_id, date_field, roomId, timeEnded = srow
-
-            # fetch attendance entries for this session
-            s_cur.execute(
-                "SELECT student_id, timeLogged, status FROM attendance_entries WHERE session_id = ?",
-                (local_session_id,)
-            )
-            entries = s_cur.fetchall()
-
-            if not db_fs:
-                cur.execute(
-                    "UPDATE attendance_sessions_outbox SET status = ?, attempts = ? WHERE rowid = ?",
-                    ("failed", (attempts or 0) + 1, outbox_id),
-                )
-                conn.commit()
-                results.append({"outbox_id": outbox_id, "status": "no_firestore_client"})
-                continue
-
-            # write per-student docs under /students/{studentId}/attendance/{sessionId}
-            batch = db_fs.batch()
-            batch_count = 0
-
-            def commit_batch(b):
+    handled = 0
+    with _process_lock:
+        started = time.perf_counter()
+        state.run_write(_release_stale_claims)
+        last_rowid = 0
+        while True:
+            claimed = state.run_write(_claim_window, last_rowid, OUTBOX_WINDOW, time.time())
+            if not claimed:
+                break
+            last_rowid = claimed[-1][0]
+            handled += len(claimed)
+            synced, retry, missing, released, conn_err = [], [], [], [], None
+            error = None
+            try:
+                conn = state.get_read_db()
                 try:
-                    b.commit()
-                except Exception:
-                    pass
+                    sessions, entries = _load_window(
+                        conn,
+                        [c[1] for c in claimed],
+                        [c[1] for c in claimed if c[3] == "session_attendance"],
+                    )
+                finally:
+                    conn.close()
+                synced, retry, missing, released, conn_err = _push_window(db_fs, claimed, sessions, entries, results)
+                if retry:
+                    error = next((r.get("error") for r in reversed(results) if r.get("status") == "error"), None)
+            except Exception as e:
+                error = str(e)
+                retry = [(c[0], c[2]) for c in claimed]
+                results.extend({"outbox_id": c[0], "status": "error", "error": error} for c in claimed)
+            state.run_write(_finish_window, synced, retry, missing, released, error)
+            if conn_err is not None:
+                _breaker_trip(conn_err)
+                break
+            if synced:
+                _breaker_success()
+            if len(claimed) < OUTBOX_WINDOW:
+                break
+        if _breaker["state"] == "half_open":
+            # the probe run did not hit a connectivity error
+            _breaker_success()
+        metrics.OUTBOX_DRAIN_SECONDS.observe(time.perf_counter() - started)
+        metrics.OUTBOX_DRAIN_ROWS.observe(handled)
+    return results
 
-            # Build a deterministic session document id using class metadata: subjectName, gradeLevel, section + date
-            def _sanitize(s: str) -> str:
-                if not s:
-                    return ""
-                return "".join(c for c in s.replace(" ", "_") if (c.isalnum() or c in "-__")).strip("_")
 
-            session_doc_id = None
-            try:
-                # attempt to read class metadata from local DB
-                ccur = conn.cursor()
-                ccur.execute("SELECT subjectName, gradeLevel, section, name FROM classes WHERE id = ?", (class_id,))
-                rclass = ccur.fetchone()
-                class_part = None
-                if rclass:
-                    subject, grade, section, cname = rclass[0], rclass[1], rclass[2], rclass[3]
-                    parts = []
-                    if subject:
-                        parts.append(str(subject))
-                    if section:
-                        parts.append(str(section))
-                    if grade:
-                        parts.append(str(grade))
-                    class_part = "_".join(parts) if parts else (cname or None)
-
-                date_part = (str(date_field).split("T")[0]) if date_field else time.strftime("%Y-%m-%d")
-                if class_part:
-                    class_part = _sanitize(class_part)[:120]
-                else:
-                    class_part = _sanitize(str(class_id))[:120]
-
-                session_doc_id = f"{class_part}_{date_part}"
-            except Exception:
-                # fallback to numeric local session id if anything goes wrong
-                session_doc_id = str(local_session_id)
-
-            time_logged_default = timeEnded or time.strftime("%Y-%m-%dT%H:%M:%S%z")
-
-            for student_id, timeLogged, status_val in entries:
-                doc_ref = db_fs.collection("students").document(str(student_id)).collection("attendance").document(session_doc_id)
-                doc = {
-                    "classId": class_id,
-                    "teacherId": teacher_id,
-                    "roomId": roomId,
-                    "date": date_field,
-                    "timeLogged": timeLogged if timeLogged else None,
-                    "status": status_val,
-                }
-                batch.set(doc_ref, doc)
-                batch_count += 1
-                if batch_count >= 400:
-                    commit_batch(batch)
-                    batch = db_fs.batch()
-                    batch_count = 0
-
-            if batch_count > 0:
-                commit_batch(batch)
-
-            # attempt to also write the full session document under _attendance_sessions (best-effort)
-                # NOTE: full session document push is handled by the session.stop endpoint
-                # to avoid duplicate session documents in Firestore. Outbox only writes
-                # per-student attendance documents under each student's attendance subcollection.
-
-            # mark outbox as synced
-            cur.execute(
-                "UPDATE attendance_sessions_outbox SET status = ?, attempts = ? WHERE rowid = ?",
-                ("synced", (attempts or 0) + 1, outbox_id),
-            )
-            conn.commit()
-            results.append({"outbox_id": outbox_id, "status": "synced", "session_doc_id": session_doc_id})
+def _prune_synced(conn, cutoff):
+    return conn.execute(
+        """
+        DELETE FROM attendance_sessions_outbox WHERE rowid IN (
+            SELECT rowid FROM attendance_sessions_outbox
+            WHERE status = 'synced' AND synced_at < ?
+            LIMIT ?
+        )
+        """,
+        (cutoff, RETENTION_CHUNK),
+    ).rowcount
+
+
+def run_retention():
+    """Delete rows synced more than SYNCED_RETENTION_DAYS ago; returns the count removed."""
+    removed = 0
+    if SYNCED_RETENTION_DAYS > 0:
+        state.ensure_schema(_ensure_outbox_table)
+        cutoff = time.time() - SYNCED_RETENTION_DAYS * 86400.0
+        while True:
+            n = state.run_write(_prune_synced, cutoff)
+            removed += n
+            if n < RETENTION_CHUNK:
+                break
+    _retention["last_run"] = time.time()
+    _retention["removed"] += removed
+    return removed
+
+
+def _backlog_by_status():
+    conn = state.get_read_db()
+    try:
+        rows = conn.execute("SELECT status, COUNT(*) FROM attendance_sessions_outbox GROUP BY status").fetchall()
+    finally:
+        conn.close()
+    return {(r[0],): r[1] for r in rows}
 
-        except Exception as e:
-            attempts_new = (attempts or 0) + 1
-            status_new = "queued" if attempts_new < 5 else "failed"
-            try:
-                cur.execute(
-                    "UPDATE attendance_sessions_outbox SET status = ?, attempts = ? WHERE rowid = ?",
-                    (status_new, attempts_new, outbox_id),
-                )
-                conn.commit()
-            except Exception:
-                pass
-            results.append({"outbox_id": outbox_id, "status": "error", "error": str(e)})
-
-    conn.close()
-    return results
+
+OUTBOX_BACKLOG = metrics.Gauge(
+    "kiosk_outbox_rows",
+    "Outbox rows by status, read at scrape time.",
+    ("status",),
+    fn=_backlog_by_status,
+)
+
+
+def _next_wait():
+    """Seconds to sleep before the next run, or None to sleep until woken.
+
+    While the breaker is open this is the time to the next probe; otherwise
+    the time until the earliest queued row is due. An empty queue waits for
+    notify_enqueued().
+    """
+    now = time.time()
+    with _breaker_lock:
+        if _breaker["state"] == "open" and _breaker["retry_at"] is not None:
+            return max(0.5, _breaker["retry_at"] - now)
+    try:
+        conn = state.get_read_db()
+        try:
+            row = conn.execute(
+                "SELECT MIN(next_attempt_at) FROM attendance_sessions_outbox WHERE status = 'queued'"
+            ).fetchone()
+        finally:
+            conn.close()
+    except Exception:
+        return OUTBOX_POLL_SECONDS
+    if row and row[0] is not None:
+        return max(0.0, row[0] - now)
+    return None
 
 
 def _loop_worker():
     while True:
+        res = None
+        failed = False
         try:
-            process_outbox_once()
+            res = process_outbox_once()
+        except Exception as e:
+            print("outbox worker pass failed:", e)
+            failed = True
+        if RETENTION_INTERVAL > 0 and time.time() - _retention["last_run"] >= RETENTION_INTERVAL:
+            try:
+                run_retention()
+            except Exception as e:
+                print("outbox retention failed:", e)
+                _retention["last_run"] = time.time()
+        try:
+            wait = _next_wait()
         except Exception:
-            pass
-        time.sleep(10)
+            wait = OUTBOX_POLL_SECONDS
+        if failed or (res and res[0].get("status") == "no_firestore_client"):
+            # nothing can be pushed; do not spin on due rows
+            wait = OUTBOX_POLL_SECONDS
+        elif not res and wait is not None and wait <= 0:
+            # rows are due but the pass claimed none of them
+            wait = OUTBOX_POLL_SECONDS
+        if wait is None or wait > 0:
+            _wake.wait(wait)
+        _wake.clear()
+        # let a burst of marks accumulate before draining
+        while True:
+            with _breaker_lock:
+                deadline = _coalesce["deadline"]
+            if deadline is None or time.time() >= deadline:
+                break
+            time.sleep(min(0.05, max(0.0, deadline - time.time())))
+        with _breaker_lock:
+            _coalesce["deadline"] = None
 
 
 try:
-    t = threading.Thread(target=_loop_worker, daemon=True)
+    t = threading.Thread(target=_loop_worker, name="outbox-worker", daemon=True)
     t.start()
 except Exception:
     pass
@@ -201,49 +778,47 @@ except Exception:
 @router.get("/sync/outbox/status")
 def outbox_status():
     try:
-        conn = state.get_db()
-        _ensure_outbox_table(conn)
+        state.ensure_schema(_ensure_outbox_table)
+        conn = state.get_read_db()
         cur = conn.cursor()
         # use rowid as id for compatibility
         cur.execute(
-            "SELECT rowid as id, local_session_id, queued_at, status, attempts FROM attendance_sessions_outbox ORDER BY rowid DESC LIMIT 50"
+            "SELECT rowid as id, local_session_id, queued_at, status, attempts, next_attempt_at, last_error, op_type FROM attendance_sessions_outbox ORDER BY rowid DESC LIMIT 50"
         )
         rows = cur.fetchall()
         conn.close()
         items = []
         for r in rows:
-            items.append({"id": r[0], "local_session_id": r[1], "queued_at": r[2], "status": r[3], "attempts": r[4]})
+            items.append({"id": r[0], "local_session_id": r[1], "queued_at": r[2], "status": r[3], "attempts": r[4], "next_attempt_at": r[5], "last_error": r[6], "op_type": r[7]})
         # add a brief summary counts for UI
+        # ('failed' is migrated to 'queued'/'dead' by _ensure_outbox_table)
         try:
-            conn2 = state.get_db()
-            cur2 = conn2.cursor()
-            cur2.execute("SELECT COUNT(*) FROM attendance_sessions_outbox")
-            total = cur2.fetchone()[0]
-            cur2.execute("SELECT COUNT(*) FROM attendance_sessions_outbox WHERE status = ?", ("queued",))
-            queued = cur2.fetchone()[0]
-            cur2.execute("SELECT COUNT(*) FROM attendance_sessions_outbox WHERE status = ?", ("failed",))
-            failed = cur2.fetchone()[0]
-            cur2.execute("SELECT COUNT(*) FROM attendance_sessions_outbox WHERE status = ?", ("synced",))
-            synced = cur2.fetchone()[0]
-            conn2.close()
+            counts = {k[0]: v for k, v in _backlog_by_status().items()}
         except Exception:
-            total = queued = failed = synced = 0
+            counts = {}
+        total = sum(counts.values())
+        queued = counts.get("queued", 0)
+        synced = counts.get("synced", 0)
+        dead = counts.get("dead", 0)
 
         summary = {
             "total": total,
             "queued": queued,
-            "failed": failed,
+            "sending": counts.get("sending", 0),
             "synced": synced,
+            "dead": dead,
         }
 
         # If nothing to show, include a friendly message
         message = None
         if total == 0:
             message = "no_outbox_records"
-        elif queued == 0 and failed == 0 and synced == 0:
+        elif queued == 0 and dead == 0 and synced == 0:
             message = "no_pending_or_synced_records"
 
-        return {"outbox": items, "summary": summary, "message": message}
+        with _breaker_lock:
+            breaker = dict(_breaker)
+        return {"outbox": items, "summary": summary, "message": message, "breaker": breaker}
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
@@ -256,3 +831,52 @@ def trigger_outbox_process():
         return {"processed": res}
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
+
+
+@router.get("/sync/outbox/dead")
+def outbox_dead_letters(limit: int = 100):
+    """List dead-lettered outbox rows (gave up after OUTBOX_MAX_ATTEMPTS or no session row)."""
+    try:
+        state.ensure_schema(_ensure_outbox_table)
+        conn = state.get_read_db()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT rowid, local_session_id, queued_at, attempts, last_error FROM attendance_sessions_outbox WHERE status = 'dead' ORDER BY rowid DESC LIMIT ?",
+            (limit,),
+        )
+        rows = cur.fetchall()
+        conn.close()
+        items = [{"id": r[0], "local_session_id": r[1], "queued_at": r[2], "attempts": r[3], "last_error": r[4]} for r in rows]
+        return {"dead": items}
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+
+def _requeue_dead(conn, ids):
+    if ids:
+        cur = conn.executemany(
+            "UPDATE attendance_sessions_outbox SET status = 'queued', attempts = 0, next_attempt_at = 0, last_error = NULL WHERE rowid = ? AND status = 'dead'",
+            [(i,) for i in ids],
+        )
+    else:
+        cur = conn.execute(
+            "UPDATE attendance_sessions_outbox SET status = 'queued', attempts = 0, next_attempt_at = 0, last_error = NULL WHERE status = 'dead'"
+        )
+    return cur.rowcount
+
+
+@router.post("/sync/outbox/retry")
+async def retry_dead_letters(request: Request):
+    """Re-queue dead-lettered rows. Body: {ids: [..]} (optional; all dead rows when omitted)."""
+    try:
+        try:
+            body = await request.json()
+        except Exception:
+            body = {}
+        ids = (body or {}).get("ids") or []
+        state.ensure_schema(_ensure_outbox_table)
+        requeued = state.run_write(_requeue_dead, [int(i) for i in ids])
+        notify_online()
+        return {"requeued": requeued}
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
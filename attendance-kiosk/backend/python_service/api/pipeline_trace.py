@@ -0,0 +1,188 @@
+"""Per-frame trace records for the capture -> infer pipeline.
+
+Every captured frame carries a small dict of time.perf_counter() stamps
+through the queues:
+
+  capture   frame returned by the camera
+  enqueue   frame handed to the encode/infer queues
+  dequeue   infer thread picked it up
+  detect    face detector done
+  embed     per-face models (embedding) done
+  match     teacher and student matching done (incl. the teacher DB lookup)
+  published recognition caches updated
+  polled    first UI poll that read the published result
+
+DB lookups done while handling the frame are kept as (start, end) spans.
+Published records go into a ring of the last PIPELINE_TRACE_SIZE frames
+served at GET /debug/pipeline (percentiles per segment) and
+GET /debug/pipeline?format=chrome (Chrome trace-event JSON for
+chrome://tracing or Perfetto).
+"""
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from collections import deque
+import itertools
+import os
+import threading
+import time
+
+router = APIRouter()
+
+try:
+    TRACE_SIZE = max(1, int(os.environ.get("PIPELINE_TRACE_SIZE", "300")))
+except Exception:
+    TRACE_SIZE = 300
+
+STAGES = ("capture", "enqueue", "dequeue", "detect", "embed", "match", "published", "polled")
+# (name, from stamp, to stamp, chrome trace thread)
+SEGMENTS = (
+    ("queue_put", "capture", "enqueue", "capture"),
+    ("queue_wait", "enqueue", "dequeue", "queue"),
+    ("detect", "dequeue", "detect", "infer"),
+    ("embed", "detect", "embed", "infer"),
+    ("match", "embed", "match", "infer"),
+    ("publish", "match", "published", "infer"),
+    ("poll_wait", "published", "polled", "ui"),
+)
+_TIDS = {"capture": 1, "queue": 2, "infer": 3, "ui": 4}
+
+# perf_counter() -> unix time, for exported timestamps
+_EPOCH_OFFSET = time.time() - time.perf_counter()
+
+_ring = deque(maxlen=TRACE_SIZE)
+_ring_lock = threading.Lock()
+_seq = itertools.count(1)
+
+
+def start():
+    """Return a new trace stamped with the capture time."""
+    return {"seq": next(_seq), "capture": time.perf_counter()}
+
+
+def mark(trace, stage):
+    if trace is not None:
+        trace[stage] = time.perf_counter()
+
+
+def add_lookup(trace, began):
+    """Record a DB lookup span that started at perf_counter() value began."""
+    if trace is not None:
+        trace.setdefault("lookups", []).append((began, time.perf_counter()))
+
+
+def publish(trace, outcome=None, faces=0):
+    """Stamp the trace as published and keep it in the ring."""
+    if trace is None:
+        return
+    trace["published"] = time.perf_counter()
+    trace["outcome"] = outcome
+    trace["faces"] = faces
+    with _ring_lock:
+        _ring.append(trace)
+
+
+def note_poll():
+    """Stamp the latest published frame with the first UI poll that saw it."""
+    try:
+        trace = _ring[-1]
+    except IndexError:
+        return
+    if "polled" not in trace:
+        trace["polled"] = time.perf_counter()
+
+
+def _percentile(sorted_vals, pct):
+    if not sorted_vals:
+        return None
+    idx = min(len(sorted_vals) - 1, max(0, int(round(pct / 100.0 * (len(sorted_vals) - 1)))))
+    return sorted_vals[idx]
+
+
+def _summary_of(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50_ms": round(_percentile(values, 50) * 1000.0, 3),
+        "p90_ms": round(_percentile(values, 90) * 1000.0, 3),
+        "p99_ms": round(_percentile(values, 99) * 1000.0, 3),
+        "max_ms": round(values[-1] * 1000.0, 3),
+    }
+
+
+def summarize(records):
+    segs = {name: [] for name, _a, _b, _t in SEGMENTS}
+    segs["lookup"] = []
+    segs["total"] = []
+    outcomes = {}
+    for r in records:
+        for name, a, b, _tid in SEGMENTS:
+            if a in r and b in r:
+                segs[name].append(r[b] - r[a])
+        if r.get("lookups"):
+            segs["lookup"].append(sum(e - s for s, e in r["lookups"]))
+        segs["total"].append(r["published"] - r["capture"])
+        key = r.get("outcome") or "none"
+        outcomes[key] = outcomes.get(key, 0) + 1
+    return {"frames": len(records), "outcomes": outcomes, "segments": {k: _summary_of(v) for k, v in segs.items()}}
+
+
+def _us(t):
+    return int((t + _EPOCH_OFFSET) * 1e6)
+
+
+def chrome_trace(records):
+    """Chrome trace-event JSON (complete 'X' events, one row per pipeline thread)."""
+    events = [
+        {"ph": "M", "name": "thread_name", "pid": 1, "tid": tid, "args": {"name": name}}
+        for name, tid in _TIDS.items()
+    ]
+    for r in records:
+        args = {"seq": r["seq"], "outcome": r.get("outcome"), "faces": r.get("faces")}
+        for name, a, b, thread in SEGMENTS:
+            if a in r and b in r:
+                events.append({
+                    "name": name, "ph": "X", "pid": 1, "tid": _TIDS[thread],
+                    "ts": _us(r[a]), "dur": max(0, _us(r[b]) - _us(r[a])), "args": args,
+                })
+        for s, e in r.get("lookups") or ():
+            events.append({
+                "name": "db_lookup", "ph": "X", "pid": 1, "tid": _TIDS["infer"],
+                "ts": _us(s), "dur": max(0, _us(e) - _us(s)), "args": args,
+            })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def snapshot(last=None):
+    with _ring_lock:
+        records = [dict(r) for r in _ring]
+    if last:
+        records = records[-last:]
+    return records
+
+
+@router.get("/debug/pipeline")
+def debug_pipeline(format: str = "summary", last: int = 0):
+    """Percentile summary of recent frames; format=chrome exports trace events,
+    format=raw returns the records (stamps in ms relative to capture)."""
+    try:
+        records = snapshot(last if last and last > 0 else None)
+        if format == "chrome":
+            return chrome_trace(records)
+        if format == "raw":
+            out = []
+            for r in records:
+                base = r["capture"]
+                item = {k: round((r[k] - base) * 1000.0, 3) for k in STAGES if k in r}
+                item.update({"seq": r["seq"], "outcome": r.get("outcome"), "faces": r.get("faces"),
+                             "captured_at": round(base + _EPOCH_OFFSET, 3)})
+                if r.get("lookups"):
+                    item["lookups_ms"] = [round((e - s) * 1000.0, 3) for s, e in r["lookups"]]
+                out.append(item)
+            return {"size": TRACE_SIZE, "records": out}
+        res = summarize(records)
+        res["size"] = TRACE_SIZE
+        return res
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
@@ -0,0 +1,106 @@
+"""On-demand sampling profiler.
+
+GET /debug/profile?seconds=N&rate=HZ samples the Python stacks of every
+thread (sys._current_frames) for N seconds and returns collapsed-stack
+text ("thread;outer;...;inner count" per line), ready for flamegraph.pl,
+speedscope or inferno. Nothing runs between requests, so it costs nothing
+while unused.
+
+The endpoint is disabled unless DEBUG_PROFILE_TOKEN is set; callers pass
+the token in the X-Debug-Token header or the token query parameter.
+"""
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+import hmac
+import os
+import sys
+import threading
+import time
+
+router = APIRouter()
+
+PROFILE_TOKEN = os.environ.get("DEBUG_PROFILE_TOKEN") or None
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except Exception:
+        return float(default)
+
+
+DEFAULT_RATE_HZ = _env_float("PROFILE_RATE_HZ", "100")
+MAX_SECONDS = _env_float("PROFILE_MAX_SECONDS", "60")
+MAX_RATE_HZ = 1000.0
+
+# one profile at a time; a second request gets 409
+_busy = threading.Lock()
+
+
+def _authorized(request):
+    if not PROFILE_TOKEN:
+        return False
+    supplied = request.headers.get("x-debug-token") or request.query_params.get("token") or ""
+    return hmac.compare_digest(supplied.encode(), PROFILE_TOKEN.encode())
+
+
+def _label(code, cache):
+    label = cache.get(code)
+    if label is None:
+        label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+        cache[code] = label
+    return label
+
+
+def sample(seconds, rate):
+    """Sample all thread stacks; returns ({collapsed stack: count}, samples taken)."""
+    interval = 1.0 / rate
+    own = threading.get_ident()
+    counts = {}
+    labels = {}
+    names = {}
+    taken = 0
+    deadline = time.perf_counter() + seconds
+    next_at = time.perf_counter()
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            break
+        if now < next_at:
+            time.sleep(next_at - now)
+        next_at += interval
+        frames = sys._current_frames()
+        if len(names) != len(frames) or any(tid not in names for tid in frames):
+            names = {t.ident: t.name for t in threading.enumerate()}
+        for tid, frame in frames.items():
+            if tid == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_label(frame.f_code, labels))
+                frame = frame.f_back
+            stack.append(names.get(tid, f"thread-{tid}").replace(";", ":").replace(" ", "_"))
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        taken += 1
+    return counts, taken
+
+
+@router.get("/debug/profile")
+def debug_profile(request: Request, seconds: float = 10.0, rate: float = 0.0):
+    if not _authorized(request):
+        # do not reveal whether the profiler is enabled
+        return JSONResponse(content={"error": "not_found"}, status_code=404)
+    seconds = min(max(0.1, seconds), MAX_SECONDS)
+    rate = min(max(1.0, rate or DEFAULT_RATE_HZ), MAX_RATE_HZ)
+    if not _busy.acquire(blocking=False):
+        return JSONResponse(content={"error": "profile_in_progress"}, status_code=409)
+    try:
+        counts, taken = sample(seconds, rate)
+    finally:
+        _busy.release()
+    body = "\n".join(f"{stack} {n}" for stack, n in sorted(counts.items()))
+    return PlainTextResponse(
+        body + "\n" if body else "",
+        headers={"X-Profile-Samples": str(taken), "X-Profile-Rate": str(rate), "X-Profile-Seconds": str(seconds)},
+    )
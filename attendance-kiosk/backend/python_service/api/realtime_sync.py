@@ -0,0 +1,313 @@
+"""Real-time Firestore sync engine built on on_snapshot listeners.
+
+Enabled with SYNC_MODE=listen (see sync.start_partial_background_sync).
+
+- one listener per collection (students, teachers, classes, kiosks, rooms)
+  pushes document changes into a coalescing map keyed by (collection, doc id)
+- a single writer thread drains that map every LISTEN_COALESCE_MS and applies
+  the latest state of each document as one command on the database writer
+  (state.run_write), using the same upsert helpers as the polling sync
+- a supervisor restarts dead listeners with exponential backoff + jitter and
+  runs a periodic full reconciliation (deletes missed while disconnected)
+- the updatedAt cursors in sync_cursors are advanced as changes are applied;
+  on restart the large collections resume from that checkpoint instead of
+  re-reading every document. kiosks and rooms are always listened to in full
+  so room reassignments never depend on updatedAt being bumped.
+"""
+from fastapi import APIRouter
+import os
+import random
+import threading
+import time
+
+from . import state
+from . import sync
+
+router = APIRouter()
+
+LISTEN_COLLECTIONS = ('teachers', 'classes', 'students', 'kiosks', 'rooms')
+# collections small enough (and latency-sensitive enough) to always listen in full
+_ALWAYS_FULL = ('kiosks', 'rooms')
+# apply order inside one writer transaction
+_APPLY_ORDER = ('teachers', 'classes', 'students', 'kiosks', 'rooms')
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except Exception:
+        return float(default)
+
+
+COALESCE_SECONDS = _env_float('LISTEN_COALESCE_MS', '200') / 1000.0
+BACKOFF_BASE = _env_float('LISTEN_BACKOFF_BASE', '1')
+BACKOFF_MAX = _env_float('LISTEN_BACKOFF_MAX', '60')
+RECONCILE_INTERVAL = _env_float('LISTEN_RECONCILE_INTERVAL', '1800')
+
+# (collection, doc_id) -> dict of the latest document data, or None for a delete
+_pending = {}
+_pending_lock = threading.Lock()
+_pending_event = threading.Event()
+
+# collection -> listener bookkeeping
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+_started = False
+_writer_thread = None
+_supervisor_thread = None
+
+status = {
+    "mode": "listen",
+    "applied": 0,
+    "last_applied_at": None,
+    "last_error": None,
+    "reconciled_at": None,
+}
+
+
+def _make_callback(name):
+    def _on_snapshot(docs, changes, read_time):
+        try:
+            with _pending_lock:
+                for ch in changes:
+                    doc = ch.document
+                    kind = getattr(getattr(ch, 'type', None), 'name', str(getattr(ch, 'type', '')))
+                    if kind == 'REMOVED':
+                        _pending[(name, doc.id)] = None
+                    else:
+                        _pending[(name, doc.id)] = doc.to_dict() or {}
+            with _listeners_lock:
+                info = _listeners.get(name)
+                if info is not None:
+                    info["last_event_at"] = time.time()
+                    info["read_time"] = str(read_time) if read_time is not None else None
+                    # a delivered snapshot means the stream is healthy again
+                    info["failures"] = 0
+            if changes:
+                _pending_event.set()
+        except Exception as e:
+            status["last_error"] = f"{name}: {e}"
+    return _on_snapshot
+
+
+def _query_for(name):
+    ref = sync.db_fs.collection(name)
+    cursor = sync._partial_last_update.get(name)
+    if name not in _ALWAYS_FULL and cursor is not None:
+        return ref.where('updatedAt', '>', cursor), True
+    return ref, False
+
+
+def _subscribe(name):
+    query, resumed = _query_for(name)
+    watch = query.on_snapshot(_make_callback(name))
+    with _listeners_lock:
+        info = _listeners.setdefault(name, {"failures": 0})
+        info.update({
+            "watch": watch,
+            "resumed": resumed,
+            "subscribed_at": time.time(),
+            "next_attempt_at": None,
+        })
+    return watch
+
+
+def _watch_alive(watch):
+    if watch is None:
+        return False
+    try:
+        if getattr(watch, '_closed', False):
+            return False
+        active = getattr(watch, 'is_active', None)
+        if active is not None and not callable(active):
+            return bool(active)
+    except Exception:
+        return False
+    return True
+
+
+def _backoff_delay(failures):
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** max(0, failures - 1)))
+    # full jitter keeps a fleet of kiosks from reconnecting in lockstep
+    return random.uniform(delay / 2.0, delay)
+
+
+def _apply_batch(conn, batch, regen):
+    cur = conn.cursor()
+    applied = 0
+    touched = set()
+    for name in _APPLY_ORDER:
+        table, id_col, apply_fn, delete_fn = sync._PARTIAL_HANDLERS[name]
+        deletes = []
+        for (coll, doc_id), data in batch.items():
+            if coll != name:
+                continue
+            if data is None:
+                deletes.append(doc_id)
+                continue
+            try:
+                apply_fn(cur, doc_id, data, regen)
+                applied += 1
+            except Exception as e:
+                status["last_error"] = f"{name}/{doc_id}: {e}"
+                continue
+            new_cursor = sync._advance_cursor(sync._partial_last_update.get(name), data.get('updatedAt'))
+            if new_cursor != sync._partial_last_update.get(name):
+                sync._partial_last_update[name] = new_cursor
+                touched.add(name)
+        if deletes:
+            try:
+                delete_fn(cur, deletes)
+                applied += len(deletes)
+            except Exception as e:
+                status["last_error"] = f"{name} delete: {e}"
+    for name in touched:
+        sync._save_cursor(cur, name)
+    return applied
+
+
+def _apply_pending():
+    """Drain the coalesced change map into SQLite in one writer command."""
+    with _pending_lock:
+        if not _pending:
+            return 0
+        batch = dict(_pending)
+        _pending.clear()
+
+    regen = []
+    try:
+        state.ensure_schema(sync._ensure_cursor_table)
+        state.ensure_schema(sync._ensure_registry_tables)
+        applied = state.run_write(_apply_batch, batch, regen)
+    except Exception as e:
+        status["last_error"] = str(e)
+        # put the batch back (newer changes win) so it is retried on the next wakeup
+        with _pending_lock:
+            for k, v in batch.items():
+                _pending.setdefault(k, v)
+        return 0
+
+    status["applied"] += applied
+    status["last_applied_at"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    if regen:
+        try:
+            sync._regenerate_embeddings(regen)
+        except Exception:
+            pass
+    return applied
+
+
+def _writer_loop():
+    while True:
+        try:
+            _pending_event.wait()
+            # let bursts (e.g. an initial snapshot or a bulk edit) coalesce
+            time.sleep(COALESCE_SECONDS)
+            _pending_event.clear()
+            if _apply_pending() == 0:
+                with _pending_lock:
+                    if _pending:
+                        time.sleep(1.0)
+                        _pending_event.set()
+        except Exception as e:
+            status["last_error"] = str(e)
+            time.sleep(1.0)
+
+
+def _supervisor_loop():
+    last_reconcile = time.time()
+    while True:
+        now = time.time()
+        for name in LISTEN_COLLECTIONS:
+            try:
+                with _listeners_lock:
+                    info = dict(_listeners.get(name) or {"failures": 0})
+                watch = info.get("watch")
+                if _watch_alive(watch):
+                    continue
+                next_at = info.get("next_attempt_at")
+                if next_at is None and watch is not None:
+                    # listener just died: schedule a reconnect
+                    failures = info.get("failures", 0) + 1
+                    with _listeners_lock:
+                        _listeners[name].update({
+                            "watch": None,
+                            "failures": failures,
+                            "next_attempt_at": now + _backoff_delay(failures),
+                        })
+                    try:
+                        watch.unsubscribe()
+                    except Exception:
+                        pass
+                    continue
+                if next_at is not None and now < next_at:
+                    continue
+                try:
+                    _subscribe(name)
+                except Exception as e:
+                    failures = info.get("failures", 0) + 1
+                    status["last_error"] = f"{name} subscribe: {e}"
+                    with _listeners_lock:
+                        _listeners.setdefault(name, {}).update({
+                            "watch": None,
+                            "failures": failures,
+                            "next_attempt_at": now + _backoff_delay(failures),
+                        })
+            except Exception as e:
+                status["last_error"] = f"{name}: {e}"
+
+        if RECONCILE_INTERVAL > 0 and now - last_reconcile >= RECONCILE_INTERVAL:
+            last_reconcile = now
+            try:
+                sync._sync_partial_collections(force_full=True)
+                status["reconciled_at"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+            except Exception as e:
+                status["last_error"] = f"reconcile: {e}"
+        time.sleep(1.0)
+
+
+def start():
+    """Start listeners, the writer and the supervisor. Returns the writer thread."""
+    global _started, _writer_thread, _supervisor_thread
+    if _started:
+        return _writer_thread
+    if not getattr(sync, 'db_fs', None):
+        return None
+    if not hasattr(sync.db_fs.collection(LISTEN_COLLECTIONS[0]), 'on_snapshot'):
+        return None
+
+    # load the persisted resume checkpoint before the first subscription
+    try:
+        state.ensure_schema(sync._ensure_cursor_table)
+        conn = state.get_read_db()
+        sync._load_cursors(conn.cursor())
+        conn.close()
+    except Exception:
+        pass
+
+    _writer_thread = threading.Thread(target=_writer_loop, name='sync-listen-writer', daemon=True)
+    _writer_thread.start()
+    _supervisor_thread = threading.Thread(target=_supervisor_loop, name='sync-listen-supervisor', daemon=True)
+    _supervisor_thread.start()
+    _started = True
+    print(f'realtime sync started (collections={",".join(LISTEN_COLLECTIONS)})')
+    return _writer_thread
+
+
+@router.get('/sync/realtime/status')
+def realtime_status():
+    with _listeners_lock:
+        listeners = {}
+        for name, info in _listeners.items():
+            listeners[name] = {
+                "active": _watch_alive(info.get("watch")),
+                "resumed": info.get("resumed"),
+                "failures": info.get("failures", 0),
+                "last_event_at": info.get("last_event_at"),
+                "read_time": info.get("read_time"),
+                "next_attempt_at": info.get("next_attempt_at"),
+            }
+    with _pending_lock:
+        pending = len(_pending)
+    return {"started": _started, "status": status, "pending": pending, "listeners": listeners}
@@ -25,8 +25,15 @@ try:
 except Exception:
 	insightface = None
 
+try:
+	from insightface.app.common import Face
+except Exception:
+	Face = None
+
 from . import state
 from . import media
+from . import metrics
+from . import pipeline_trace
 
 # Module-level camera and model to reuse between requests
 _cap = None
@@ -50,6 +57,23 @@ TARGET_FPS = int(os.environ.get("CAP_FPS", 15))
 # Separate tunables for streaming (jpeg encode) and inference loop
 STREAM_FPS = int(os.environ.get("STREAM_FPS", TARGET_FPS))
 INFER_FPS = int(os.environ.get("INFER_FPS", max(1, TARGET_FPS // 2)))
+# insightface model pack; also part of the embedding cache key used by sync
+MODEL_PACK = os.environ.get("FACE_MODEL_PACK", "buffalo_l")
+# server-side marking: a registered student matched on AUTO_MARK_FRAMES
+# consecutive inference frames is marked without waiting for the UI
+AUTO_MARK = os.environ.get("AUTO_MARK", "0").lower() in ("1", "true", "yes")
+try:
+	AUTO_MARK_FRAMES = max(1, int(os.environ.get("AUTO_MARK_FRAMES", "3")))
+except Exception:
+	AUTO_MARK_FRAMES = 3
+# RECOGNITION_WORKERS=0 keeps the capture/encode/infer threads from starting
+# at import (benchmarks and tools drive the pipeline themselves)
+RECOGNITION_WORKERS = os.environ.get("RECOGNITION_WORKERS", "1").lower() not in ("0", "false", "no")
+# CAM_DEVICE may name a video file or an image directory to replay instead of a camera
+CAM_REPLAY_LOOP = os.environ.get("CAM_REPLAY_LOOP", "1").lower() in ("1", "true", "yes")
+_auto_streak = {"id": None, "name": None, "count": 0}
+# cumulative pipeline counters; monitor's history sampler turns them into rates
+pipeline_stats = {"captured": 0, "inferred": 0, "infer_ms_total": 0.0}
 
 # Small in-memory queues to decouple capture -> encode -> inference
 # keep queues tiny to prioritize the latest frame; size=1 drops older frames
@@ -57,7 +81,7 @@ _encode_q = queue.Queue(maxsize=1)
 _infer_q = queue.Queue(maxsize=1)
 
 
-def _put_drop_old(q, item):
+def _put_drop_old(q, item, name=""):
 	"""Put item into q; if full, remove the old and put the new one.
 
 	Keep this inexpensive: queue operations are cheap relative to encoding/inference.
@@ -67,6 +91,7 @@ def _put_drop_old(q, item):
 	except queue.Full:
 		try:
 			q.get_nowait()
+			metrics.FRAMES_DROPPED.inc(labels=(name,))
 		except Exception:
 			pass
 		try:
@@ -75,6 +100,71 @@ def _put_drop_old(q, item):
 			pass
 
 
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+class ReplaySource:
+	"""cv2.VideoCapture-like reader replaying a video file or an image directory.
+
+	Images are read in sorted path order (subdirectories included). `name`
+	identifies the last frame returned (path relative to the directory, or
+	the frame index of a video) so replayed frames can be matched to
+	ground-truth labels. Without loop, read() fails once the source is
+	exhausted and `exhausted` is set.
+	"""
+
+	def __init__(self, path, loop=True):
+		self.path = path
+		self.loop = loop
+		self.position = -1
+		self.name = None
+		self.exhausted = False
+		self._files = None
+		self._video = None
+		if os.path.isdir(path):
+			self._files = sorted(
+				os.path.join(root, f)
+				for root, _dirs, files in os.walk(path)
+				for f in files
+				if f.lower().endswith(IMAGE_EXTS)
+			)
+		else:
+			self._video = cv2.VideoCapture(path)
+
+	def isOpened(self):
+		if self._files is not None:
+			return bool(self._files)
+		return self._video is not None and self._video.isOpened()
+
+	def read(self):
+		if self._files is not None:
+			nxt = self.position + 1
+			if nxt >= len(self._files):
+				if not self.loop or not self._files:
+					self.exhausted = True
+					return False, None
+				nxt = 0
+			frame = cv2.imread(self._files[nxt])
+			self.position = nxt
+			self.name = os.path.relpath(self._files[nxt], self.path)
+			return frame is not None, frame
+		ok, frame = self._video.read()
+		if not ok and self.loop and self.position >= 0:
+			self._video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+			self.position = -1
+			ok, frame = self._video.read()
+		if not ok:
+			self.exhausted = True
+			return False, None
+		self.position += 1
+		self.name = str(self.position)
+		return True, frame
+
+	def release(self):
+		if self._video is not None:
+			self._video.release()
+
+
 def _open_camera():
 	global _cap
 	if cv2 is None:
@@ -94,7 +184,15 @@ def _open_camera():
 
 	# Respect an explicit device path via CAM_DEVICE (e.g. /dev/video1)
 	cam_device = os.environ.get("CAM_DEVICE")
-	if cam_device:
+	if cam_device and (os.path.isdir(cam_device) or os.path.isfile(cam_device)):
+		try:
+			c = ReplaySource(cam_device, loop=CAM_REPLAY_LOOP)
+			if c.isOpened():
+				_cap = c
+				return _cap
+		except Exception:
+			pass
+	elif cam_device:
 		try:
 			c = cv2.VideoCapture(cam_device)
 			if c is not None and c.isOpened():
@@ -144,7 +242,7 @@ def _init_model():
 	if model is not None:
 		return model
 	try:
-		appm = insightface.app.FaceAnalysis(name="buffalo_l")
+		appm = insightface.app.FaceAnalysis(name=MODEL_PACK)
 		try:
 			appm.prepare(ctx_id=0, det_size=(320, 320))
 		except Exception:
@@ -204,14 +302,22 @@ def _capture_thread():
 				# produce a blank frame for encoder to pick up
 				if cv2 is not None and np is not None:
 					blank = np.zeros((480, 640, 3), dtype=np.uint8)
-					_put_drop_old(_encode_q, blank)
-					_put_drop_old(_infer_q, blank)
+					trace = pipeline_trace.start()
+					_put_drop_old(_encode_q, (blank, trace), "encode")
+					_put_drop_old(_infer_q, (blank, trace), "infer")
+					pipeline_trace.mark(trace, "enqueue")
 				time.sleep(interval)
 				continue
 
-			# put frame into encode and infer queues (drop oldest if busy)
-			_put_drop_old(_encode_q, frame)
-			_put_drop_old(_infer_q, frame)
+			# put frame into encode and infer queues (drop oldest if busy);
+			# items carry the frame's trace record (see pipeline_trace)
+			trace = pipeline_trace.start()
+			if isinstance(cam, ReplaySource):
+				trace["frame"] = cam.name
+			_put_drop_old(_encode_q, (frame, trace), "encode")
+			_put_drop_old(_infer_q, (frame, trace), "infer")
+			pipeline_trace.mark(trace, "enqueue")
+			pipeline_stats["captured"] += 1
 			# sleep to target capture FPS
 			time.sleep(interval)
 		except Exception:
@@ -226,14 +332,17 @@ def _encode_thread():
 
 	Uses a blocking get() so we process frames as soon as they arrive without unnecessary timeouts.
 	"""
+	global latest_frame_buf
 	# If cv2 or numpy missing, this thread will not run (threads only start when cv2 present)
 	while True:
 		try:
-			frame = _encode_q.get()  # block until a frame is available
+			frame, _trace = _encode_q.get()  # block until a frame is available
 			if frame is None:
 				continue
 			try:
+				t0 = time.perf_counter()
 				ok, buf = cv2.imencode('.jpg', frame)
+				metrics.JPEG_ENCODE_SECONDS.observe(time.perf_counter() - t0)
 				if ok:
 					with latest_frame_lock:
 						latest_frame_buf = buf.tobytes()
@@ -247,305 +356,414 @@ def _encode_thread():
 				pass
 
 
-def _infer_thread():
-	"""Run face model on frames and update cached recognition results.
+def _run_model(mdl, img, trace=None):
+	"""Run the face model on img, timing detection and embedding separately.
 
-	Uses blocking get() and a simple rate limiter to respect INFER_FPS without idle timeouts.
+	Mirrors FaceAnalysis.get() (detector, then every other model per face);
+	falls back to a single mdl.get() call, recorded as detect, when the model
+	does not expose its parts.
 	"""
-	mdl = None
+	det = getattr(mdl, 'det_model', None)
+	models = getattr(mdl, 'models', None)
+	if det is None or Face is None or not isinstance(models, dict):
+		t0 = time.perf_counter()
+		faces = mdl.get(img)
+		metrics.INFER_STAGE_SECONDS.observe(time.perf_counter() - t0, ("detect",))
+		pipeline_trace.mark(trace, "detect")
+		return faces
+	t0 = time.perf_counter()
+	bboxes, kpss = det.detect(img, max_num=0, metric='default')
+	t1 = time.perf_counter()
+	metrics.INFER_STAGE_SECONDS.observe(t1 - t0, ("detect",))
+	if trace is not None:
+		trace["detect"] = t1
+	faces = []
+	for i in range(bboxes.shape[0]):
+		face = Face(bbox=bboxes[i, 0:4], kps=kpss[i] if kpss is not None else None, det_score=bboxes[i, 4])
+		for taskname, m in models.items():
+			if taskname == 'detection':
+				continue
+			m.get(img, face)
+		faces.append(face)
+	if faces:
+		t2 = time.perf_counter()
+		metrics.INFER_STAGE_SECONDS.observe(t2 - t1, ("embed",))
+		if trace is not None:
+			trace["embed"] = t2
+	return faces
+
+
+def _auto_mark_step(student_id, student_name=None):
+	"""Track consecutive matches of one student and mark them once the streak is stable."""
+	if student_id is None or latest_spoof_result.get("status") == "spoof":
+		_auto_streak.update({"id": None, "name": None, "count": 0})
+		return
+	if _auto_streak["id"] == student_id:
+		_auto_streak["count"] += 1
+	else:
+		_auto_streak.update({"id": student_id, "name": student_name, "count": 1})
+	if _auto_streak["count"] == AUTO_MARK_FRAMES:
+		try:
+			from . import session
+			session.auto_mark(student_id, student_name)
+		except Exception:
+			pass
+
+
+def _publish(trace, outcome, faces, match=None):
+	if trace is None:
+		return
+	if match:
+		trace["match_id"] = match.get("id")
+	pipeline_trace.publish(trace, outcome, faces)
+	metrics.FRAME_LATENCY_SECONDS.observe(trace["published"] - trace["capture"])
+
+
+def _process_frame(mdl, frame, trace=None):
+	"""Run recognition on one frame and publish the results to the live caches.
+
+	Shared by _infer_thread and the offline benchmark. Returns
+	(outcome, match) where match is the matched teacher/student dict or None.
+	"""
+	global _last_unrecog_ts
+	start = time.time()
+	auto_candidate = None
+	outcome = None
+	tmatch = smatch = None
 	try:
-		mdl = _init_model()
-	except Exception:
-		mdl = None
+		try:
+			small = cv2.resize(frame, (320, 240)) if cv2 is not None else frame
+		except Exception:
+			small = frame
+		faces = _run_model(mdl, small, trace)
+		pipeline_stats["inferred"] += 1
+		pipeline_stats["infer_ms_total"] += (time.time() - start) * 1000.0
 
-	interval = 1.0 / max(1, INFER_FPS)
-	last_infer = 0.0
-	while True:
+		# update detection cache
+		now = time.time()
 		try:
-			frame = _infer_q.get()  # block until a frame is available
-			if frame is None or mdl is None or np is None:
-				continue
+			latest_detection_result.update({"faces": len(faces) if faces else 0, "ts": now, "known": False})
+		except Exception:
+			pass
 
-			start = time.time()
+		if not faces or len(faces) == 0:
+			# no faces detected: surface this explicitly so UI can react
 			try:
-				try:
-					small = cv2.resize(frame, (320, 240)) if cv2 is not None else frame
-				except Exception:
-					small = frame
-				faces = mdl.get(small)
+				latest_teacher_result.update({"status": "no_face"})
+			except Exception:
+				pass
+			try:
+				latest_student_result.update({"status": "no_face"})
+			except Exception:
+				pass
+			try:
+				latest_unrecognized_result.update({"status": "idle"})
+			except Exception:
+				pass
+			# an empty frame breaks any auto-mark streak
+			_auto_streak["count"] = 0
+			_auto_streak["id"] = None
+			_publish(trace, "no_face", 0)
+			return "no_face", None
+		# if we continue, detection known stays False (no faces)
+	except Exception:
+		faces = []
 
-				# update detection cache
-				now = time.time()
-				try:
-					latest_detection_result.update({"faces": len(faces) if faces else 0, "ts": now, "known": False})
-				except Exception:
-					pass
+	if faces:
+		face = faces[0]
+		try:
+			emb = face.embedding.astype(np.float32)
+		except Exception:
+			emb = None
 
-				if not faces or len(faces) == 0:
-					# no faces detected: surface this explicitly so UI can react
+		if emb is not None:
+			# teacher match
+			t0 = time.perf_counter()
+			try:
+				with state.emb_lock:
+					tmatch = _match_face_in_list(state.teacher_embeddings, emb)
+			except Exception:
+				tmatch = None
+			metrics.INFER_STAGE_SECONDS.observe(time.perf_counter() - t0, ("match",))
+			if tmatch:
+				metrics.MATCHES.inc(labels=("teacher",))
+				# include profilePicUrl and determine whether this teacher is assigned to the local kiosk room
+				pp = None
+				assigned_ok = None
+				classes_in_room = []
+				conn = None
+				lookup_t0 = time.perf_counter()
+				try:
+					conn = state.get_read_db()
+					cur = conn.cursor()
+					# profile pic
 					try:
-						latest_teacher_result.update({"status": "no_face"})
+						cur.execute("SELECT profilePicUrl FROM teachers WHERE id = ?", (tmatch["id"],))
+						rpic = cur.fetchone()
+						if rpic and rpic[0]:
+							pp = rpic[0]
 					except Exception:
-						pass
+						pp = None
+
+					# build room candidates from kiosks_fs and env
+					room_candidates = []
 					try:
-						latest_student_result.update({"status": "no_face"})
+						cur.execute("SELECT assignedRoomId, raw_doc FROM kiosks_fs LIMIT 1")
+						krow = cur.fetchone()
+						if krow:
+							if krow[0]:
+								room_candidates.append(str(krow[0]))
+							raw = krow[1] if len(krow) > 1 else None
+							if raw:
+								try:
+									import json as _json
+									rj = _json.loads(raw)
+									if isinstance(rj, dict):
+										if 'roomNumber' in rj:
+											room_candidates.append(str(rj.get('roomNumber')))
+										if 'assignedRoom' in rj:
+											room_candidates.append(str(rj.get('assignedRoom')))
+								except Exception:
+									pass
 					except Exception:
 						pass
 					try:
-						latest_unrecognized_result.update({"status": "idle"})
+						env_room = os.environ.get('KIOSK_ROOM_NUMBER')
+						if env_room:
+							room_candidates.append(env_room)
 					except Exception:
 						pass
-					continue
-				# if we continue, detection known stays False (no faces)
-			except Exception:
-				faces = []
+					room_candidates = [c for c in [str(x).strip() for x in room_candidates if x] if c]
 
-			if faces:
-				face = faces[0]
-				try:
-					emb = face.embedding.astype(np.float32)
+					# If we have candidates, query classes for this teacher filtered by roomNumber
+					if room_candidates:
+						try:
+							placeholders = ",".join(["?"] * len(room_candidates))
+							sql = f"SELECT id, name, subjectName, gradeLevel, section, roomNumber FROM classes WHERE teacher_id = ? AND roomNumber IN ({placeholders})"
+							params = [tmatch["id"]] + room_candidates
+							cur.execute(sql, tuple(params))
+							crows = cur.fetchall()
+							if crows:
+								assigned_ok = True
+								for cr in crows:
+									classes_in_room.append({"id": cr[0], "name": cr[1], "subjectName": cr[2], "gradeLevel": cr[3], "section": cr[4], "roomNumber": cr[5] if len(cr) > 5 else None})
+							else:
+								assigned_ok = False
+						except Exception:
+							assigned_ok = False
+					else:
+						# no room candidates: leave assigned_ok as None (unknown) and optionally list all classes for this teacher
+						try:
+							cur.execute("SELECT id, name, subjectName, gradeLevel, section, roomNumber FROM classes WHERE teacher_id = ?", (tmatch["id"],))
+							crows = cur.fetchall()
+							for cr in crows:
+								classes_in_room.append({"id": cr[0], "name": cr[1], "subjectName": cr[2], "gradeLevel": cr[3], "section": cr[4], "roomNumber": cr[5] if len(cr) > 5 else None})
+						except Exception:
+							pass
 				except Exception:
-					emb = None
-
-				if emb is not None:
-					# teacher match
+					pass
+				finally:
 					try:
-						with state.emb_lock:
-							tmatch = _match_face_in_list(state.teacher_embeddings, emb)
+						if conn:
+							conn.close()
 					except Exception:
-						tmatch = None
-					if tmatch:
-						# include profilePicUrl and determine whether this teacher is assigned to the local kiosk room
-						pp = None
-						assigned_ok = None
-						classes_in_room = []
-						conn = None
-						try:
-							conn = state.get_db()
-							cur = conn.cursor()
-							# profile pic
-							try:
-								cur.execute("SELECT profilePicUrl FROM teachers WHERE id = ?", (tmatch["id"],))
-								rpic = cur.fetchone()
-								if rpic and rpic[0]:
-									pp = rpic[0]
-							except Exception:
-								pp = None
+						pass
+				pipeline_trace.add_lookup(trace, lookup_t0)
+
+				# final update: include assigned flag and classes when available
+				payload = {"status": "success", "id": tmatch["id"], "name": tmatch["name"], "score": tmatch.get("score"), "profilePicUrl": pp}
+				if assigned_ok is True:
+					payload["assigned"] = True
+					if classes_in_room:
+						payload["classes"] = classes_in_room
+				elif assigned_ok is False:
+					payload["assigned"] = False
+				# assigned_ok None -> unknown: omit assigned or set to None
+				latest_teacher_result.update(payload)
+				# mark detection as known (teacher matched)
+				try:
+					latest_detection_result.update({"known": True, "ts": time.time()})
+				except Exception:
+					pass
+			else:
+				latest_teacher_result.update({"status": "teacher_not_registered"})
 
-							# build room candidates from kiosks_fs and env
-							room_candidates = []
-							try:
-								cur.execute("SELECT assignedRoomId, raw_doc FROM kiosks_fs LIMIT 1")
-								krow = cur.fetchone()
-								if krow:
-									if krow[0]:
-										room_candidates.append(str(krow[0]))
-									raw = krow[1] if len(krow) > 1 else None
-									if raw:
-										try:
-											import json as _json
-											rj = _json.loads(raw)
-											if isinstance(rj, dict):
-												if 'roomNumber' in rj:
-													room_candidates.append(str(rj.get('roomNumber')))
-												if 'assignedRoom' in rj:
-													room_candidates.append(str(rj.get('assignedRoom')))
-										except Exception:
-											pass
-							except Exception:
-								pass
+			# student match
+			t0 = time.perf_counter()
+			try:
+				with state.emb_lock:
+					smatch = _match_face_in_list(state.student_embeddings, emb)
+			except Exception:
+				smatch = None
+			metrics.INFER_STAGE_SECONDS.observe(time.perf_counter() - t0, ("match",))
+			pipeline_trace.mark(trace, "match")
+			if smatch:
+				metrics.MATCHES.inc(labels=("student",))
+				student_id = smatch["id"]
+				student_name = smatch["name"]
+				# enforce session active and registration before accepting
+				conn = None
+				lookup_t0 = time.perf_counter()
+				try:
+					conn = state.get_read_db()
+					cur = conn.cursor()
+					active_class_id = state.current_session.get("class_id")
+					if not active_class_id:
+						# no active session: don't accept student
+						latest_student_result.update({"status": "service_inactive"})
+					else:
+						cur.execute("SELECT 1 FROM class_students WHERE class_id = ? AND student_id = ?", (active_class_id, student_id))
+						row = cur.fetchone()
+						if row:
+							# include profilePicUrl from DB if available and save snapshot
+							pp = None
 							try:
-								env_room = os.environ.get('KIOSK_ROOM_NUMBER')
-								if env_room:
-									room_candidates.append(env_room)
+								conn = state.get_read_db()
+								cur = conn.cursor()
+								cur.execute("SELECT profilePicUrl FROM students WHERE id = ?", (student_id,))
+								row = cur.fetchone()
+								if row and row[0]:
+									pp = row[0]
+								conn.close()
 							except Exception:
-								pass
-							room_candidates = [c for c in [str(x).strip() for x in room_candidates if x] if c]
-
-							# If we have candidates, query classes for this teacher filtered by roomNumber
-							if room_candidates:
 								try:
-									placeholders = ",".join(["?"] * len(room_candidates))
-									sql = f"SELECT id, name, subjectName, gradeLevel, section, roomNumber FROM classes WHERE teacher_id = ? AND roomNumber IN ({placeholders})"
-									params = [tmatch["id"]] + room_candidates
-									cur.execute(sql, tuple(params))
-									crows = cur.fetchall()
-									if crows:
-										assigned_ok = True
-										for cr in crows:
-											classes_in_room.append({"id": cr[0], "name": cr[1], "subjectName": cr[2], "gradeLevel": cr[3], "section": cr[4], "roomNumber": cr[5] if len(cr) > 5 else None})
-									else:
-										assigned_ok = False
-								except Exception:
-									assigned_ok = False
-							else:
-								# no room candidates: leave assigned_ok as None (unknown) and optionally list all classes for this teacher
-								try:
-									cur.execute("SELECT id, name, subjectName, gradeLevel, section, roomNumber FROM classes WHERE teacher_id = ?", (tmatch["id"],))
-									crows = cur.fetchall()
-									for cr in crows:
-										classes_in_room.append({"id": cr[0], "name": cr[1], "subjectName": cr[2], "gradeLevel": cr[3], "section": cr[4], "roomNumber": cr[5] if len(cr) > 5 else None})
+									if conn:
+										conn.close()
 								except Exception:
 									pass
-						except Exception:
-							pass
-						finally:
+							latest_student_result.update({"status": "success", "id": student_id, "name": student_name, "registered": True, "profilePicUrl": pp})
+							auto_candidate = (student_id, student_name)
+							# mark detection as known (student matched)
 							try:
-								if conn:
-									conn.close()
+								latest_detection_result.update({"known": True, "ts": time.time()})
 							except Exception:
 								pass
+						else:
+							# student not registered for the active class
+							latest_student_result.update({"status": "denied", "reason": "not_registered", "id": student_id, "name": student_name, "registered": False})
+				except Exception:
+					latest_student_result.update({"status": "unknown"})
+				finally:
+					try:
+						if conn:
+							conn.close()
+					except Exception:
+						pass
+				pipeline_trace.add_lookup(trace, lookup_t0)
+			else:
+				latest_student_result.update({"status": "unknown"})
 
-						# final update: include assigned flag and classes when available
-						payload = {"status": "success", "id": tmatch["id"], "name": tmatch["name"], "score": tmatch.get("score"), "profilePicUrl": pp}
-						if assigned_ok is True:
-							payload["assigned"] = True
-							if classes_in_room:
-								payload["classes"] = classes_in_room
-						elif assigned_ok is False:
-							payload["assigned"] = False
-						# assigned_ok None -> unknown: omit assigned or set to None
-						latest_teacher_result.update(payload)
-						# mark detection as known (teacher matched)
-						try:
-							latest_detection_result.update({"known": True, "ts": time.time()})
-						except Exception:
-							pass
-					else:
-						latest_teacher_result.update({"status": "teacher_not_registered"})
-
-					# student match
+			# ensure detection-known info reflects any teacher/student match (covers service_inactive cases)
+			try:
+				known = None
+				if tmatch:
+					known = {"type": "teacher", "id": tmatch.get("id"), "name": tmatch.get("name"), "score": tmatch.get("score")}
+				elif smatch:
+					known = {"type": "student", "id": smatch.get("id"), "name": smatch.get("name"), "score": smatch.get("score")}
+				if known is not None:
 					try:
-						with state.emb_lock:
-							smatch = _match_face_in_list(state.student_embeddings, emb)
+						latest_detection_result.update({"known": known, "ts": time.time()})
 					except Exception:
-						smatch = None
-					if smatch:
-						student_id = smatch["id"]
-						student_name = smatch["name"]
-						# enforce session active and registration before accepting
-						conn = None
+						pass
+			except Exception:
+				pass
+
+			# Unrecognized face: neither teacher nor student matched.
+			# Rate-limit notifications/signals so the UI isn't flooded.
+			try:
+				now = time.time()
+				try:
+					quiet = int(os.environ.get("UNRECOG_QUIET_SECONDS", "5"))
+				except Exception:
+					quiet = 5
+				# if neither matched and embedding exists, set unrecognized signal
+				if (not tmatch) and (not smatch) and emb is not None:
+					metrics.UNKNOWN_FACES.inc()
+					outcome = "unknown"
+					if now - _last_unrecog_ts > quiet:
+						_last_unrecog_ts = now
 						try:
-							conn = state.get_db()
-							cur = conn.cursor()
-							active_class_id = state.current_session.get("class_id")
-							if not active_class_id:
-								# no active session: don't accept student
-								latest_student_result.update({"status": "service_inactive"})
-							else:
-								cur.execute("SELECT 1 FROM class_students WHERE class_id = ? AND student_id = ?", (active_class_id, student_id))
-								row = cur.fetchone()
-								if row:
-									# include profilePicUrl from DB if available and save snapshot
-									pp = None
-									try:
-										conn = state.get_db()
-										cur = conn.cursor()
-										cur.execute("SELECT profilePicUrl FROM students WHERE id = ?", (student_id,))
-										row = cur.fetchone()
-										if row and row[0]:
-											pp = row[0]
-										conn.close()
-									except Exception:
-										try:
-											if conn:
-												conn.close()
-										except Exception:
-											pass
-									latest_student_result.update({"status": "success", "id": student_id, "name": student_name, "registered": True, "profilePicUrl": pp})
-									# mark detection as known (student matched)
-									try:
-										latest_detection_result.update({"known": True, "ts": time.time()})
-									except Exception:
-										pass
-								else:
-									# student not registered for the active class
-									latest_student_result.update({"status": "denied", "reason": "not_registered", "id": student_id, "name": student_name, "registered": False})
+							latest_unrecognized_result.update({"status": "unrecognized", "ts": now})
 						except Exception:
-							latest_student_result.update({"status": "unknown"})
-						finally:
-							try:
-								if conn:
-									conn.close()
-							except Exception:
-								pass
-					else:
-						latest_student_result.update({"status": "unknown"})
-
-					# ensure detection-known info reflects any teacher/student match (covers service_inactive cases)
+							pass
+				else:
+					# if matched, clear unrecognized signal
 					try:
-						known = None
-						if tmatch:
-							known = {"type": "teacher", "id": tmatch.get("id"), "name": tmatch.get("name"), "score": tmatch.get("score")}
-						elif smatch:
-							known = {"type": "student", "id": smatch.get("id"), "name": smatch.get("name"), "score": smatch.get("score")}
-						if known is not None:
-							try:
-								latest_detection_result.update({"known": known, "ts": time.time()})
-							except Exception:
-								pass
+						latest_unrecognized_result.update({"status": "idle"})
 					except Exception:
 						pass
 
-					# Unrecognized face: neither teacher nor student matched.
-					# Rate-limit notifications/signals so the UI isn't flooded.
+				# Anti-spoof / liveness check (anti_fake1). If the face object or
+				# its extra attributes include an `anti_fake1` flag, expose it via
+				# latest_spoof_result so frontends can show a UI warning.
+				try:
+					# robustly attempt to read anti_fake1 from face attributes
+					anti_flag = None
 					try:
-						now = time.time()
-						try:
-							quiet = int(os.environ.get("UNRECOG_QUIET_SECONDS", "5"))
-						except Exception:
-							quiet = 5
-						# if neither matched and embedding exists, set unrecognized signal
-						if (not tmatch) and (not smatch) and emb is not None:
-							if now - _last_unrecog_ts > quiet:
-								_last_unrecog_ts = now
-								try:
-									latest_unrecognized_result.update({"status": "unrecognized", "ts": now})
-								except Exception:
-									pass
-						else:
-							# if matched, clear unrecognized signal
+						anti_flag = getattr(face, "anti_fake1", None)
+					except Exception:
+						anti_flag = None
+					# some runtimes may put extra attributes in a dict-like field
+					try:
+						if anti_flag is None and hasattr(face, "extra"):
+							ex = getattr(face, "extra")
+							if isinstance(ex, dict) and "anti_fake1" in ex:
+								anti_flag = ex.get("anti_fake1")
+					except Exception:
+						pass
+					# If we found a truthy anti_fake1 indicator, flag spoof
+						if anti_flag:
 							try:
-								latest_unrecognized_result.update({"status": "idle"})
+								latest_spoof_result.update({"status": "spoof", "ts": now, "method": "anti_fake1"})
 							except Exception:
 								pass
-
-						# Anti-spoof / liveness check (anti_fake1). If the face object or
-						# its extra attributes include an `anti_fake1` flag, expose it via
-						# latest_spoof_result so frontends can show a UI warning.
+					else:
+						# clear spoof when anti_fake1 not present
 						try:
-							# robustly attempt to read anti_fake1 from face attributes
-							anti_flag = None
-							try:
-								anti_flag = getattr(face, "anti_fake1", None)
-							except Exception:
-								anti_flag = None
-							# some runtimes may put extra attributes in a dict-like field
-							try:
-								if anti_flag is None and hasattr(face, "extra"):
-									ex = getattr(face, "extra")
-									if isinstance(ex, dict) and "anti_fake1" in ex:
-										anti_flag = ex.get("anti_fake1")
-							except Exception:
-								pass
-							# If we found a truthy anti_fake1 indicator, flag spoof
-								if anti_flag:
-									try:
-										latest_spoof_result.update({"status": "spoof", "ts": now, "method": "anti_fake1"})
-									except Exception:
-										pass
-							else:
-								# clear spoof when anti_fake1 not present
-								try:
-									latest_spoof_result.update({"status": "idle"})
-								except Exception:
-									pass
+							latest_spoof_result.update({"status": "idle"})
 						except Exception:
-							# swallow any errors reading spoof attributes
 							pass
-					except Exception:
-						# ignore unrecognized signaling failures
-						pass
+				except Exception:
+					# swallow any errors reading spoof attributes
+					pass
+			except Exception:
+				# ignore unrecognized signaling failures
+				pass
+
+	if AUTO_MARK:
+		try:
+			_auto_mark_step(*(auto_candidate or (None,)))
+		except Exception:
+			pass
+	if outcome is None and faces:
+		outcome = "teacher" if tmatch else ("student" if smatch else "no_embedding")
+	match = tmatch or smatch
+	_publish(trace, outcome, len(faces) if faces else 0, match)
+	return outcome, match
+
+
+def _infer_thread():
+	"""Run face model on frames and update cached recognition results.
+
+	Uses blocking get() and a simple rate limiter to respect INFER_FPS without idle timeouts.
+	"""
+	mdl = None
+	try:
+		mdl = _init_model()
+	except Exception:
+		mdl = None
+
+	interval = 1.0 / max(1, INFER_FPS)
+	last_infer = 0.0
+	while True:
+		try:
+			frame, trace = _infer_q.get()  # block until a frame is available
+			pipeline_trace.mark(trace, "dequeue")
+			if frame is None or mdl is None or np is None:
+				continue
+
+			start = time.time()
+			_process_frame(mdl, frame, trace)
 
 			# rate limit inference to roughly INFER_FPS
 			elapsed = time.time() - start
@@ -563,13 +781,24 @@ def _infer_thread():
 				pass
 
 
+def start_workers():
+	"""Start the capture, encode and infer threads (once)."""
+	global _workers_started
+	if _workers_started or cv2 is None:
+		return
+	_workers_started = True
+	threading.Thread(target=_capture_thread, name='camera-capture', daemon=True).start()
+	threading.Thread(target=_encode_thread, name='jpeg-encode', daemon=True).start()
+	threading.Thread(target=_infer_thread, name='face-infer', daemon=True).start()
+
+
+_workers_started = False
+
 # start worker threads (best-effort)
 try:
 	# only start threads if cv2 is present; otherwise endpoints will return errors as before
-	if cv2 is not None:
-		threading.Thread(target=_capture_thread, daemon=True).start()
-		threading.Thread(target=_encode_thread, daemon=True).start()
-		threading.Thread(target=_infer_thread, daemon=True).start()
+	if RECOGNITION_WORKERS:
+		start_workers()
 except Exception:
 	pass
 
@@ -623,6 +852,7 @@ def recognize_teacher():
 	Returns JSON with status and optional classes list when teacher matched.
 	"""
 	# Return latest cached teacher result for instant response
+	pipeline_trace.note_poll()
 	try:
 		res = dict(latest_teacher_result)
 		# include detection info so frontends can act on presence quickly
@@ -640,7 +870,7 @@ def recognize_teacher():
 		# enrich with profilePicUrl from local DB when available
 		try:
 			if res.get("status") == "success" and res.get("id"):
-				conn = state.get_db()
+				conn = state.get_read_db()
 				try:
 					cur = conn.cursor()
 					cur.execute("SELECT profilePicUrl FROM teachers WHERE id = ?", (res.get("id"),))
@@ -665,6 +895,7 @@ def recognize_camera():
 	`state.current_session` the student must belong to that class.
 	"""
 	# Return latest cached student result for instant response
+	pipeline_trace.note_poll()
 	try:
 		res = dict(latest_student_result)
 		# include detection info so frontends can act on presence quickly
@@ -682,7 +913,7 @@ def recognize_camera():
 		# enrich with profilePicUrl from local DB when available
 		try:
 			if res.get("status") == "success" and res.get("id"):
-				conn = state.get_db()
+				conn = state.get_read_db()
 				try:
 					cur = conn.cursor()
 					cur.execute("SELECT profilePicUrl FROM students WHERE id = ?", (res.get("id"),))
@@ -728,6 +959,7 @@ def detect_status():
 
 	Frontend should poll this for quick presence indication.
 	"""
+	pipeline_trace.note_poll()
 	try:
 		return dict(latest_detection_result)
 	except Exception as e:
@@ -23,7 +23,7 @@ def _rows_to_dicts(cursor, rows):
 @router.get("/rooms")
 def get_rooms(kioskid: str = Query(None)):
 	try:
-		conn = state.get_db()
+		conn = state.get_read_db()
 		cur = conn.cursor()
 		if kioskid:
 			cur.execute("SELECT * FROM rooms_fs WHERE kioskId = ?", (kioskid,))
@@ -38,7 +38,7 @@ def get_rooms(kioskid: str = Query(None)):
 @router.get("/kiosks")
 def get_kiosks(serial: str = Query(None), kioskid: str = Query(None)):
 	try:
-		conn = state.get_db()
+		conn = state.get_read_db()
 		cur = conn.cursor()
 		if serial:
 			cur.execute("SELECT * FROM kiosks_fs WHERE serialNumber = ?", (serial,))
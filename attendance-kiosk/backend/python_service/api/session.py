@@ -1,21 +1,25 @@
 from fastapi import APIRouter, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 import json
 import time
+import uuid
 from datetime import datetime, timezone
 import os
+import threading
+from collections import deque
 
 from . import state
 
-# optional import for recognition and firestore push
+# optional import for recognition and the firestore outbox
 try:
     from . import recognition
 except Exception:
     recognition = None
 try:
-    from . import sync
+    from . import outbox
 except Exception:
-    sync = None
+    outbox = None
 
 router = APIRouter()
 
@@ -34,6 +38,28 @@ def _read_rpi_serial():
     return None
 
 
+def _local_kiosk(conn):
+    """Return (kiosk fs id, assigned room id) for this device, best-effort."""
+    try:
+        serial_local = _read_rpi_serial()
+        if serial_local:
+            try:
+                kro = conn.execute("SELECT fs_id, assignedRoomId FROM kiosks_fs WHERE serialNumber = ?", (serial_local,)).fetchone()
+                if kro and kro[0]:
+                    return kro[0], kro[1]
+            except Exception:
+                pass
+        try:
+            kro = conn.execute("SELECT fs_id, assignedRoomId FROM kiosks_fs LIMIT 1").fetchone()
+            if kro:
+                return kro[0], kro[1]
+        except Exception:
+            pass
+    except Exception:
+        pass
+    return None, None
+
+
 def _ensure_attendance_table(conn):
     conn.execute(
         """
@@ -48,10 +74,16 @@ def _ensure_attendance_table(conn):
             studentsAbsent TEXT,
             timeStarted TEXT,
             timeEnded TEXT,
-            raw_doc JSON
+            raw_doc JSON,
+            fs_doc_id TEXT
         )
     """
     )
+    # Firestore session doc id, computed once at start (outbox.session_doc_id)
+    try:
+        conn.execute("ALTER TABLE attendance_sessions ADD COLUMN fs_doc_id TEXT")
+    except Exception:
+        pass
     # per-session per-student attendance entries
     conn.execute(
         """
@@ -85,6 +117,544 @@ def _ensure_attendance_table(conn):
         )
     """
     )
+    # attendance_entries is the source of truth for present/absent; the JSON
+    # columns on attendance_sessions are only a derived export
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_attendance_entries_session_status ON attendance_entries (session_id, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_attendance_sessions_active ON attendance_sessions (teacher_id, class_id, isActive)")
+    # session writes enqueue outbox rows; migrate that table here, once, not per insert
+    if outbox is not None:
+        outbox._ensure_outbox_table(conn)
+
+
+PRESENT_STATUSES = ("present", "late")
+
+
+def _upsert_session_fs(conn, values):
+    """Mirror a session document into the local attendance_sessions_fs table."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS attendance_sessions_fs (
+            fs_id TEXT PRIMARY KEY,
+            class_id TEXT,
+            teacher_id TEXT,
+            date TEXT,
+            isActive TEXT,
+            roomId TEXT,
+            studentsPresent JSON,
+            studentsAbsent JSON,
+            timeStarted TEXT,
+            timeEnded TEXT,
+            raw_doc JSON
+        )
+    """
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO attendance_sessions_fs (fs_id, class_id, teacher_id, date, isActive, roomId, studentsPresent, studentsAbsent, timeStarted, timeEnded, raw_doc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        values,
+    )
+
+
+def _create_session_rows(conn, class_id, teacher_id, room_fs_id, now, body):
+    """Insert the attendance_sessions row and queue its Firestore session document."""
+    cur = conn.execute(
+        "INSERT INTO attendance_sessions (class_id, teacher_id, date, isActive, roomId, studentsPresent, studentsAbsent, timeStarted, raw_doc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (class_id, teacher_id, now, "true", room_fs_id, json.dumps([]), json.dumps([]), now, json.dumps(body)),
+    )
+    row_id = cur.lastrowid
+    if outbox is None:
+        return row_id, None
+    doc_id = outbox.session_doc_id(row_id, class_id, now, state.get_class_meta(class_id, conn))
+    conn.execute("UPDATE attendance_sessions SET fs_doc_id = ? WHERE id = ?", (doc_id, row_id))
+    session_doc = {
+        "classId": class_id,
+        "teacherId": teacher_id,
+        "date": now,
+        "isActive": True,
+        "roomId": room_fs_id,
+        "studentsPresent": [],
+        "studentsAbsent": [],
+        "timeStarted": now,
+        "timeEnded": None,
+        "entries": [],
+        "raw_doc": body,
+    }
+    # mirror to local attendance_sessions_fs table as well
+    _upsert_session_fs(
+        conn,
+        (doc_id, class_id, teacher_id, now, str(True), room_fs_id, json.dumps([]), json.dumps([]), now, None, json.dumps(body)),
+    )
+    outbox.enqueue_op(conn, "session_upsert", row_id, {"doc": session_doc, "merge": False}, now)
+    return row_id, doc_id
+
+
+def _close_session_rows(conn, row_id, class_id, now):
+    """Mark a session inactive and record absentees; returns (present, absent, entries).
+
+    Every enrolled student without an entry gets an 'absent' entry (one
+    INSERT ... SELECT anti-join); the entries are then read once and the JSON
+    export columns are written with the same UPDATE that closes the session.
+    """
+    conn.execute(
+        """
+        INSERT INTO attendance_entries (session_id, student_id, timeLogged, status, created_at)
+        SELECT ?, cs.student_id, NULL, 'absent', ?
+        FROM class_students cs
+        WHERE cs.class_id = ?
+          AND NOT EXISTS (
+              SELECT 1 FROM attendance_entries e WHERE e.session_id = ? AND e.student_id = cs.student_id
+          )
+        """,
+        (row_id, now, class_id, row_id),
+    )
+    entries = []
+    present = []
+    absent = []
+    for r in conn.execute(
+        "SELECT student_id, timeLogged, status, created_at FROM attendance_entries WHERE session_id = ? ORDER BY id",
+        (row_id,),
+    ).fetchall():
+        entries.append({"student_id": r[0], "timeLogged": r[1], "status": r[2], "created_at": r[3]})
+        if r[2] in PRESENT_STATUSES:
+            present.append(r[0])
+        elif r[2] == "absent":
+            absent.append(r[0])
+    # studentsPresent/studentsAbsent are only a derived export of the entries
+    conn.execute(
+        "UPDATE attendance_sessions SET isActive = ?, timeEnded = ?, studentsPresent = ?, studentsAbsent = ? WHERE id = ?",
+        ("false", now, json.dumps(present), json.dumps(absent), row_id),
+    )
+    return present, absent, entries
+
+
+def _finish_session(conn, info):
+    """Local side of /session/stop; Firestore writes are queued in the outbox."""
+    row_id = info["row_id"]
+    now = info["timeEnded"]
+    present, absent, entries = _close_session_rows(conn, row_id, info["class_id"], now)
+    # per-student attendance docs for every entry of the session
+    if outbox is not None:
+        outbox.enqueue_op(conn, "session_attendance", row_id, None, now)
+    else:
+        _enqueue_outbox(conn, row_id, info["class_id"], info["teacher_id"], now)
+
+    # kiosk/room and display names are read on the writer connection so the
+    # whole stop is one transaction
+    kiosk_fs_id, room_fs_id = _local_kiosk(conn)
+    room_id = info["room_id"] if info["room_id"] is not None else room_fs_id
+    class_name = info["class_name"]
+    teacher_name = info["teacher_name"]
+    try:
+        if not class_name:
+            meta = state.get_class_meta(info["class_id"], conn)
+            if meta:
+                class_name = meta[3]
+        if not teacher_name:
+            r2 = conn.execute("SELECT firstname, lastname FROM teachers WHERE id = ?", (info["teacher_id"],)).fetchone()
+            if r2:
+                teacher_name = (r2[0] or "") + (" " + (r2[1] or "") if r2[1] else "")
+    except Exception:
+        pass
+    # Keep the actual room FS id in roomId and include a human-readable roomLabel
+    room_label = None
+    if teacher_name or class_name:
+        room_label = f"{teacher_name or ''} - {class_name or ''}".strip(" -")
+
+    raw_doc = info["raw_doc"]
+    students_present_total = len(present)
+    conn.execute(
+        "INSERT INTO session_history (kiosk_fs_id, room_fs_id, class_id, class_name, students_present_total, timeStarted, timeEnded, teacher_id, date, raw_doc, createdAt) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (kiosk_fs_id, room_fs_id, info["class_id"], class_name, students_present_total, info["timeStarted"], now, info["teacher_id"], info["date"], raw_doc, now),
+    )
+    if outbox is None:
+        return
+
+    session_doc = {
+        "classId": info["class_id"],
+        "teacherId": info["teacher_id"],
+        "date": info["date"] if info["date"] is not None else now,
+        "isActive": False,
+        # prefer the stored room id from the session row (row_roomId/room_fs_id)
+        "roomId": room_id,
+        # include a human-readable label for convenience
+        "roomLabel": room_label,
+        "studentsPresent": present,
+        "studentsAbsent": absent,
+        "timeStarted": info["timeStarted"],
+        "timeEnded": now,
+        "entries": entries,
+    }
+    outbox.enqueue_op(conn, "session_upsert", row_id, {"doc": session_doc, "merge": False}, now)
+    history_doc = {
+        "kiosk_fs_id": kiosk_fs_id,
+        "room_fs_id": room_fs_id,
+        "class_name": class_name,
+        "students_present_total": students_present_total,
+        "timeStarted": info["timeStarted"],
+        "timeEnded": now,
+        "teacher_id": info["teacher_id"],
+        "date": info["date"],
+        "raw_doc": json.loads(raw_doc) if raw_doc else None,
+        "createdAt": now,
+    }
+    # the doc id is fixed at enqueue time so a retried push cannot duplicate the entry
+    outbox.enqueue_op(conn, "session_history_add", row_id, {"doc_id": uuid.uuid4().hex, "doc": history_doc}, now)
+
+    # Also persist the session document locally into attendance_sessions_fs so
+    # tools that read the local Firestore mirror table see the new session immediately
+    doc_id = info.get("fs_doc_id") or outbox.session_doc_id_for(conn, row_id)
+    _upsert_session_fs(
+        conn,
+        (
+            doc_id,
+            session_doc.get("classId"),
+            session_doc.get("teacherId"),
+            session_doc.get("date"),
+            str(session_doc.get("isActive")),
+            session_doc.get("roomId"),
+            json.dumps(session_doc.get("studentsPresent") or []),
+            json.dumps(session_doc.get("studentsAbsent") or []),
+            session_doc.get("timeStarted"),
+            session_doc.get("timeEnded"),
+            json.dumps({}),
+        ),
+    )
+
+
+def _record_mark(conn, row_id, student_id, time_logged, status, now_iso, student_doc):
+    """Record a student's entry; returns False when they were already marked."""
+    cur = conn.execute(
+        """
+        INSERT INTO attendance_entries (session_id, student_id, timeLogged, status, created_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (session_id, student_id) DO UPDATE SET
+            timeLogged = excluded.timeLogged, status = excluded.status, created_at = excluded.created_at
+        WHERE attendance_entries.status NOT IN ('present', 'late')
+        """,
+        (row_id, student_id, time_logged, status, now_iso),
+    )
+    if cur.rowcount == 0:
+        return False
+    if outbox is None:
+        return True
+    outbox.enqueue_op(conn, "student_attendance", row_id, {"student_id": str(student_id), "doc": student_doc}, now_iso)
+    # add to the session doc's studentsPresent; marks in one outbox window are
+    # folded into a single ArrayUnion update instead of whole-array rewrites
+    outbox.enqueue_op(conn, "session_present_add", row_id, {"student_id": student_id}, now_iso)
+    return True
+
+
+def _enqueue_outbox(conn, row_id, cid, tid, now):
+    cur = conn.cursor()
+    # create a minimal compatible outbox table if it doesn't exist
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS attendance_sessions_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            local_session_id INTEGER,
+            queued_at TEXT,
+            status TEXT,
+            attempts INTEGER DEFAULT 0
+        )
+    """
+    )
+
+    # Check actual columns to support older/alternate schemas
+    cols = [c[1] for c in cur.execute("PRAGMA table_info(attendance_sessions_outbox)").fetchall()]
+
+    if "local_session_id" in cols:
+        # preferred schema: store local_session_id
+        cur.execute(
+            "INSERT INTO attendance_sessions_outbox (local_session_id, queued_at, status, attempts) VALUES (?, ?, ?, ?)",
+            (row_id, now, "queued", 0),
+        )
+    else:
+        # fallback: store minimal info into the existing schema (map fields if available)
+        # try common alternative columns: local_id/class_id/teacher_id/created_at
+        if "created_at" in cols and "class_id" in cols and "teacher_id" in cols:
+            raw = json.dumps({"local_session_id": row_id})
+            cur.execute(
+                "INSERT INTO attendance_sessions_outbox (class_id, teacher_id, created_at, status, attempts, raw_doc) VALUES (?, ?, ?, ?, ?, ?)",
+                (cid, tid, now, "queued", 0, raw),
+            )
+        else:
+            # last resort: attempt a very small insert into status/created_at if available
+            if "created_at" in cols and "status" in cols:
+                cur.execute(
+                    "INSERT INTO attendance_sessions_outbox (created_at, status, attempts) VALUES (?, ?, ?)",
+                    (now, "queued", 0),
+                )
+            else:
+                # If schema is unexpected, create a simple compatible table alongside and insert there
+                cur.execute(
+                    "CREATE TABLE IF NOT EXISTS attendance_sessions_outbox_v2 (id INTEGER PRIMARY KEY AUTOINCREMENT, local_session_id INTEGER, queued_at TEXT, status TEXT, attempts INTEGER DEFAULT 0)"
+                )
+                cur.execute(
+                    "INSERT INTO attendance_sessions_outbox_v2 (local_session_id, queued_at, status, attempts) VALUES (?, ?, ?, ?)",
+                    (row_id, now, "queued", 0),
+                )
+
+
+def _parse_started(time_started):
+    if not time_started:
+        return None
+    try:
+        return datetime.strptime(time_started, "%Y-%m-%dT%H:%M:%S%z")
+    except Exception:
+        # fallback: parse without timezone
+        try:
+            return datetime.strptime(time_started.split('+')[0], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+        except Exception:
+            return None
+
+
+class SessionRoster:
+    """In-memory view of the active session, written through to SQLite.
+
+    Holds the enrolled/present/late/absent sets and the attendance_sessions row
+    id so marks and /session/attendance polls are dictionary operations; every
+    change is persisted with state.run_write before it is applied here.
+    """
+
+    def __init__(self, row_id, teacher_id, class_id, time_started, room_id=None, raw_doc=None, fs_doc_id=None):
+        self.row_id = row_id
+        self.teacher_id = teacher_id
+        self.class_id = class_id
+        self.time_started = time_started
+        self.started_dt = _parse_started(time_started)
+        self.room_id = room_id
+        self.raw_doc = raw_doc
+        self.fs_doc_id = fs_doc_id
+        # class_students of the class; empty when the roster is not cached
+        self.enrolled = set()
+        # student_id -> timeLogged, in mark order
+        self.present = {}
+        self.late = set()
+        self.absent = set()
+        # student_id -> Event set when their in-flight mark write finishes
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, conn, row):
+        """Build a roster from an attendance_sessions row (id, class_id, teacher_id, timeStarted, roomId, raw_doc, fs_doc_id)."""
+        roster = cls(row[0], row[2], row[1], row[3], row[4], row[5], row[6])
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT student_id FROM class_students WHERE class_id = ?", (roster.class_id,))
+            roster.enrolled = {str(r[0]) for r in cur.fetchall()}
+        except Exception:
+            pass
+        cur.execute(
+            "SELECT student_id, status, timeLogged FROM attendance_entries WHERE session_id = ? ORDER BY id",
+            (roster.row_id,),
+        )
+        for student_id, status, time_logged in cur.fetchall():
+            roster._apply(student_id, status, time_logged)
+        return roster
+
+    def _apply(self, student_id, status, time_logged):
+        if status in PRESENT_STATUSES:
+            self.present[student_id] = time_logged
+            self.absent.discard(student_id)
+            if status == "late":
+                self.late.add(student_id)
+        elif status == "absent":
+            self.absent.add(student_id)
+
+    def is_marked(self, student_id):
+        return student_id in self.present
+
+    def is_enrolled(self, student_id):
+        """Whether the student is on the class list; None when it is not cached."""
+        if not self.enrolled:
+            return None
+        return str(student_id) in self.enrolled
+
+    def status_for(self, now_dt):
+        """present within the first minutes of the session, late afterwards."""
+        status = "present"
+        try:
+            if self.started_dt is not None:
+                diff_minutes = (now_dt - self.started_dt).total_seconds() / 60.0
+                if diff_minutes < 0.20:
+                    status = "present"
+                elif diff_minutes >= 0.33:
+                    status = "late"
+        except Exception:
+            status = "present"
+        return status
+
+    def mark(self, student_id, status, time_logged, now_iso, student_doc):
+        """Persist then record a mark; returns False if the student was already marked."""
+        # reserve the student, then wait on the writer without the lock so
+        # snapshot() polls are not queued behind the write
+        while True:
+            with self.lock:
+                if student_id in self.present:
+                    return False
+                waiter = self.pending.get(student_id)
+                if waiter is None:
+                    done = self.pending[student_id] = threading.Event()
+                    break
+            # another mark of this student is in flight; if its write fails
+            # this one retries instead of reporting "already marked"
+            waiter.wait()
+        written = False
+        try:
+            marked = state.run_write(_record_mark, self.row_id, student_id, time_logged, status, now_iso, student_doc)
+            written = True
+        finally:
+            with self.lock:
+                del self.pending[student_id]
+                if written:
+                    self._apply(student_id, status, time_logged)
+            done.set()
+        if marked and outbox is not None:
+            outbox.notify_enqueued(coalesce=True)
+        return marked
+
+    def snapshot(self):
+        with self.lock:
+            return {"studentsPresent": list(self.present), "studentsAbsent": sorted(self.absent)}
+
+
+_roster = None
+_roster_lock = threading.Lock()
+
+_ACTIVE_ROW_SQL = "SELECT id, class_id, teacher_id, timeStarted, roomId, raw_doc, fs_doc_id FROM attendance_sessions WHERE teacher_id = ? AND class_id = ? AND isActive = ? ORDER BY id DESC LIMIT 1"
+
+
+def active_roster():
+    """Return the roster for state.current_session, rebuilding it from SQLite if needed."""
+    global _roster
+    tid = state.current_session.get("teacher_id")
+    cid = state.current_session.get("class_id")
+    if not tid or not cid:
+        return None
+    roster = _roster
+    if roster is not None and roster.teacher_id == tid and roster.class_id == cid:
+        return roster
+    with _roster_lock:
+        if _roster is not None and _roster.teacher_id == tid and _roster.class_id == cid:
+            return _roster
+        state.ensure_schema(_ensure_attendance_table)
+        conn = state.get_read_db()
+        try:
+            row = conn.execute(_ACTIVE_ROW_SQL, (tid, cid, "true")).fetchone()
+            _roster = SessionRoster.load(conn, row) if row else None
+        finally:
+            conn.close()
+        return _roster
+
+
+def _set_roster(roster):
+    global _roster
+    with _roster_lock:
+        _roster = roster
+
+
+def restore_active_session():
+    """Rebuild state.current_session and the roster from the latest active session row on startup."""
+    try:
+        state.ensure_schema(_ensure_attendance_table)
+        conn = state.get_read_db()
+        try:
+            row = conn.execute(
+                "SELECT id, class_id, teacher_id, timeStarted, roomId, raw_doc, fs_doc_id FROM attendance_sessions WHERE isActive = ? ORDER BY id DESC LIMIT 1",
+                ("true",),
+            ).fetchone()
+            if not row:
+                return None
+            roster = SessionRoster.load(conn, row)
+        finally:
+            conn.close()
+        try:
+            body = json.loads(row[5]) if row[5] else {}
+        except Exception:
+            body = {}
+        state.current_session["teacher_id"] = roster.teacher_id
+        state.current_session["teacher_name"] = body.get("teacher_name")
+        state.current_session["class_id"] = roster.class_id
+        state.current_session["class_name"] = body.get("class_name")
+        _set_roster(roster)
+        print(f"restored active session {roster.row_id} ({len(roster.present)} marked)")
+        return roster
+    except Exception as e:
+        print("restore_active_session failed:", e)
+        return None
+
+
+# recent marks (manual and automatic) for the UI to pick up via /session/events
+EVENTS_MAX = 200
+_events = deque(maxlen=EVENTS_MAX)
+_events_lock = threading.Lock()
+_event_seq = 0
+
+
+def _push_event(event):
+    global _event_seq
+    with _events_lock:
+        _event_seq += 1
+        event["id"] = _event_seq
+        _events.append(event)
+    return event
+
+
+def _mark_with_roster(roster, student_id, student_name=None, source="manual"):
+    """Mark a student through the roster; returns True when a new entry was recorded."""
+    if roster.is_marked(student_id):
+        return False
+    try:
+        now_dt = datetime.now(timezone.utc)
+        now_iso = now_dt.isoformat()
+    except Exception:
+        now_iso = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+        try:
+            now_dt = datetime.strptime(now_iso, "%Y-%m-%dT%H:%M:%S%z")
+        except Exception:
+            now_dt = datetime.now()
+
+    # present if marked within the first minutes of the session, late afterwards
+    status = roster.status_for(now_dt)
+    time_logged_val = now_iso if status in PRESENT_STATUSES else None
+    student_doc = {
+        "classId": roster.class_id,
+        "teacherId": roster.teacher_id,
+        "roomId": roster.room_id,
+        "date": now_iso,
+        "timeLogged": time_logged_val,
+        "status": status,
+    }
+    # write-through: the entry and its Firestore writes are persisted by
+    # the db writer before the roster records the mark
+    if not roster.mark(student_id, status, time_logged_val, now_iso, student_doc):
+        return False
+    # marks of students outside the class list are kept but flagged for the UI
+    enrolled = roster.is_enrolled(student_id)
+    if enrolled is False:
+        print(f"student {student_id} marked in class {roster.class_id} is not enrolled in it")
+    _push_event({
+        "type": "marked",
+        "source": source,
+        "student_id": student_id,
+        "student_name": student_name,
+        "status": status,
+        "timeLogged": time_logged_val,
+        "session_id": roster.row_id,
+        "enrolled": enrolled,
+    })
+    return True
+
+
+def auto_mark(student_id, student_name=None):
+    """Mark a student straight from the recognition worker (AUTO_MARK mode)."""
+    try:
+        roster = active_roster()
+        if roster is None:
+            return False
+        return _mark_with_roster(roster, student_id, student_name, source="auto")
+    except Exception as e:
+        print("auto_mark failed:", e)
+        return False
 
 
 @router.get("/session")
@@ -96,7 +666,7 @@ def get_session():
 def get_classes_for_teacher(teacher_id: str):
     """Return classes for a given teacher id from the local sqlite DB."""
     try:
-        conn = state.get_db()
+        conn = state.get_read_db()
         cur = conn.cursor()
         cur.execute("SELECT id, name, subjectName, gradeLevel, section FROM classes WHERE teacher_id = ?", (teacher_id,))
         rows = cur.fetchall()
@@ -184,165 +754,30 @@ async def start_session(request: Request):
         state.current_session["class_id"] = class_id
         state.current_session["class_name"] = class_name
 
-        # persist to local DB
-        conn = state.get_db()
-        _ensure_attendance_table(conn)
+        # persist to local DB (reads here, the insert goes through the db writer)
+        state.ensure_schema(_ensure_attendance_table)
+        conn = state.get_read_db()
         # determine kiosk fs id and assigned room (best-effort)
-        kiosk_fs_id = None
-        room_fs_id = None
-        try:
-            serial_local = _read_rpi_serial()
-            if serial_local:
-                try:
-                    cur_loc = conn.cursor()
-                    cur_loc.execute("SELECT fs_id, assignedRoomId FROM kiosks_fs WHERE serialNumber = ?", (serial_local,))
-                    kro = cur_loc.fetchone()
-                    if kro:
-                        kiosk_fs_id = kro[0]
-                        room_fs_id = kro[1]
-                except Exception:
-                    pass
-            if not kiosk_fs_id:
-                try:
-                    cur_loc = conn.cursor()
-                    cur_loc.execute("SELECT fs_id, assignedRoomId FROM kiosks_fs LIMIT 1")
-                    kro = cur_loc.fetchone()
-                    if kro:
-                        kiosk_fs_id = kro[0]
-                        room_fs_id = kro[1]
-                except Exception:
-                    pass
-        except Exception:
-            pass
+        kiosk_fs_id, room_fs_id = _local_kiosk(conn)
         # use timezone-aware ISO format for timestamps
         try:
             now = time.strftime("%Y-%m-%dT%H:%M:%S%z")
         except Exception:
             now = time.strftime("%Y-%m-%dT%H:%M:%S%z")
-        conn.execute(
-            "INSERT INTO attendance_sessions (class_id, teacher_id, date, isActive, roomId, studentsPresent, studentsAbsent, timeStarted, raw_doc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (class_id, teacher_id, now, "true", room_fs_id, json.dumps([]), json.dumps([]), now, json.dumps(body)),
+        # insert the session row, mirror it locally and queue the Firestore
+        # upsert in one writer command; the outbox sends it in the background.
+        # The wait on the writer queue runs off the event loop.
+        row_id, fs_doc_id = await run_in_threadpool(
+            state.run_write, _create_session_rows, class_id, teacher_id, room_fs_id, now, body
         )
-        conn.commit()
-        # mirror the session to Firestore immediately (best-effort)
-        try:
-            db_fs = getattr(sync, "db_fs", None) if sync is not None else None
-            # build a deterministic doc id similar to stop_session logic
-            doc_id = None
-            if db_fs:
-                try:
-                    def _sanitize(s: str) -> str:
-                        if not s:
-                            return ""
-                        return "".join(c for c in s.replace(" ", "_") if (c.isalnum() or c in "-__")).strip("_")
-
-                    class_part = None
-                    try:
-                        conn2 = state.get_db()
-                        cur2 = conn2.cursor()
-                        cur2.execute("SELECT subjectName, gradeLevel, section, name FROM classes WHERE id = ?", (class_id,))
-                        rclass = cur2.fetchone()
-                        if rclass:
-                            subject, grade, section, cname = rclass[0], rclass[1], rclass[2], rclass[3]
-                            parts = []
-                            if subject:
-                                parts.append(str(subject))
-                            if section:
-                                parts.append(str(section))
-                            if grade:
-                                parts.append(str(grade))
-                            class_part = "_".join(parts) if parts else (cname or None)
-                        try:
-                            conn2.close()
-                        except Exception:
-                            pass
-                    except Exception:
-                        try:
-                            if conn2:
-                                conn2.close()
-                        except Exception:
-                            pass
+        if outbox is not None:
+            outbox.notify_enqueued()
 
-                    date_part = str(now).split("T")[0]
-                    if class_part:
-                        class_part = _sanitize(class_part)[:120]
-                    else:
-                        class_part = _sanitize(class_name)[:120] if class_name else "unknown_class"
-                    doc_id = f"{class_part}_{date_part}"
-
-                    session_doc = {
-                        "classId": class_id,
-                        "teacherId": teacher_id,
-                        "date": now,
-                        "isActive": True,
-                        "roomId": room_fs_id,
-                        "studentsPresent": [],
-                        "studentsAbsent": [],
-                        "timeStarted": now,
-                        "timeEnded": None,
-                        "entries": [],
-                        "raw_doc": body,
-                    }
-                    try:
-                        db_fs.collection("attendance_sessions").document(doc_id).set(session_doc)
-                    except Exception:
-                        pass
-
-                    # mirror to local attendance_sessions_fs table as well
-                    try:
-                        loc_conn = state.get_db()
-                        loc_cur = loc_conn.cursor()
-                        loc_cur.execute(
-                            """
-                            CREATE TABLE IF NOT EXISTS attendance_sessions_fs (
-                                fs_id TEXT PRIMARY KEY,
-                                class_id TEXT,
-                                teacher_id TEXT,
-                                date TEXT,
-                                isActive TEXT,
-                                roomId TEXT,
-                                studentsPresent JSON,
-                                studentsAbsent JSON,
-                                timeStarted TEXT,
-                                timeEnded TEXT,
-                                raw_doc JSON
-                            )
-                        """
-                        )
-                        try:
-                            loc_cur.execute(
-                                "INSERT OR REPLACE INTO attendance_sessions_fs (fs_id, class_id, teacher_id, date, isActive, roomId, studentsPresent, studentsAbsent, timeStarted, timeEnded, raw_doc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                                (
-                                    doc_id,
-                                    class_id,
-                                    teacher_id,
-                                    now,
-                                    str(True),
-                                    room_fs_id,
-                                    json.dumps([]),
-                                    json.dumps([]),
-                                    now,
-                                    None,
-                                    json.dumps(body),
-                                ),
-                            )
-                            loc_conn.commit()
-                        except Exception:
-                            try:
-                                loc_conn.rollback()
-                            except Exception:
-                                pass
-                        try:
-                            loc_conn.close()
-                        except Exception:
-                            pass
-                    except Exception:
-                        pass
-                except Exception:
-                    doc_id = None
+        # materialize the in-memory roster for marks and attendance polls
+        try:
+            _set_roster(SessionRoster.load(conn, (row_id, class_id, teacher_id, now, room_fs_id, json.dumps(body), fs_doc_id)))
         except Exception:
-            pass
-
+            _set_roster(None)
         conn.close()
 
         return {"status": "started", "session": state.current_session}
@@ -369,412 +804,40 @@ def stop_session():
         except Exception:
             return JSONResponse(content={"error": "teacher_reauthentication_required", "reason": "recognition_unavailable"}, status_code=503)
 
-        conn = state.get_db()
-        _ensure_attendance_table(conn)
-        now = time.strftime("%Y-%m-%dT%H:%M:%S%z")
-
-        # fetch the most recent active session row for this teacher+class
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, class_id, teacher_id, date, isActive, roomId, studentsPresent, studentsAbsent, timeStarted, timeEnded, raw_doc FROM attendance_sessions WHERE teacher_id = ? AND class_id = ? AND isActive = ? ORDER BY id DESC LIMIT 1",
-            (tid, cid, "true"),
-        )
-        row = cur.fetchone()
-
-        if not row:
-            conn.close()
+        roster = active_roster()
+        if roster is None:
             return {"status": "stopped", "warning": "no_active_row_found"}
 
-        # Map columns according to SELECT above
-        row_id = row[0]
-        # class_id = row[1]
-        # teacher_id = row[2]
-        session_date = row[3]
-        # isActive = row[4]
-        row_roomId = row[5]
-        studentsPresent_json = row[6]
-        studentsAbsent_json = row[7]
-        timeStarted = row[8]
-        # timeEnded = row[9]
-        raw_doc = row[10]
-        try:
-            present = json.loads(studentsPresent_json) if studentsPresent_json else []
-        except Exception:
-            present = []
-
-        # compute absentees from class_students
-        try:
-            cur.execute("SELECT student_id FROM class_students WHERE class_id = ?", (cid,))
-            enrolled_rows = cur.fetchall()
-            enrolled = [r[0] for r in enrolled_rows] if enrolled_rows else []
-        except Exception:
-            enrolled = []
-
-        absent = [s for s in enrolled if s not in present]
+        row_id = roster.row_id
+        row_roomId = roster.room_id
+        timeStarted = roster.time_started
+        raw_doc = roster.raw_doc
+        now = time.strftime("%Y-%m-%dT%H:%M:%S%z")
 
-        # update attendance_sessions row: set studentsAbsent, isActive=false, timeEnded
-        cur.execute(
-            "UPDATE attendance_sessions SET studentsAbsent = ?, isActive = ?, timeEnded = ? WHERE id = ?",
-            (json.dumps(absent), "false", now, row_id),
+        # close the session row, record absentees, write session_history and
+        # queue every Firestore write (per-student attendance, the session
+        # document and the history entry) in one writer command
+        state.run_write(
+            _finish_session,
+            {
+                "row_id": row_id,
+                "fs_doc_id": roster.fs_doc_id,
+                "class_id": cid,
+                "teacher_id": tid,
+                "class_name": state.current_session.get("class_name") or None,
+                "teacher_name": state.current_session.get("teacher_name") or None,
+                "room_id": row_roomId,
+                "date": timeStarted,
+                "timeStarted": timeStarted,
+                "timeEnded": now,
+                "raw_doc": raw_doc,
+            },
         )
-        conn.commit()
-
-        # insert attendance_entries for absent students (no timeLogged)
-        try:
-            for sid in absent:
-                try:
-                    cur.execute(
-                        "INSERT OR REPLACE INTO attendance_entries (session_id, student_id, timeLogged, status, created_at) VALUES (?, ?, ?, ?, ?)",
-                        (row_id, sid, None, "absent", now),
-                    )
-                except Exception:
-                    pass
-            conn.commit()
-        except Exception:
-            pass
-
-        # enqueue outbox row to push per-student attendance to Firestore (non-blocking)
-        try:
-            # create a minimal compatible outbox table if it doesn't exist
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS attendance_sessions_outbox (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    local_session_id INTEGER,
-                    queued_at TEXT,
-                    status TEXT,
-                    attempts INTEGER DEFAULT 0
-                )
-            """
-            )
-
-            # Check actual columns to support older/alternate schemas
-            cols = [c[1] for c in cur.execute("PRAGMA table_info(attendance_sessions_outbox)").fetchall()]
-
-            if "local_session_id" in cols:
-                # preferred schema: store local_session_id
-                cur.execute(
-                    "INSERT INTO attendance_sessions_outbox (local_session_id, queued_at, status, attempts) VALUES (?, ?, ?, ?)",
-                    (row_id, now, "queued", 0),
-                )
-            else:
-                # fallback: store minimal info into the existing schema (map fields if available)
-                # try common alternative columns: local_id/class_id/teacher_id/created_at
-                if "created_at" in cols and "class_id" in cols and "teacher_id" in cols:
-                    raw = json.dumps({"local_session_id": row_id})
-                    cur.execute(
-                        "INSERT INTO attendance_sessions_outbox (class_id, teacher_id, created_at, status, attempts, raw_doc) VALUES (?, ?, ?, ?, ?, ?)",
-                        (cid, tid, now, "queued", 0, raw),
-                    )
-                else:
-                    # last resort: attempt a very small insert into status/created_at if available
-                    if "created_at" in cols and "status" in cols:
-                        cur.execute(
-                            "INSERT INTO attendance_sessions_outbox (created_at, status, attempts) VALUES (?, ?, ?)",
-                            (now, "queued", 0),
-                        )
-                    else:
-                        # If schema is unexpected, create a simple compatible table alongside and insert there
-                        cur.execute(
-                            "CREATE TABLE IF NOT EXISTS attendance_sessions_outbox_v2 (id INTEGER PRIMARY KEY AUTOINCREMENT, local_session_id INTEGER, queued_at TEXT, status TEXT, attempts INTEGER DEFAULT 0)"
-                        )
-                        cur.execute(
-                            "INSERT INTO attendance_sessions_outbox_v2 (local_session_id, queued_at, status, attempts) VALUES (?, ?, ?, ?)",
-                            (row_id, now, "queued", 0),
-                        )
-            conn.commit()
-        except Exception as e:
-            print(f"Warning: failed to enqueue attendance outbox: {e}")
-
-        # Persist a session_history summary row locally
-        try:
-            # ensure table exists
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS session_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    kiosk_fs_id TEXT,
-                    room_fs_id TEXT,
-                    class_id TEXT,
-                    class_name TEXT,
-                    students_present_total INTEGER,
-                    timeStarted TEXT,
-                    timeEnded TEXT,
-                    teacher_id TEXT,
-                    date TEXT,
-                    raw_doc JSON,
-                    createdAt TEXT
-                )
-            """
-            )
-
-            # determine kiosk fs id and assigned room (best-effort)
-            kiosk_fs_id = None
-            room_fs_id = None
-            try:
-                serial_local = _read_rpi_serial()
-                if serial_local:
-                    try:
-                        cur.execute("SELECT fs_id, assignedRoomId FROM kiosks_fs WHERE serialNumber = ?", (serial_local,))
-                        kro = cur.fetchone()
-                        if kro:
-                            kiosk_fs_id = kro[0]
-                            room_fs_id = kro[1]
-                    except Exception:
-                        pass
-                if not kiosk_fs_id:
-                    try:
-                        cur.execute("SELECT fs_id, assignedRoomId FROM kiosks_fs LIMIT 1")
-                        kro = cur.fetchone()
-                        if kro:
-                            kiosk_fs_id = kro[0]
-                            room_fs_id = kro[1]
-                    except Exception:
-                        pass
-            except Exception:
-                pass
-
-            # determine class name if possible
-            class_name = state.current_session.get("class_name") or None
-            if not class_name:
-                try:
-                    cur.execute("SELECT name FROM classes WHERE id = ?", (cid,))
-                    cr = cur.fetchone()
-                    if cr:
-                        class_name = cr[0]
-                except Exception:
-                    pass
-
-            # fetch the session date if present
-            session_date = None
-            try:
-                cur.execute("SELECT date FROM attendance_sessions WHERE id = ?", (row_id,))
-                dr = cur.fetchone()
-                if dr:
-                    session_date = dr[0]
-            except Exception:
-                session_date = None
-
-            students_present_total = len(present) if present is not None else 0
-
-            cur.execute(
-                "INSERT INTO session_history (kiosk_fs_id, room_fs_id, class_id, class_name, students_present_total, timeStarted, timeEnded, teacher_id, date, raw_doc, createdAt) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (kiosk_fs_id, room_fs_id, cid, class_name, students_present_total, timeStarted, now, tid, session_date, raw_doc, now),
-            )
-            conn.commit()
-            # attempt to push history to Firestore (best-effort)
-            try:
-                db_fs = getattr(sync, "db_fs", None) if sync is not None else None
-                if db_fs:
-                    doc = {
-                        "kiosk_fs_id": kiosk_fs_id,
-                        "room_fs_id": room_fs_id,
-                        "class_name": class_name,
-                        "students_present_total": students_present_total,
-                        "timeStarted": timeStarted,
-                        "timeEnded": now,
-                        "teacher_id": tid,
-                        "date": session_date,
-                        "raw_doc": json.loads(raw_doc) if raw_doc else None,
-                        "createdAt": now,
-                    }
-                    try:
-                        # use Firestore auto-id to avoid collisions
-                        db_fs.collection("session_history").add(doc)
-                    except Exception:
-                        # ignore failures
-                        pass
-            except Exception:
-                pass
-        except Exception as e:
-            print(f"Warning: failed to persist session_history: {e}")
-
-        conn.close()
-        # attempt to push the full attendance session document to Firestore _attendance_sessions
-        try:
-            db_fs = getattr(sync, "db_fs", None) if sync is not None else None
-            if db_fs:
-                # gather entries
-                conn2 = state.get_db()
-                cur2 = conn2.cursor()
-                cur2.execute("SELECT student_id, timeLogged, status, created_at FROM attendance_entries WHERE session_id = ?", (row_id,))
-                entries_rows = cur2.fetchall()
-                conn2.close()
-
-                entries = []
-                for r in entries_rows:
-                    entries.append({"student_id": r[0], "timeLogged": r[1], "status": r[2], "created_at": r[3]})
-
-                session_doc = {
-                    "classId": cid,
-                    "teacherId": tid,
-                    "date": session_date if session_date is not None else now,
-                    "isActive": False,
-                    "roomId": row_roomId if row_roomId is not None else room_fs_id,
-                    "studentsPresent": present,
-                    "studentsAbsent": absent,
-                    "timeStarted": timeStarted,
-                    "timeEnded": now,
-                    "entries": entries,
-                    "raw_doc": json.loads(raw_doc) if raw_doc else None,
-                }
-                try:
-                    # Build a deterministic Firestore document id using class name + date (date portion only).
-                    # Prefer the in-memory state class_name/teacher_name; fall back to DB lookups if missing.
-                    class_name = state.current_session.get("class_name") or None
-                    teacher_name = state.current_session.get("teacher_name") or None
-                    if not class_name or not teacher_name:
-                        # attempt to read from local DB
-                        try:
-                            conn3 = state.get_db()
-                            cur3 = conn3.cursor()
-                            if not class_name:
-                                cur3.execute("SELECT name FROM classes WHERE id = ?", (cid,))
-                                r = cur3.fetchone()
-                                if r:
-                                    class_name = r[0]
-                            if not teacher_name:
-                                cur3.execute("SELECT firstname, lastname FROM teachers WHERE id = ?", (tid,))
-                                r2 = cur3.fetchone()
-                                if r2:
-                                    teacher_name = (r2[0] or "") + (" " + (r2[1] or "") if r2[1] else "")
-                            conn3.close()
-                        except Exception:
-                            try:
-                                if conn3:
-                                    conn3.close()
-                            except Exception:
-                                pass
-
-                    # Build doc id from class metadata: subjectName, gradeLevel, section + date
-                    def _sanitize(s: str) -> str:
-                        if not s:
-                            return ""
-                        return "".join(c for c in s.replace(" ", "_") if (c.isalnum() or c in "-__")).strip("_")
-
-                    # prefer class subject/grade/section for id to meet requirement
-                    class_part = None
-                    try:
-                        conn3 = state.get_db()
-                        cur3 = conn3.cursor()
-                        cur3.execute("SELECT subjectName, gradeLevel, section, name FROM classes WHERE id = ?", (cid,))
-                        rclass = cur3.fetchone()
-                        if rclass:
-                            subject, grade, section, cname = rclass[0], rclass[1], rclass[2], rclass[3]
-                            parts = []
-                            if subject:
-                                parts.append(str(subject))
-                            if section:
-                                parts.append(str(section))
-                            if grade:
-                                parts.append(str(grade))
-                            class_part = "_".join(parts) if parts else (cname or None)
-                        conn3.close()
-                    except Exception:
-                        try:
-                            if conn3:
-                                conn3.close()
-                        except Exception:
-                            pass
-
-                    date_str = session_doc.get("date") or now
-                    date_part = str(date_str).split("T")[0]
-                    if class_part:
-                        class_part = _sanitize(class_part)[:120]
-                    else:
-                        class_part = _sanitize(class_name)[:120] if class_name else "unknown_class"
-                    doc_id = f"{class_part}_{date_part}"
-
-                    # Keep the actual room FS id in roomId and include a human-readable roomLabel
-                    room_label = None
-                    if teacher_name or class_name:
-                        tn = teacher_name or ""
-                        cn = class_name or ""
-                        room_label = f"{tn} - {cn}".strip(" -")
-
-                    session_doc_clean = {
-                        "classId": session_doc.get("classId"),
-                        "teacherId": session_doc.get("teacherId"),
-                        "date": session_doc.get("date"),
-                        "isActive": session_doc.get("isActive"),
-                        # prefer the stored room id from the session row (row_roomId/room_fs_id)
-                        "roomId": session_doc.get("roomId"),
-                        # include a human-readable label for convenience
-                        "roomLabel": room_label,
-                        "studentsPresent": session_doc.get("studentsPresent"),
-                        "studentsAbsent": session_doc.get("studentsAbsent"),
-                        "timeStarted": session_doc.get("timeStarted"),
-                        "timeEnded": session_doc.get("timeEnded"),
-                        "entries": session_doc.get("entries", []),
-                    }
-
-                    try:
-                        dbfs_collection = db_fs.collection("attendance_sessions")
-                        dbfs_collection.document(doc_id).set(session_doc_clean)
-                    except Exception as e:
-                        # Firestore push failed; log and continue — outbox will attempt per-student push
-                        print(f"Warning: failed to push attendance session to Firestore: {e}")
-                    # Also persist the session document locally into attendance_sessions_fs so
-                    # tools that read the local Firestore mirror table see the new session immediately
-                    try:
-                        loc_conn = state.get_db()
-                        loc_cur = loc_conn.cursor()
-                        loc_cur.execute(
-                            """
-                            CREATE TABLE IF NOT EXISTS attendance_sessions_fs (
-                                fs_id TEXT PRIMARY KEY,
-                                class_id TEXT,
-                                teacher_id TEXT,
-                                date TEXT,
-                                isActive TEXT,
-                                roomId TEXT,
-                                studentsPresent JSON,
-                                studentsAbsent JSON,
-                                timeStarted TEXT,
-                                timeEnded TEXT,
-                                raw_doc JSON
-                            )
-                        """
-                        )
-                        try:
-                            loc_cur.execute(
-                                "INSERT OR REPLACE INTO attendance_sessions_fs (fs_id, class_id, teacher_id, date, isActive, roomId, studentsPresent, studentsAbsent, timeStarted, timeEnded, raw_doc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                                (
-                                    doc_id,
-                                    session_doc_clean.get("classId"),
-                                    session_doc_clean.get("teacherId"),
-                                    session_doc_clean.get("date"),
-                                    str(session_doc_clean.get("isActive")),
-                                    session_doc_clean.get("roomId"),
-                                    json.dumps(session_doc_clean.get("studentsPresent") or []),
-                                    json.dumps(session_doc_clean.get("studentsAbsent") or []),
-                                    session_doc_clean.get("timeStarted"),
-                                    session_doc_clean.get("timeEnded"),
-                                    json.dumps(session_doc_clean.get("raw_doc") or {}),
-                                ),
-                            )
-                            loc_conn.commit()
-                            try:
-                                print(f"Mirrored session to local attendance_sessions_fs: {doc_id}")
-                            except Exception:
-                                pass
-                        except Exception:
-                            try:
-                                loc_conn.rollback()
-                            except Exception:
-                                pass
-                        try:
-                            loc_conn.close()
-                        except Exception:
-                            pass
-                    except Exception:
-                        pass
-                except Exception:
-                    pass
-        except Exception:
-            pass
+        if outbox is not None:
+            outbox.notify_enqueued()
 
         # finally clear the in-memory session state (only after successful re-auth and local updates)
+        _set_roster(None)
         state.current_session["teacher_id"] = None
         state.current_session["teacher_name"] = None
         state.current_session["class_id"] = None
@@ -809,148 +872,18 @@ async def mark_student_present(request: Request):
         return JSONResponse(content={"error": "missing_student_id"}, status_code=400)
 
     try:
-        conn = state.get_db()
-        _ensure_attendance_table(conn)
-        cur = conn.cursor()
-        # find the most recent active attendance_sessions row for this teacher+class
-        cur.execute(
-            "SELECT id, studentsPresent, studentsAbsent, timeStarted, roomId FROM attendance_sessions WHERE teacher_id = ? AND class_id = ? AND isActive = ? ORDER BY id DESC LIMIT 1",
-            (active_teacher, active_class, "true"),
-        )
-        row = cur.fetchone()
-        if not row:
-            conn.close()
+        roster = await run_in_threadpool(active_roster)
+        if roster is None:
             return JSONResponse(content={"error": "no_active_attendance_row"}, status_code=404)
-        row_id, studentsPresent_json, studentsAbsent_json, timeStarted, row_roomId = row
-        try:
-            present = json.loads(studentsPresent_json) if studentsPresent_json else []
-        except Exception:
-            present = []
-        # append if not already present
-        if student_id not in present:
-            # determine status based on timeStarted: present if within <1 minute, late if >=1 minute
-            try:
-                now_dt = datetime.now(timezone.utc)
-                now_iso = now_dt.isoformat()
-            except Exception:
-                now_iso = time.strftime("%Y-%m-%dT%H:%M:%S%z")
-                try:
-                    now_dt = datetime.strptime(now_iso, "%Y-%m-%dT%H:%M:%S%z")
-                except Exception:
-                    now_dt = datetime.now()
-
-            status = "present"
-            try:
-                if timeStarted:
-                    try:
-                        start_dt = datetime.strptime(timeStarted, "%Y-%m-%dT%H:%M:%S%z")
-                    except Exception:
-                        # fallback: parse without timezone
-                        try:
-                            start_dt = datetime.strptime(timeStarted.split('+')[0], "%Y-%m-%dT%H:%M:%S")
-                            start_dt = start_dt.replace(tzinfo=timezone.utc)
-                        except Exception:
-                            start_dt = None
-                    if start_dt is not None:
-                        diff_minutes = (now_dt - start_dt).total_seconds() / 60.0
-                        # present if less than 1 minute, late if >= 1 minute
-                        if diff_minutes < 0.20:
-                            status = "present"
-                        elif diff_minutes >= 0.33:
-                            status = "late"
-            except Exception:
-                status = "present"
-
-            # update local session present list
-            if status in ("present", "late"):
-                present.append(student_id)
-                try:
-                    cur.execute("UPDATE attendance_sessions SET studentsPresent = ? WHERE id = ?", (json.dumps(present), row_id))
-                    conn.commit()
-                except Exception:
-                    pass
-
-            # record attendance entry with timeLogged and status
-            try:
-                time_logged_val = now_iso if status in ("present", "late") else None
-                cur.execute(
-                    "INSERT OR REPLACE INTO attendance_entries (session_id, student_id, timeLogged, status, created_at) VALUES (?, ?, ?, ?, ?)",
-                    (row_id, student_id, time_logged_val, status, now_iso),
-                )
-                conn.commit()
-            except Exception:
-                pass
-
-            # attempt to update Firestore: per-student doc and session doc (best-effort)
-            try:
-                db_fs = getattr(sync, "db_fs", None) if sync is not None else None
-                if db_fs:
-                    # build session doc id (same deterministic scheme as start/stop)
-                    def _sanitize(s: str) -> str:
-                        if not s:
-                            return ""
-                        return "".join(c for c in s.replace(" ", "_") if (c.isalnum() or c in "-__")).strip("_")
-
-                    session_doc_id = None
-                    try:
-                        # prefer in-memory class_name if available
-                        class_name = state.current_session.get("class_name") or None
-                        conn3 = state.get_db()
-                        cur3 = conn3.cursor()
-                        cur3.execute("SELECT subjectName, gradeLevel, section, name FROM classes WHERE id = ?", (active_class,))
-                        rclass = cur3.fetchone()
-                        class_part = None
-                        if rclass:
-                            subject, grade, section, cname = rclass[0], rclass[1], rclass[2], rclass[3]
-                            parts = []
-                            if subject:
-                                parts.append(str(subject))
-                            if section:
-                                parts.append(str(section))
-                            if grade:
-                                parts.append(str(grade))
-                            class_part = "_".join(parts) if parts else (cname or None)
-                        try:
-                            conn3.close()
-                        except Exception:
-                            pass
-                        date_part = str(now_iso).split("T")[0]
-                        if class_part:
-                            class_part = _sanitize(class_part)[:120]
-                        else:
-                            class_part = _sanitize(class_name)[:120] if class_name else str(active_class)
-                        session_doc_id = f"{class_part}_{date_part}"
-                    except Exception:
-                        session_doc_id = None
-
-                    # write per-student attendance under students/{id}/attendance/{session_doc_id}
-                    try:
-                        if session_doc_id:
-                            student_doc = {
-                                "classId": active_class,
-                                "teacherId": active_teacher,
-                                "roomId": row_roomId,
-                                "date": now_iso,
-                                "timeLogged": time_logged_val,
-                                "status": status,
-                            }
-                            try:
-                                db_fs.collection("students").document(str(student_id)).collection("attendance").document(session_doc_id).set(student_doc)
-                            except Exception:
-                                pass
-
-                            # update session doc arrays (studentsPresent). Use full arrays to avoid duplicates.
-                            try:
-                                session_updates = {"studentsPresent": present}
-                                db_fs.collection("attendance_sessions").document(session_doc_id).set(session_updates, merge=True)
-                            except Exception:
-                                pass
-                    except Exception:
-                        pass
-            except Exception:
-                pass
-        conn.close()
-        return {"status": "marked", "studentsPresent": present}
+        # the roster answers "already marked?" without touching the database;
+        # a new mark waits on the db writer off the event loop, and a failed
+        # commit is reported instead of "marked"
+        await run_in_threadpool(_mark_with_roster, roster, student_id, student_name)
+        return {
+            "status": "marked",
+            "enrolled": roster.is_enrolled(student_id),
+            "studentsPresent": roster.snapshot()["studentsPresent"],
+        }
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
@@ -959,35 +892,27 @@ async def mark_student_present(request: Request):
 def get_current_attendance():
     """Return the studentsPresent/studentsAbsent arrays for the active session (if any)."""
     try:
-        active_teacher = state.current_session.get("teacher_id")
-        active_class = state.current_session.get("class_id")
-        if not active_teacher or not active_class:
+        roster = active_roster()
+        if roster is None:
             return {"studentsPresent": [], "studentsAbsent": []}
-        conn = state.get_db()
-        _ensure_attendance_table(conn)
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT studentsPresent, studentsAbsent FROM attendance_sessions WHERE teacher_id = ? AND class_id = ? AND isActive = ? ORDER BY id DESC LIMIT 1",
-            (active_teacher, active_class, "true"),
-        )
-        row = cur.fetchone()
-        conn.close()
-        if not row:
-            return {"studentsPresent": [], "studentsAbsent": []}
-        studentsPresent_json, studentsAbsent_json = row
-        try:
-            present = json.loads(studentsPresent_json) if studentsPresent_json else []
-        except Exception:
-            present = []
-        try:
-            absent = json.loads(studentsAbsent_json) if studentsAbsent_json else []
-        except Exception:
-            absent = []
-        return {"studentsPresent": present, "studentsAbsent": absent}
+        return roster.snapshot()
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 
+@router.get("/session/events")
+def get_session_events(since: int = 0):
+    """Return marks recorded after event id `since` (poll with the last id seen)."""
+    with _events_lock:
+        events = [e for e in _events if e["id"] > since]
+        last_id = _event_seq
+    return {
+        "events": events,
+        "last_id": last_id,
+        "auto_mark": bool(getattr(recognition, "AUTO_MARK", False)) if recognition is not None else False,
+    }
+
+
 @router.get("/session/attendance_entries")
 def get_current_attendance_entries():
     """Return attendance_entries rows for the active session."""
@@ -996,8 +921,8 @@ def get_current_attendance_entries():
         active_class = state.current_session.get("class_id")
         if not active_teacher or not active_class:
             return {"entries": []}
-        conn = state.get_db()
-        _ensure_attendance_table(conn)
+        state.ensure_schema(_ensure_attendance_table)
+        conn = state.get_read_db()
         cur = conn.cursor()
         cur.execute(
             "SELECT id FROM attendance_sessions WHERE teacher_id = ? AND class_id = ? ORDER BY id DESC LIMIT 1",
@@ -1026,7 +951,8 @@ def get_current_attendance_entries():
 def get_session_history(limit: int = 50):
     """Return recent session_history rows from local DB."""
     try:
-        conn = state.get_db()
+        state.ensure_schema(_ensure_attendance_table)
+        conn = state.get_read_db()
         cur = conn.cursor()
         cur.execute(
             "SELECT id, kiosk_fs_id, room_fs_id, class_id, class_name, students_present_total, timeStarted, timeEnded, teacher_id, date, raw_doc, createdAt FROM session_history ORDER BY id DESC LIMIT ?",
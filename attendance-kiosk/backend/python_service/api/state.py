@@ -1,8 +1,14 @@
 import os
+import queue
 import sqlite3
 import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
 from typing import List, Tuple, Optional
 
+from . import metrics
+
 try:
     import numpy as np
 except Exception:
@@ -13,16 +19,76 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 DB_PATH = os.path.abspath(os.path.join(BASE_DIR, "..", "data", "db", "local_database.db"))
 
 
+# milliseconds a connection waits on a locked database before failing
+BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+
+_schema_lock = threading.Lock()
+_schema_ready_path = None
+
+
+def _connect(path=None, **kwargs) -> sqlite3.Connection:
+    conn = sqlite3.connect(path or DB_PATH, check_same_thread=False, factory=metrics.TimedConnection, **kwargs)
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS};")
+    conn.execute("PRAGMA foreign_keys = ON;")
+    return conn
+
+
 def get_db() -> sqlite3.Connection:
     """Return a sqlite3 connection and ensure schema exists.
 
     The function creates parent directories if needed and ensures tables
-    used by the app exist. It's safe to call repeatedly.
+    used by the app exist (once per process and DB path). It's safe to
+    call repeatedly. Background subsystems should not write through these
+    connections directly; use run_write()/submit_write() instead.
     """
+    global _schema_ready_path
     db_dir = os.path.dirname(DB_PATH)
     os.makedirs(db_dir, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.execute("PRAGMA foreign_keys = ON;")
+    conn = _connect()
+    if _schema_ready_path != DB_PATH:
+        with _schema_lock:
+            if _schema_ready_path != DB_PATH:
+                _create_schema(conn)
+                _schema_ready_path = DB_PATH
+    return conn
+
+
+def get_read_db() -> sqlite3.Connection:
+    """Return a read-only connection (falls back to get_db() if unavailable)."""
+    if _schema_ready_path != DB_PATH:
+        get_db().close()
+    _ensure_writer()
+    try:
+        conn = sqlite3.connect(
+            Path(DB_PATH).as_uri() + "?mode=ro", uri=True, check_same_thread=False, factory=metrics.TimedConnection
+        )
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS};")
+        return conn
+    except Exception:
+        return get_db()
+
+
+# convert a database created without auto_vacuum with one full VACUUM at
+# startup (needs free disk about the size of the DB; blocks startup)
+CONVERT_AUTO_VACUUM = os.environ.get("DB_CONVERT_AUTO_VACUUM", "0").lower() in ("1", "true", "yes")
+
+
+def _create_schema(conn):
+    # incremental auto_vacuum lets retention give pages back a few at a time;
+    # it only takes effect on a new database, before WAL and the first table
+    try:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        if CONVERT_AUTO_VACUUM and conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("VACUUM")
+            print("database converted to incremental auto_vacuum")
+    except Exception as e:
+        print("auto_vacuum setup failed:", e)
+    # WAL lets readers proceed while the single writer commits
+    try:
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute("PRAGMA synchronous = NORMAL;")
+    except Exception:
+        pass
 
     # Create required tables if they don't exist
     conn.execute(
@@ -138,8 +204,197 @@ def get_db() -> sqlite3.Connection:
         conn.execute("ALTER TABLE kiosk_notifications ADD COLUMN last_notified_at TEXT")
     except Exception:
         pass
+    # repeated events within the dedup window are collapsed into one counted row
+    try:
+        conn.execute("ALTER TABLE kiosk_notifications ADD COLUMN occurrences INTEGER DEFAULT 1")
+    except Exception:
+        pass
+    try:
+        conn.execute("ALTER TABLE kiosk_notifications ADD COLUMN last_occurred_ts REAL")
+    except Exception:
+        pass
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_kiosk_notifications_sync ON kiosk_notifications (sync_status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_kiosk_notifications_dedup ON kiosk_notifications (title, type, last_occurred_ts)")
+    # retention ages rows by last_occurred_ts; list filters page by (type, id)
+    conn.execute(
+        "UPDATE kiosk_notifications SET last_occurred_ts = (julianday(substr(COALESCE(timestamp, createdAt), 1, 19)) - 2440587.5) * 86400.0 WHERE last_occurred_ts IS NULL"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_kiosk_notifications_age ON kiosk_notifications (last_occurred_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_kiosk_notifications_type ON kiosk_notifications (type, id)")
+    conn.commit()
+
+
+# Single-writer queue.
+# All background writes go through one thread that owns one connection and
+# groups queued commands into a single transaction (group commit). Each
+# command runs inside its own SAVEPOINT so a failing command does not undo
+# the others. Callers get a Future; run_write() blocks for the result.
+WRITE_QUEUE_SIZE = int(os.environ.get("DB_WRITE_QUEUE_SIZE", "256"))
+WRITE_BATCH_MAX = int(os.environ.get("DB_WRITE_BATCH_MAX", "64"))
+
+_write_q = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+_writer_thread = None
+_writer_lock = threading.Lock()
+_writer_conn = None
+_writer_conn_path = None
+
+write_stats = {
+    "batches": 0,
+    "commands": 0,
+    "errors": 0,
+    "last_batch_size": 0,
+    "last_commit_ms": None,
+    "max_commit_ms": 0.0,
+}
+
+
+def _ensure_writer():
+    global _writer_thread
+    if _writer_thread is not None and _writer_thread.is_alive():
+        return
+    with _writer_lock:
+        if _writer_thread is not None and _writer_thread.is_alive():
+            return
+        _writer_thread = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+        _writer_thread.start()
 
-    return conn
+
+def _writer_connection():
+    global _writer_conn, _writer_conn_path
+    if _writer_conn is not None and _writer_conn_path == DB_PATH:
+        return _writer_conn
+    try:
+        if _writer_conn is not None:
+            _writer_conn.close()
+    except Exception:
+        pass
+    get_db().close()
+    # autocommit mode: transactions are opened explicitly per batch
+    _writer_conn = _connect(isolation_level=None)
+    _writer_conn_path = DB_PATH
+    return _writer_conn
+
+
+def _run_command(conn, fn, args, kwargs):
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    conn.execute("SAVEPOINT write_cmd")
+    try:
+        res = fn(conn, *args, **kwargs)
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK TO write_cmd")
+            conn.execute("RELEASE write_cmd")
+        raise
+    # fn may have committed on its own; only release a savepoint that still exists
+    if conn.in_transaction:
+        conn.execute("RELEASE write_cmd")
+    return res
+
+
+def _writer_loop():
+    while True:
+        item = _write_q.get()
+        batch = [item]
+        while len(batch) < WRITE_BATCH_MAX:
+            try:
+                batch.append(_write_q.get_nowait())
+            except queue.Empty:
+                break
+
+        results = []
+        start = time.time()
+        try:
+            conn = _writer_connection()
+            for fn, args, kwargs, fut in batch:
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                try:
+                    results.append((fut, _run_command(conn, fn, args, kwargs), None))
+                except Exception as e:
+                    write_stats["errors"] += 1
+                    results.append((fut, None, e))
+            if conn.in_transaction:
+                conn.commit()
+        except Exception as e:
+            # the commit (or BEGIN) failed: nothing in this batch was persisted
+            write_stats["errors"] += 1
+            try:
+                if _writer_conn is not None and _writer_conn.in_transaction:
+                    _writer_conn.rollback()
+            except Exception:
+                pass
+            results = [(fut, None, e) for fut, _res, _err in results]
+
+        elapsed_ms = (time.time() - start) * 1000.0
+        metrics.SQLITE_WRITE_BATCH_SECONDS.observe(elapsed_ms / 1000.0)
+        write_stats["batches"] += 1
+        write_stats["commands"] += len(batch)
+        write_stats["last_batch_size"] = len(batch)
+        write_stats["last_commit_ms"] = round(elapsed_ms, 3)
+        write_stats["max_commit_ms"] = max(write_stats["max_commit_ms"], round(elapsed_ms, 3))
+        for fut, res, err in results:
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(res)
+
+
+def submit_write(fn, *args, **kwargs) -> Future:
+    """Queue fn(conn, *args, **kwargs) for the writer thread and return a Future.
+
+    fn runs inside the writer's transaction and should not commit itself.
+    The queue is bounded, so producers block briefly under heavy load.
+    """
+    fut = Future()
+    if threading.current_thread() is _writer_thread:
+        # nested write from inside a command: run inline in the same transaction
+        try:
+            fut.set_result(fn(_writer_conn, *args, **kwargs))
+        except Exception as e:
+            fut.set_exception(e)
+        return fut
+    _ensure_writer()
+    _write_q.put((fn, args, kwargs, fut))
+    return fut
+
+
+def run_write(fn, *args, timeout=None, **kwargs):
+    """Run fn(conn, ...) on the writer thread and return its result (re-raises errors)."""
+    return submit_write(fn, *args, **kwargs).result(timeout=timeout)
+
+
+def execute_write(sql, params=()):
+    """Run one write statement through the writer; returns (rowcount, lastrowid)."""
+    def _exec(conn):
+        cur = conn.execute(sql, params)
+        return cur.rowcount, cur.lastrowid
+    return run_write(_exec)
+
+
+_schema_fns_done = set()
+
+
+def ensure_schema(fn):
+    """Run a module's CREATE TABLE helper fn(conn) once per DB path via the writer."""
+    key = (getattr(fn, "__module__", None), getattr(fn, "__qualname__", repr(fn)), DB_PATH)
+    if key in _schema_fns_done:
+        return
+    run_write(fn)
+    _schema_fns_done.add(key)
+
+
+def backup_db(dest_path):
+    """Copy the live database (including WAL content) to dest_path."""
+    src = get_read_db()
+    try:
+        dst = sqlite3.connect(dest_path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+    finally:
+        src.close()
 
 
 # In-memory state caches populated by load_embeddings()
@@ -156,6 +411,49 @@ current_session = {
     "class_name": None,
 }
 
+# class_id -> (subjectName, gradeLevel, section, name), or None for an unknown
+# class; feeds the Firestore session doc id. Cleared when sync writes classes.
+_class_meta = {}
+_class_meta_lock = threading.Lock()
+
+
+def get_class_meta(class_id, conn=None):
+    """Return cached (subjectName, gradeLevel, section, name) for a class.
+
+    Pass `conn` to read through an existing (e.g. writer) connection on a miss.
+    """
+    if class_id is None:
+        return None
+    with _class_meta_lock:
+        if class_id in _class_meta:
+            return _class_meta[class_id]
+    own = conn is None
+    try:
+        if own:
+            conn = get_read_db()
+        row = conn.execute("SELECT subjectName, gradeLevel, section, name FROM classes WHERE id = ?", (class_id,)).fetchone()
+    except Exception:
+        return None
+    finally:
+        if own and conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+    meta = tuple(row) if row else None
+    with _class_meta_lock:
+        _class_meta[class_id] = meta
+    return meta
+
+
+def invalidate_class_meta(class_ids=None):
+    with _class_meta_lock:
+        if class_ids is None:
+            _class_meta.clear()
+        else:
+            for cid in class_ids:
+                _class_meta.pop(cid, None)
+
 
 def load_embeddings():
     """Load embeddings from the sqlite DB into the in-memory lists.
@@ -168,7 +466,7 @@ def load_embeddings():
         teacher_embeddings = []
         return
 
-    conn = get_db()
+    conn = get_read_db()
     cur = conn.cursor()
     try:
         cur.execute("SELECT id, firstname, lastname, embedding FROM students")
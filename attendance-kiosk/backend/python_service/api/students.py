@@ -20,7 +20,7 @@ def get_students_by_ids(ids: str = ""):
         if not id_list:
             return {"students": []}
 
-        conn = state.get_db()
+        conn = state.get_read_db()
         cur = conn.cursor()
         # Build a parameter list for SQL IN clause
         placeholders = ",".join(["?" for _ in id_list])
@@ -1,11 +1,12 @@
 from fastapi import APIRouter
 from fastapi.responses import JSONResponse
 from . import state
+from . import metrics
 import os
 import json
-import shutil
 import requests
 import time
+import hashlib
 
 try:
     import numpy as np
@@ -27,25 +28,271 @@ except Exception:
 
 router = APIRouter()
 
-# Initialize Firestore client if credentials exist (optional)
-db_fs = None
+# Firestore data source, chosen by FIRESTORE_BACKEND:
+#   firestore (default)  firebase_admin client when serviceAccountKey.json exists
+#   fake                 in-process stand-in (api/fake_firestore.py) for offline tests/benchmarks
+#   none                 no remote; sync and outbox stay local
+FIRESTORE_BACKEND = os.environ.get("FIRESTORE_BACKEND", "firestore").strip().lower()
 cred_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "serviceAccountKey.json"))
-try:
-    from firebase_admin import credentials, firestore, initialize_app
-    if os.path.exists(cred_path):
+
+
+def _init_firestore(backend):
+    if backend == "none":
+        return None
+    if backend == "fake":
+        from . import fake_firestore
+        return fake_firestore.from_env()
+    try:
+        from firebase_admin import credentials, firestore, initialize_app
+        if os.path.exists(cred_path):
+            try:
+                cred = credentials.Certificate(cred_path)
+                initialize_app(cred)
+                return firestore.client()
+            except Exception:
+                return None
+    except Exception:
+        pass
+    return None
+
+
+db_fs = _init_firestore(FIRESTORE_BACKEND)
+
+
+# Profile photo / embedding cache.
+# Photos are revalidated with ETag/Last-Modified and embeddings are keyed by
+# (photo content hash, model pack, preprocessing version) so an unchanged
+# roster costs neither downloads nor model inference on repeated syncs.
+EMBED_PREPROC_VERSION = "bgr-resize-320x240-v1"
+
+_http = requests.Session()
+
+
+def _ensure_embedding_cache_tables(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            content_hash TEXT,
+            model_pack TEXT,
+            preproc_version TEXT,
+            embedding BLOB,
+            createdAt TEXT,
+            PRIMARY KEY (content_hash, model_pack, preproc_version)
+        )
+    """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS profile_photo_cache (
+            role TEXT,
+            doc_id TEXT,
+            url TEXT,
+            etag TEXT,
+            last_modified TEXT,
+            content_hash TEXT,
+            local_path TEXT,
+            checkedAt TEXT,
+            PRIMARY KEY (role, doc_id)
+        )
+    """
+    )
+    # remote URL the row's current embedding was computed from (see _needs_embedding)
+    try:
+        conn.execute("ALTER TABLE profile_photo_cache ADD COLUMN embedded_url TEXT")
+    except Exception:
+        pass
+
+
+_MARK_EMBEDDED_SQL = "UPDATE profile_photo_cache SET embedded_url = ? WHERE role = ? AND doc_id = ?"
+
+
+def _compute_embedding(content, label):
+    """Decode image bytes and return the first face embedding as bytes (or None)."""
+    img = None
+    # Try OpenCV decode first if available
+    if cv2 is not None and np is not None:
+        try:
+            img_array = np.asarray(bytearray(content), dtype=np.uint8)
+            img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
+        except Exception:
+            img = None
+    # Fallback to PIL if OpenCV not available or failed
+    if img is None and Image is not None:
+        try:
+            pil = Image.open(io.BytesIO(content)).convert('RGB')
+            img = np.asarray(pil)[:, :, ::-1] if np is not None else None
+        except Exception:
+            img = None
+
+    if img is None:
+        return None
+    try:
+        # ensure model is prepared
+        mdl = recognition._init_model() or recognition.model
+        if mdl is None:
+            return None
+        small = cv2.resize(img, (320, 240)) if cv2 is not None else img
+        try:
+            faces = mdl.get(small)
+        except Exception:
+            faces = []
+        if faces:
+            return faces[0].embedding.tobytes()
+    except Exception as e:
+        print(f"Model processing failed for {label}: {e}")
+    return None
+
+
+def _cache_lookup(sql, params):
+    conn = None
+    try:
+        conn = state.get_read_db()
+        return conn.execute(sql, params).fetchone()
+    except Exception:
+        return None
+    finally:
+        try:
+            if conn:
+                conn.close()
+        except Exception:
+            pass
+
+
+def _cache_write(sql, params):
+    try:
+        state.execute_write(sql, params)
+    except Exception:
+        pass
+
+
+def _profile_embedding(role, doc_id, profile_url, stats=None):
+    """Return (embedding_bytes, local_photo_path) for a profile photo URL.
+
+    The download is skipped when the server answers 304 for the cached
+    validators, and inference is skipped when the photo hash is already in
+    embedding_cache. Either value may be None on failure. Cache lookups use a
+    read-only connection and cache rows go through the single writer, so no
+    transaction is held open across the download or the model.
+    """
+    if stats is None:
+        stats = {}
+    label = f"{role[:-1]} {doc_id}"
+    cached = _cache_lookup(
+        "SELECT url, etag, last_modified, content_hash, local_path FROM profile_photo_cache WHERE role = ? AND doc_id = ?",
+        (role, doc_id),
+    )
+
+    local_file = media.local_photo_file(doc_id, role)
+    headers = {}
+    if cached and cached[0] == profile_url and cached[3] and local_file and os.path.exists(local_file):
+        if cached[1]:
+            headers["If-None-Match"] = cached[1]
+        if cached[2]:
+            headers["If-Modified-Since"] = cached[2]
+
+    content = None
+    try:
+        resp = _http.get(profile_url, headers=headers, timeout=15, allow_redirects=True)
+    except Exception as e:
+        print(f"Error downloading {label}: {e}")
+        return None, None
+
+    now = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    if resp.status_code == 304 and headers:
+        content_hash = cached[3]
+        local_path = cached[4] or None
+        stats["photos_not_modified"] = stats.get("photos_not_modified", 0) + 1
+        _cache_write(
+            "UPDATE profile_photo_cache SET checkedAt = ? WHERE role = ? AND doc_id = ?",
+            (now, role, doc_id),
+        )
+    elif resp.status_code == 200:
+        content = resp.content
+        content_hash = hashlib.sha256(content).hexdigest()
+        stats["photos_downloaded"] = stats.get("photos_downloaded", 0) + 1
+        # Save a local copy of the profile image (best-effort); replace it when the photo changed
+        local_path = None
         try:
-            cred = credentials.Certificate(cred_path)
-            initialize_app(cred)
-            db_fs = firestore.client()
+            changed = not cached or cached[3] != content_hash
+            local_path = media.save_profile_photo(doc_id, role, content, overwrite=changed) or None
         except Exception:
-            db_fs = None
+            local_path = None
+        _cache_write(
+            "INSERT OR REPLACE INTO profile_photo_cache (role, doc_id, url, etag, last_modified, content_hash, local_path, checkedAt) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (role, doc_id, profile_url, resp.headers.get("ETag"), resp.headers.get("Last-Modified"), content_hash, local_path, now),
+        )
     else:
-        db_fs = None
-except Exception:
-    db_fs = None
+        return None, None
+
+    model_pack = getattr(recognition, "MODEL_PACK", None) or "default"
+    hit = _cache_lookup(
+        "SELECT embedding FROM embedding_cache WHERE content_hash = ? AND model_pack = ? AND preproc_version = ?",
+        (content_hash, model_pack, EMBED_PREPROC_VERSION),
+    )
+    if hit is not None:
+        # a NULL embedding is a cached "no face found" result
+        stats["embedding_cache_hits"] = stats.get("embedding_cache_hits", 0) + 1
+        return hit[0], local_path
+
+    if content is None:
+        try:
+            with open(local_file, "rb") as f:
+                content = f.read()
+        except Exception:
+            return None, local_path
+
+    if recognition._init_model() is None:
+        # no model on this device: do not cache a negative result
+        return None, local_path
+    emb = _compute_embedding(content, label)
+    stats["embeddings_computed"] = stats.get("embeddings_computed", 0) + 1
+    _cache_write(
+        "INSERT OR REPLACE INTO embedding_cache (content_hash, model_pack, preproc_version, embedding, createdAt) VALUES (?, ?, ?, ?, ?)",
+        (content_hash, model_pack, EMBED_PREPROC_VERSION, emb, now),
+    )
+    return emb, local_path
+
+
+def _ensure_attendance_fs_table(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS attendance_sessions_fs (
+            fs_id TEXT PRIMARY KEY,
+            class_id TEXT,
+            teacher_id TEXT,
+            date TEXT,
+            isActive TEXT,
+            roomId TEXT,
+            studentsPresent JSON,
+            studentsAbsent JSON,
+            timeStarted TEXT,
+            timeEnded TEXT,
+            raw_doc JSON
+        )
+    """
+    )
+
+
+def _execute_statements(conn, statements):
+    failed = 0
+    for sql, params in statements:
+        try:
+            conn.execute(sql, params)
+        except Exception as e:
+            failed += 1
+            print(f"Error writing synced row: {e}")
+    return failed
+
+
+def _write_statements(statements):
+    """Apply (sql, params) pairs collected during a sync in one writer command."""
+    if not statements:
+        return 0
+    return state.run_write(_execute_statements, statements)
 
 
 @router.get("/sync")
+@metrics.SYNC_SECONDS.time(("full",))
 def sync_firestore():
     if not db_fs:
         # Firestore client not configured. Return a clearer hint instead of a generic 500.
@@ -56,18 +303,20 @@ def sync_firestore():
             },
             status_code=400,
         )
-    conn = None
     try:
         DB_PATH = getattr(state, 'DB_PATH', None)
         if DB_PATH and os.path.exists(DB_PATH):
             try:
-                shutil.copy(DB_PATH, DB_PATH + ".bak")
+                state.backup_db(DB_PATH + ".bak")
             except Exception as e:
                 print(f"Warning: failed to backup DB: {e}")
 
-        conn = state.get_db()
-        cursor = conn.cursor()
+        state.ensure_schema(_ensure_embedding_cache_tables)
+        # Rows are collected while talking to Firestore and written through the
+        # single writer afterwards, so no write lock is held during downloads.
+        writes = []
         synced_count = {"students": 0, "teachers": 0, "classes": 0, "class_students": 0}
+        cache_stats = {"photos_downloaded": 0, "photos_not_modified": 0, "embedding_cache_hits": 0, "embeddings_computed": 0}
 
         teachers_ref = db_fs.collection("teachers").stream()
         for doc in teachers_ref:
@@ -78,58 +327,33 @@ def sync_firestore():
             emb = None
             if profile_url:
                 try:
-                    resp = requests.get(profile_url, timeout=15, allow_redirects=True)
-                    if resp.status_code == 200:
-                        content = resp.content
-                        # Save a local copy of the profile image (best-effort)
-                        try:
-                            local_path = media.save_profile_photo(teacher_id, 'teachers', content)
-                            if local_path:
-                                profile_url = local_path
-                        except Exception:
-                            pass
-
-                        img = None
-                        # Try OpenCV decode first if available
-                        if cv2 is not None and np is not None:
-                            try:
-                                img_array = np.asarray(bytearray(content), dtype=np.uint8)
-                                img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-                            except Exception:
-                                img = None
-                        # Fallback to PIL if OpenCV not available or failed
-                        if img is None and Image is not None:
-                            try:
-                                pil = Image.open(io.BytesIO(content)).convert('RGB')
-                                img = np.asarray(pil)[:, :, ::-1] if np is not None else None
-                            except Exception:
-                                img = None
-
-                        if img is not None:
-                            try:
-                                # ensure model is prepared
-                                mdl = recognition._init_model() or recognition.model
-                                if mdl is not None:
-                                    small = cv2.resize(img, (320, 240)) if cv2 is not None else img
-                                    try:
-                                        faces = mdl.get(small)
-                                    except Exception:
-                                        faces = []
-                                    if faces:
-                                        emb = faces[0].embedding.tobytes()
-                            except Exception as e:
-                                print(f"Model processing failed for teacher {teacher_id}: {e}")
+                    emb, local_path = _profile_embedding('teachers', teacher_id, profile_url, cache_stats)
+                    if local_path:
+                        profile_url = local_path
                 except Exception as e:
                     print(f"Error downloading/processing teacher {teacher_id}: {e}")
 
             try:
-                cursor.execute(
+                writes.append((
                     """
-                    INSERT OR REPLACE INTO teachers (
+                    INSERT INTO teachers (
                         id, firstname, middlename, lastname,
                         school_email, personal_email, status, temp_password,
                         profilePicUrl, createdAt, updatedAt, embedding, raw_doc
                     ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        firstname = excluded.firstname,
+                        middlename = excluded.middlename,
+                        lastname = excluded.lastname,
+                        school_email = excluded.school_email,
+                        personal_email = excluded.personal_email,
+                        status = excluded.status,
+                        temp_password = excluded.temp_password,
+                        profilePicUrl = excluded.profilePicUrl,
+                        createdAt = excluded.createdAt,
+                        updatedAt = excluded.updatedAt,
+                        embedding = COALESCE(excluded.embedding, teachers.embedding),
+                        raw_doc = excluded.raw_doc
                 """,
                     (
                         teacher_id,
@@ -146,8 +370,10 @@ def sync_firestore():
                         emb,
                         raw_json,
                     ),
-                )
+                ))
                 synced_count["teachers"] += 1
+                if emb is not None:
+                    writes.append((_MARK_EMBEDDED_SQL, (_remote_pic_url(data), 'teachers', teacher_id)))
             except Exception as e:
                 print(f"Error inserting teacher {teacher_id}: {e}")
 
@@ -161,7 +387,7 @@ def sync_firestore():
                 time_start = data.get("time_start") or data.get("timeStart") or None
                 time_end = data.get("time_end") or data.get("timeEnd") or None
                 time_val = data.get("time") if data.get("time") is not None else None
-                cursor.execute(
+                writes.append((
                     """
                     INSERT OR REPLACE INTO classes (
                         id, name, gradeLevel, section, subjectName,
@@ -186,7 +412,7 @@ def sync_firestore():
                         data.get("updatedAt"),
                         raw_json,
                     ),
-                )
+                ))
                 synced_count["classes"] += 1
             except Exception as e:
                 print(f"Error inserting class {class_id}: {e}")
@@ -200,56 +426,36 @@ def sync_firestore():
             emb = None
             if profile_url:
                 try:
-                    resp = requests.get(profile_url, timeout=15, allow_redirects=True)
-                    if resp.status_code == 200:
-                        content = resp.content
-                        # Save a local copy of the profile image (best-effort)
-                        try:
-                            local_path = media.save_profile_photo(student_id, 'students', content)
-                            if local_path:
-                                profile_url = local_path
-                        except Exception:
-                            pass
-
-                        img = None
-                        if cv2 is not None and np is not None:
-                            try:
-                                img_array = np.asarray(bytearray(content), dtype=np.uint8)
-                                img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-                            except Exception:
-                                img = None
-                        if img is None and Image is not None:
-                            try:
-                                pil = Image.open(io.BytesIO(content)).convert('RGB')
-                                img = np.asarray(pil)[:, :, ::-1] if np is not None else None
-                            except Exception:
-                                img = None
-
-                        if img is not None:
-                            try:
-                                mdl = recognition._init_model() or recognition.model
-                                if mdl is not None:
-                                    small = cv2.resize(img, (320, 240)) if cv2 is not None else img
-                                    try:
-                                        faces = mdl.get(small)
-                                    except Exception:
-                                        faces = []
-                                    if faces:
-                                        emb = faces[0].embedding.tobytes()
-                            except Exception as e:
-                                print(f"Model processing failed for student {student_id}: {e}")
+                    emb, local_path = _profile_embedding('students', student_id, profile_url, cache_stats)
+                    if local_path:
+                        profile_url = local_path
                 except Exception as e:
                     print(f"Error downloading/processing student {student_id}: {e}")
 
             try:
-                cursor.execute(
+                writes.append((
                     """
-                    INSERT OR REPLACE INTO students (
+                    INSERT INTO students (
                         id, firstname, middlename, lastname,
                         school_email, personal_email, guardianname,
                         guardiancontact, status, temp_password, profilePicUrl,
                         createdAt, updatedAt, embedding, raw_doc
                     ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        firstname = excluded.firstname,
+                        middlename = excluded.middlename,
+                        lastname = excluded.lastname,
+                        school_email = excluded.school_email,
+                        personal_email = excluded.personal_email,
+                        guardianname = excluded.guardianname,
+                        guardiancontact = excluded.guardiancontact,
+                        status = excluded.status,
+                        temp_password = excluded.temp_password,
+                        profilePicUrl = excluded.profilePicUrl,
+                        createdAt = excluded.createdAt,
+                        updatedAt = excluded.updatedAt,
+                        embedding = COALESCE(excluded.embedding, students.embedding),
+                        raw_doc = excluded.raw_doc
                 """,
                     (
                         student_id,
@@ -268,52 +474,37 @@ def sync_firestore():
                         emb,
                         raw_json,
                     ),
-                )
+                ))
                 synced_count["students"] += 1
+                if emb is not None:
+                    writes.append((_MARK_EMBEDDED_SQL, (_remote_pic_url(data), 'students', student_id)))
 
                 classes_arr = data.get("classes") or []
                 try:
-                    cursor.execute("DELETE FROM class_students WHERE student_id = ?", (student_id,))
+                    writes.append(("DELETE FROM class_students WHERE student_id = ?", (student_id,)))
                 except Exception:
                     pass
                 for class_id in classes_arr:
                     try:
-                        cursor.execute("INSERT OR IGNORE INTO classes (id, raw_doc) VALUES (?, ?)", (class_id, None))
-                        cursor.execute("INSERT OR IGNORE INTO class_students (class_id, student_id) VALUES (?, ?)", (class_id, student_id))
+                        writes.append(("INSERT OR IGNORE INTO classes (id, raw_doc) VALUES (?, ?)", (class_id, None)))
+                        writes.append(("INSERT OR IGNORE INTO class_students (class_id, student_id) VALUES (?, ?)", (class_id, student_id)))
                         synced_count["class_students"] += 1
                     except Exception as e:
                         print(f"Error linking student {student_id} -> class {class_id}: {e}")
             except Exception as e:
                 print(f"Error inserting student {student_id}: {e}")
 
-        conn.commit()
-        conn.close()
+        _write_statements(writes)
+        state.invalidate_class_meta()
 
         # reload embeddings
         state.load_embeddings()
 
         # Also sync attendance_sessions collection into a local table
         try:
-            conn = state.get_db()
-            cur = conn.cursor()
             # store Firestore attendance documents in a dedicated table to avoid schema conflicts
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS attendance_sessions_fs (
-                    fs_id TEXT PRIMARY KEY,
-                    class_id TEXT,
-                    teacher_id TEXT,
-                    date TEXT,
-                    isActive TEXT,
-                    roomId TEXT,
-                    studentsPresent JSON,
-                    studentsAbsent JSON,
-                    timeStarted TEXT,
-                    timeEnded TEXT,
-                    raw_doc JSON
-                )
-            """
-            )
+            state.ensure_schema(_ensure_attendance_fs_table)
+            writes = []
 
             try:
                 sessions_ref = db_fs.collection("attendance_sessions").stream()
@@ -333,7 +524,7 @@ def sync_firestore():
                     timeEnded = str(data.get("timeEnded") or data.get("time_ended")) if (data.get("timeEnded") or data.get("time_ended")) is not None else None
 
                     try:
-                        cur.execute(
+                        writes.append((
                             "INSERT OR REPLACE INTO attendance_sessions_fs (fs_id, class_id, teacher_id, date, isActive, roomId, studentsPresent, studentsAbsent, timeStarted, timeEnded, raw_doc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                             (
                                 fs_id,
@@ -348,61 +539,29 @@ def sync_firestore():
                                 timeEnded,
                                 raw_json,
                             ),
-                        )
+                        ))
                         synced_count["attendance_sessions"] = synced_count.get("attendance_sessions", 0) + 1
                     except Exception as e:
                         print(f"Error inserting attendance_session {fs_id}: {e}")
             except Exception:
                 # collection may not exist or be empty
                 pass
-            conn.commit()
-            conn.close()
+            _write_statements(writes)
         except Exception:
             pass
 
         # Also sync rooms and kiosks collections if available
         try:
-            conn = state.get_db()
-            cur = conn.cursor()
             # create dedicated tables for rooms and kiosks from Firestore
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS rooms_fs (
-                    fs_id TEXT PRIMARY KEY,
-                    roomname TEXT,
-                    kioskid TEXT,
-                    assignedteachers JSON,
-                    currentsessionid TEXT,
-                    isactive TEXT,
-                    createdat TEXT,
-                    updatedat TEXT,
-                    raw_doc JSON
-                )
-            """
-            )
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS kiosks_fs (
-                    fs_id TEXT PRIMARY KEY,
-                    name TEXT,
-                    serialNumber TEXT,
-                    assignedRoomId TEXT,
-                    ipAddress TEXT,
-                    macAddress TEXT,
-                    status TEXT,
-                    installedAt TEXT,
-                    updatedAt TEXT,
-                    raw_doc JSON
-                )
-            """
-            )
+            state.ensure_schema(_ensure_registry_tables)
+            writes = []
 
             try:
                 rooms_ref = db_fs.collection("rooms").stream()
                 room_count = 0
                 # determine local kiosk id (if any) so we can notify when a room targeting our kiosk is updated
                 try:
-                    loc_conn = state.get_db()
+                    loc_conn = state.get_read_db()
                     loc_cur = loc_conn.cursor()
                     loc_cur.execute("SELECT fs_id FROM kiosks_fs LIMIT 1")
                     lk = loc_cur.fetchone()
@@ -426,10 +585,10 @@ def sync_firestore():
                     updatedat = str(data.get("updatedAt")) if data.get("updatedAt") is not None else None
 
                     try:
-                        cur.execute(
+                        writes.append((
                             "INSERT OR REPLACE INTO rooms_fs (fs_id, roomname, kioskid, assignedteachers, currentsessionid, isactive, createdat, updatedat, raw_doc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
                             (fs_id, roomname, kioskid, assignedteachers, currentsessionid, isactive, createdat, updatedat, raw_json),
-                        )
+                        ))
                         # If this room references our local kiosk, insert a notification
                         try:
                             if local_kiosk_id and kioskid and str(kioskid) == str(local_kiosk_id):
@@ -464,7 +623,7 @@ def sync_firestore():
                 kiosk_count = 0
                 # determine local kiosk id (if any) so we can notify when this kiosk's doc is updated
                 try:
-                    loc_conn = state.get_db()
+                    loc_conn = state.get_read_db()
                     loc_cur = loc_conn.cursor()
                     loc_cur.execute("SELECT fs_id FROM kiosks_fs LIMIT 1")
                     lk = loc_cur.fetchone()
@@ -489,10 +648,10 @@ def sync_firestore():
                     updatedAt = str(data.get("updatedAt")) if data.get("updatedAt") is not None else None
 
                     try:
-                        cur.execute(
+                        writes.append((
                             "INSERT OR REPLACE INTO kiosks_fs (fs_id, name, serialNumber, assignedRoomId, ipAddress, macAddress, status, installedAt, updatedAt, raw_doc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                             (fs_id, name, serial, assignedRoomId, ip, mac, status, installedAt, updatedAt, raw_json),
-                        )
+                        ))
                         # If this Firestore doc corresponds to our local kiosk, insert a notification about the update
                         try:
                             if local_kiosk_id and str(fs_id) == str(local_kiosk_id):
@@ -521,8 +680,7 @@ def sync_firestore():
             except Exception:
                 pass
 
-            conn.commit()
-            conn.close()
+            _write_statements(writes)
         except Exception:
             pass
 
@@ -531,15 +689,10 @@ def sync_firestore():
         total_synced = sum(v for v in synced_count.values())
         if total_synced == 0:
             message = "no_records_synced"
-        return {"status": "success", "synced": synced_count, "message": message}
+        return {"status": "success", "synced": synced_count, "cache": cache_stats, "message": message}
     except Exception as e:
         import traceback
         traceback.print_exc()
-        try:
-            if conn:
-                conn.rollback()
-        except Exception:
-            pass
         # Return a concise error to the client, full traceback is in server logs
         return JSONResponse(content={"error": "sync_failed", "detail": str(e)}, status_code=500)
 
@@ -568,283 +721,588 @@ from datetime import datetime, timezone
 
 # incremental sync state
 _partial_last_update = {}
+_partial_last_full = {}
 _partial_last_run = None
 _partial_last_synced = {}
 
 _partial_bg_thread = None
 _partial_bg_started = False
 
+# Collections pulled by the partial sync, in apply order (classes before
+# students so class_students links find their class rows). Room docs often
+# carry no updatedAt; without a cursor they are simply re-read in full.
+PARTIAL_COLLECTIONS = ('teachers', 'classes', 'students', 'kiosks', 'rooms')
 
-def _sync_partial_collections():
-    """Pull the target Firestore collections and update local DB tables.
 
-    Returns a dict summary or {'error': ...} on failure.
+def _to_iso(val):
+    """Normalize Firestore Timestamp/datetime-like values to an ISO string."""
+    if val is None:
+        return None
+    try:
+        # datetime-like objects
+        if hasattr(val, 'isoformat'):
+            return val.isoformat()
+    except Exception:
+        pass
+    try:
+        # some Firestore timestamp classes expose to_datetime or ToDatetime
+        if hasattr(val, 'ToDatetime'):
+            return val.ToDatetime().isoformat()
+        if hasattr(val, 'to_datetime'):
+            return val.to_datetime().isoformat()
+    except Exception:
+        pass
+    # fallback: stringify
+    try:
+        return str(val)
+    except Exception:
+        return None
+
+
+def _ensure_cursor_table(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_cursors (
+            collection TEXT PRIMARY KEY,
+            cursor TEXT,
+            cursor_type TEXT,
+            last_full_at REAL
+        )
     """
-    if not db_fs:
-        return {'error': 'firestore_not_configured'}
+    )
 
-    conn = None
-    try:
-        conn = state.get_db()
-        cur = conn.cursor()
-        synced = {'students': 0, 'teachers': 0, 'classes': 0, 'kiosks': 0, 'class_students': 0}
 
-        # Teachers (lightweight: do not download/process images)
+def _encode_cursor(val):
+    if isinstance(val, datetime):
+        return val.isoformat(), 'datetime'
+    return str(val), 'str'
+
+
+def _decode_cursor(text, cursor_type):
+    if text is None:
+        return None
+    if cursor_type == 'datetime':
         try:
-            fs_ids = set()
-            count = 0
-            for doc in db_fs.collection('teachers').stream():
-                fs_ids.add(doc.id)
-                data = doc.to_dict() or {}
-                teacher_id = doc.id
-                try:
-                    raw_json = json.dumps(data, default=str)
-                    cur.execute(
-                        "INSERT OR REPLACE INTO teachers (id, firstname, middlename, lastname, school_email, personal_email, status, temp_password, profilePicUrl, createdAt, updatedAt, embedding, raw_doc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                        (
-                            teacher_id,
-                            data.get('firstname'),
-                            data.get('middlename'),
-                            data.get('lastname'),
-                            data.get('school_email'),
-                            data.get('personal_email'),
-                            data.get('status'),
-                            data.get('temp_password'),
-                            data.get('profilePicUrl') or data.get('profile_pic_url'),
-                            data.get('createdAt'),
-                            data.get('updatedAt'),
-                            None,
-                            raw_json,
-                        ),
-                    )
-                    synced['teachers'] += 1
-                    count += 1
-                except Exception:
-                    pass
-            # remove local teachers that are not in Firestore anymore
-            try:
-                cur.execute("SELECT id FROM teachers")
-                local_ids = set([r[0] for r in cur.fetchall() if r and r[0]])
-                to_remove = local_ids - fs_ids
-                if to_remove:
-                    cur.executemany("DELETE FROM teachers WHERE id = ?", [(i,) for i in to_remove])
-            except Exception:
-                pass
-            _partial_last_synced['teachers'] = count
+            return datetime.fromisoformat(text)
         except Exception:
-            pass
+            return None
+    return text
 
-        # Classes
-        try:
-            fs_ids = set()
-            count = 0
-            for doc in db_fs.collection('classes').stream():
-                fs_ids.add(doc.id)
-                data = doc.to_dict() or {}
-                class_id = doc.id
-                try:
-                    raw_json = json.dumps(data, default=str)
 
-                    # normalize time fields: Firestore may store Timestamp objects or nested maps
-                    def _to_iso(val):
-                        if val is None:
-                            return None
-                        try:
-                            # datetime-like objects
-                            if hasattr(val, 'isoformat'):
-                                return val.isoformat()
-                        except Exception:
-                            pass
-                        try:
-                            # some Firestore timestamp classes expose to_datetime or ToDatetime
-                            if hasattr(val, 'ToDatetime'):
-                                return val.ToDatetime().isoformat()
-                            if hasattr(val, 'to_datetime'):
-                                return val.to_datetime().isoformat()
-                            if hasattr(val, 'ToDatetime') or hasattr(val, 'to_datetime'):
-                                return str(val)
-                        except Exception:
-                            pass
-                        # fallback: stringify
-                        try:
-                            return str(val)
-                        except Exception:
-                            return None
-
-                    raw_time = data.get('time')
-                    # time may be a map {'start':..., 'end':...} or similar
-                    time_start = data.get('time_start') or data.get('timeStart') or None
-                    time_end = data.get('time_end') or data.get('timeEnd') or None
-                    if raw_time and isinstance(raw_time, dict):
-                        # prefer explicit keys if present
-                        time_start = raw_time.get('start') or raw_time.get('time_start') or time_start
-                        time_end = raw_time.get('end') or raw_time.get('time_end') or time_end
-
-                    time_start_s = _to_iso(time_start)
-                    time_end_s = _to_iso(time_end)
-
-                    # For the 'time' column, store a JSON string if it's a dict, else ISO/string
-                    if isinstance(raw_time, dict):
-                        time_val = json.dumps(raw_time, default=str)
-                    else:
-                        time_val = _to_iso(raw_time) if raw_time is not None else None
-
-                    cur.execute(
-                        "INSERT OR REPLACE INTO classes (id, name, gradeLevel, section, subjectName, roomId, roomNumber, teacher_id, days, time, time_start, time_end, createdAt, updatedAt, raw_doc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                        (
-                            class_id,
-                            data.get('name'),
-                            data.get('gradeLevel'),
-                            data.get('section'),
-                            data.get('subjectName'),
-                            data.get('roomId'),
-                            data.get('roomNumber'),
-                            data.get('teacherId'),
-                            data.get('days'),
-                            time_val,
-                            time_start_s,
-                            time_end_s,
-                            data.get('createdAt'),
-                            data.get('updatedAt'),
-                            raw_json,
-                        ),
-                    )
-                    synced['classes'] += 1
-                    count += 1
-                except Exception:
-                    pass
-            # remove local classes not present in Firestore and clean class_students
-            try:
-                cur.execute("SELECT id FROM classes")
-                local_ids = set([r[0] for r in cur.fetchall() if r and r[0]])
-                to_remove = local_ids - fs_ids
-                if to_remove:
-                    cur.executemany("DELETE FROM classes WHERE id = ?", [(i,) for i in to_remove])
-                    cur.executemany("DELETE FROM class_students WHERE class_id = ?", [(i,) for i in to_remove])
-            except Exception:
-                pass
-            _partial_last_synced['classes'] = count
+def _load_cursors(cur):
+    """Populate _partial_last_update/_partial_last_full from sync_cursors (once)."""
+    if _partial_last_update or _partial_last_full:
+        return
+    try:
+        cur.execute("SELECT collection, cursor, cursor_type, last_full_at FROM sync_cursors")
+        for name, text, ctype, last_full in cur.fetchall():
+            val = _decode_cursor(text, ctype)
+            if val is not None:
+                _partial_last_update[name] = val
+            if last_full:
+                _partial_last_full[name] = float(last_full)
+    except Exception:
+        pass
+
+
+def _save_cursor(cur, name):
+    text, ctype = (None, None)
+    if _partial_last_update.get(name) is not None:
+        text, ctype = _encode_cursor(_partial_last_update[name])
+    cur.execute(
+        "INSERT OR REPLACE INTO sync_cursors (collection, cursor, cursor_type, last_full_at) VALUES (?, ?, ?, ?)",
+        (name, text, ctype, _partial_last_full.get(name)),
+    )
+
+
+def _advance_cursor(cursor, val):
+    """Return the larger of cursor and val; values of another type are ignored."""
+    if val is None:
+        return cursor
+    if cursor is None:
+        return val if isinstance(val, (datetime, str)) else cursor
+    try:
+        if type(val) is type(cursor) or (isinstance(val, datetime) and isinstance(cursor, datetime)):
+            return val if val > cursor else cursor
+    except Exception:
+        pass
+    return cursor
+
+
+def _remote_pic_url(data):
+    return (data or {}).get('profilePicUrl') or (data or {}).get('profile_pic_url')
+
+
+def _needs_embedding(cur, table, row_id, data):
+    """Return the profile URL unless the row's embedding was already built from it, else None.
+
+    Compared against profile_photo_cache.embedded_url, which is only set once
+    an embedding was stored; raw_doc is updated even when the download or the
+    model failed, so a failed photo is retried on a later sync.
+    """
+    url = _remote_pic_url(data)
+    if not url:
+        return None
+    try:
+        cur.execute("SELECT embedded_url FROM profile_photo_cache WHERE role = ? AND doc_id = ?", (table, row_id))
+        row = cur.fetchone()
+    except Exception:
+        row = None
+    if row and row[0] == url:
+        return None
+    return url
+
+
+def _apply_teacher_doc(cur, teacher_id, data, regen=None):
+    raw_json = json.dumps(data, default=str)
+    url = _needs_embedding(cur, 'teachers', teacher_id, data)
+    # Upsert without touching embedding/profilePicUrl of an existing row; the
+    # WHERE clause turns unchanged documents into no-ops.
+    cur.execute(
+        """
+        INSERT INTO teachers (id, firstname, middlename, lastname, school_email, personal_email, status, temp_password, profilePicUrl, createdAt, updatedAt, raw_doc)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            firstname = excluded.firstname,
+            middlename = excluded.middlename,
+            lastname = excluded.lastname,
+            school_email = excluded.school_email,
+            personal_email = excluded.personal_email,
+            status = excluded.status,
+            temp_password = excluded.temp_password,
+            createdAt = excluded.createdAt,
+            updatedAt = excluded.updatedAt,
+            raw_doc = excluded.raw_doc
+        WHERE teachers.raw_doc IS NOT excluded.raw_doc
+    """,
+        (
+            teacher_id,
+            data.get('firstname'),
+            data.get('middlename'),
+            data.get('lastname'),
+            data.get('school_email'),
+            data.get('personal_email'),
+            data.get('status'),
+            data.get('temp_password'),
+            _remote_pic_url(data),
+            data.get('createdAt'),
+            data.get('updatedAt'),
+            raw_json,
+        ),
+    )
+    if url and regen is not None:
+        regen.append(('teachers', teacher_id, url))
+    return 0
+
+
+def _apply_class_doc(cur, class_id, data, regen=None):
+    raw_json = json.dumps(data, default=str)
+
+    raw_time = data.get('time')
+    # time may be a map {'start':..., 'end':...} or similar
+    time_start = data.get('time_start') or data.get('timeStart') or None
+    time_end = data.get('time_end') or data.get('timeEnd') or None
+    if raw_time and isinstance(raw_time, dict):
+        # prefer explicit keys if present
+        time_start = raw_time.get('start') or raw_time.get('time_start') or time_start
+        time_end = raw_time.get('end') or raw_time.get('time_end') or time_end
+
+    time_start_s = _to_iso(time_start)
+    time_end_s = _to_iso(time_end)
+
+    # For the 'time' column, store a JSON string if it's a dict, else ISO/string
+    if isinstance(raw_time, dict):
+        time_val = json.dumps(raw_time, default=str)
+    else:
+        time_val = _to_iso(raw_time) if raw_time is not None else None
+
+    # Upsert (not REPLACE) so class_students rows are not cascade-deleted
+    cur.execute(
+        """
+        INSERT INTO classes (id, name, gradeLevel, section, subjectName, roomId, roomNumber, teacher_id, days, time, time_start, time_end, createdAt, updatedAt, raw_doc)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            name = excluded.name,
+            gradeLevel = excluded.gradeLevel,
+            section = excluded.section,
+            subjectName = excluded.subjectName,
+            roomId = excluded.roomId,
+            roomNumber = excluded.roomNumber,
+            teacher_id = excluded.teacher_id,
+            days = excluded.days,
+            time = excluded.time,
+            time_start = excluded.time_start,
+            time_end = excluded.time_end,
+            createdAt = excluded.createdAt,
+            updatedAt = excluded.updatedAt,
+            raw_doc = excluded.raw_doc
+        WHERE classes.raw_doc IS NOT excluded.raw_doc
+    """,
+        (
+            class_id,
+            data.get('name'),
+            data.get('gradeLevel'),
+            data.get('section'),
+            data.get('subjectName'),
+            data.get('roomId'),
+            data.get('roomNumber'),
+            data.get('teacherId'),
+            data.get('days'),
+            time_val,
+            time_start_s,
+            time_end_s,
+            data.get('createdAt'),
+            data.get('updatedAt'),
+            raw_json,
+        ),
+    )
+    state.invalidate_class_meta([class_id])
+    return 0
+
+
+def _apply_student_doc(cur, student_id, data, regen=None):
+    """Upsert a student row and diff its class_students links; returns links added."""
+    raw_json = json.dumps(data, default=str)
+    url = _needs_embedding(cur, 'students', student_id, data)
+    cur.execute(
+        """
+        INSERT INTO students (id, firstname, middlename, lastname, school_email, personal_email, guardianname, guardiancontact, status, temp_password, profilePicUrl, createdAt, updatedAt, raw_doc)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            firstname = excluded.firstname,
+            middlename = excluded.middlename,
+            lastname = excluded.lastname,
+            school_email = excluded.school_email,
+            personal_email = excluded.personal_email,
+            guardianname = excluded.guardianname,
+            guardiancontact = excluded.guardiancontact,
+            status = excluded.status,
+            temp_password = excluded.temp_password,
+            createdAt = excluded.createdAt,
+            updatedAt = excluded.updatedAt,
+            raw_doc = excluded.raw_doc
+        WHERE students.raw_doc IS NOT excluded.raw_doc
+    """,
+        (
+            student_id,
+            data.get('firstname'),
+            data.get('middlename'),
+            data.get('lastname'),
+            data.get('school_email'),
+            data.get('personal_email'),
+            data.get('guardianname'),
+            data.get('guardiancontact'),
+            data.get('status'),
+            data.get('temp_password'),
+            _remote_pic_url(data),
+            data.get('createdAt'),
+            data.get('updatedAt'),
+            raw_json,
+        ),
+    )
+    if url and regen is not None:
+        regen.append(('students', student_id, url))
+
+    # Update class_students: only insert/delete the links that changed
+    wanted = set(c for c in (data.get('classes') or []) if c)
+    try:
+        cur.execute("SELECT class_id FROM class_students WHERE student_id = ?", (student_id,))
+        existing = set(r[0] for r in cur.fetchall())
+    except Exception:
+        existing = set()
+    stale = existing - wanted
+    if stale:
+        cur.executemany("DELETE FROM class_students WHERE class_id = ? AND student_id = ?", [(c, student_id) for c in stale])
+    links = 0
+    for class_id in wanted - existing:
+        try:
+            cur.execute("INSERT OR IGNORE INTO classes (id, raw_doc) VALUES (?, ?)", (class_id, None))
+            cur.execute("INSERT OR IGNORE INTO class_students (class_id, student_id) VALUES (?, ?)", (class_id, student_id))
+            links += 1
         except Exception:
             pass
+    return links
 
-        # Students and class_students
+
+def _apply_kiosk_doc(cur, fs_id, data, regen=None):
+    raw_json = json.dumps(data, default=str)
+    name = data.get('name') or data.get('displayName')
+    serial = data.get('serialNumber') or data.get('serial_number') or data.get('serial')
+    assignedRoomId = data.get('assignedRoomId') or data.get('assigned_room_id') or data.get('assignedRoom')
+    ip = data.get('ipAddress') or data.get('ip_address') or data.get('ip')
+    mac = data.get('macAddress') or data.get('mac_address') or data.get('mac')
+    status_val = data.get('status')
+    installedAt = str(data.get('installedAt')) if data.get('installedAt') is not None else None
+    updatedAt = str(data.get('updatedAt')) if data.get('updatedAt') is not None else None
+    cur.execute(
+        """
+        INSERT INTO kiosks_fs (fs_id, name, serialNumber, assignedRoomId, ipAddress, macAddress, status, installedAt, updatedAt, raw_doc)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(fs_id) DO UPDATE SET
+            name = excluded.name,
+            serialNumber = excluded.serialNumber,
+            assignedRoomId = excluded.assignedRoomId,
+            ipAddress = excluded.ipAddress,
+            macAddress = excluded.macAddress,
+            status = excluded.status,
+            installedAt = excluded.installedAt,
+            updatedAt = excluded.updatedAt,
+            raw_doc = excluded.raw_doc
+        WHERE kiosks_fs.raw_doc IS NOT excluded.raw_doc
+    """,
+        (fs_id, name, serial, assignedRoomId, ip, mac, status_val, installedAt, updatedAt, raw_json),
+    )
+    return 0
+
+
+def _store_embedding(conn, table, row_id, url, emb, local_path):
+    conn.execute(
+        f"UPDATE {table} SET embedding = COALESCE(?, embedding), profilePicUrl = COALESCE(?, profilePicUrl) WHERE id = ?",
+        (emb, local_path, row_id),
+    )
+    if emb is not None:
+        conn.execute(_MARK_EMBEDDED_SQL, (url, table, row_id))
+
+
+def _regenerate_embeddings(regen):
+    """Compute embeddings for rows whose profile photo changed (via the photo/embedding cache)."""
+    if not regen:
+        return 0
+    updated = 0
+    state.ensure_schema(_ensure_embedding_cache_tables)
+    for table, row_id, url in regen:
         try:
-            fs_ids = set()
-            count = 0
-            for doc in db_fs.collection('students').stream():
-                fs_ids.add(doc.id)
-                data = doc.to_dict() or {}
-                student_id = doc.id
-                try:
-                    raw_json = json.dumps(data, default=str)
-                    cur.execute(
-                        "INSERT OR REPLACE INTO students (id, firstname, middlename, lastname, school_email, personal_email, guardianname, guardiancontact, status, temp_password, profilePicUrl, createdAt, updatedAt, embedding, raw_doc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                        (
-                            student_id,
-                            data.get('firstname'),
-                            data.get('middlename'),
-                            data.get('lastname'),
-                            data.get('school_email'),
-                            data.get('personal_email'),
-                            data.get('guardianname'),
-                            data.get('guardiancontact'),
-                            data.get('status'),
-                            data.get('temp_password'),
-                            data.get('profilePicUrl') or data.get('profile_pic_url'),
-                            data.get('createdAt'),
-                            data.get('updatedAt'),
-                            None,
-                            raw_json,
-                        ),
-                    )
-                    synced['students'] += 1
-                    count += 1
-
-                    # Update class_students
-                    classes_arr = data.get('classes') or []
-                    try:
-                        cur.execute("DELETE FROM class_students WHERE student_id = ?", (student_id,))
-                    except Exception:
-                        pass
-                    for class_id in classes_arr:
-                        try:
-                            cur.execute("INSERT OR IGNORE INTO classes (id, raw_doc) VALUES (?, ?)", (class_id, None))
-                            cur.execute("INSERT OR IGNORE INTO class_students (class_id, student_id) VALUES (?, ?)", (class_id, student_id))
-                            synced['class_students'] += 1
-                        except Exception:
-                            pass
-                except Exception:
-                    pass
-            # remove local students that are not in Firestore and their class links
-            try:
-                cur.execute("SELECT id FROM students")
-                local_ids = set([r[0] for r in cur.fetchall() if r and r[0]])
-                to_remove = local_ids - fs_ids
-                if to_remove:
-                    cur.executemany("DELETE FROM students WHERE id = ?", [(i,) for i in to_remove])
-                    cur.executemany("DELETE FROM class_students WHERE student_id = ?", [(i,) for i in to_remove])
-            except Exception:
-                pass
-            _partial_last_synced['students'] = count
+            emb, local_path = _profile_embedding(table, row_id, url)
+            if emb is None and not local_path:
+                continue
+            state.run_write(_store_embedding, table, row_id, url, emb, local_path)
+            if emb is not None:
+                updated += 1
+        except Exception as e:
+            print(f"Embedding regeneration failed for {table} {row_id}: {e}")
+    if updated:
+        try:
+            state.load_embeddings()
         except Exception:
             pass
+    return updated
+
 
-        # Kiosks
+def _apply_room_doc(cur, fs_id, data, regen=None):
+    raw_json = json.dumps(data, default=str)
+    roomname = data.get("roomname") or data.get("name")
+    kioskid = data.get("kioskId") or data.get("kioskid") or data.get("kiosk")
+    assignedteachers = json.dumps(data.get("assignedTeachers") or data.get("assigned_teachers") or [])
+    currentsessionid = data.get("currentsessionId") or data.get("currentsessionid") or data.get("currentsession")
+    isactive = str(data.get("isActive")) if data.get("isActive") is not None else None
+    createdat = str(data.get("createdAt")) if data.get("createdAt") is not None else None
+    updatedat = str(data.get("updatedAt")) if data.get("updatedAt") is not None else None
+    cur.execute(
+        """
+        INSERT INTO rooms_fs (fs_id, roomname, kioskid, assignedteachers, currentsessionid, isactive, createdat, updatedat, raw_doc)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(fs_id) DO UPDATE SET
+            roomname = excluded.roomname,
+            kioskid = excluded.kioskid,
+            assignedteachers = excluded.assignedteachers,
+            currentsessionid = excluded.currentsessionid,
+            isactive = excluded.isactive,
+            createdat = excluded.createdat,
+            updatedat = excluded.updatedat,
+            raw_doc = excluded.raw_doc
+        WHERE rooms_fs.raw_doc IS NOT excluded.raw_doc
+    """,
+        (fs_id, roomname, kioskid, assignedteachers, currentsessionid, isactive, createdat, updatedat, raw_json),
+    )
+    return 0
+
+
+def _ensure_registry_tables(conn):
+    """Create the Firestore mirror tables for rooms and kiosks if missing."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rooms_fs (
+            fs_id TEXT PRIMARY KEY,
+            roomname TEXT,
+            kioskid TEXT,
+            assignedteachers JSON,
+            currentsessionid TEXT,
+            isactive TEXT,
+            createdat TEXT,
+            updatedat TEXT,
+            raw_doc JSON
+        )
+    """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS kiosks_fs (
+            fs_id TEXT PRIMARY KEY,
+            name TEXT,
+            serialNumber TEXT,
+            assignedRoomId TEXT,
+            ipAddress TEXT,
+            macAddress TEXT,
+            status TEXT,
+            installedAt TEXT,
+            updatedAt TEXT,
+            raw_doc JSON
+        )
+    """
+    )
+
+
+def _delete_teachers(cur, ids):
+    cur.executemany("DELETE FROM teachers WHERE id = ?", [(i,) for i in ids])
+
+
+def _delete_classes(cur, ids):
+    cur.executemany("DELETE FROM classes WHERE id = ?", [(i,) for i in ids])
+    state.invalidate_class_meta(ids)
+    cur.executemany("DELETE FROM class_students WHERE class_id = ?", [(i,) for i in ids])
+
+
+def _delete_students(cur, ids):
+    cur.executemany("DELETE FROM students WHERE id = ?", [(i,) for i in ids])
+    cur.executemany("DELETE FROM class_students WHERE student_id = ?", [(i,) for i in ids])
+
+
+def _delete_kiosks(cur, ids):
+    cur.executemany("DELETE FROM kiosks_fs WHERE fs_id = ?", [(i,) for i in ids])
+
+
+def _delete_rooms(cur, ids):
+    cur.executemany("DELETE FROM rooms_fs WHERE fs_id = ?", [(i,) for i in ids])
+
+
+# collection -> (local table, id column, apply fn, delete fn)
+_PARTIAL_HANDLERS = {
+    'teachers': ('teachers', 'id', _apply_teacher_doc, _delete_teachers),
+    'classes': ('classes', 'id', _apply_class_doc, _delete_classes),
+    'students': ('students', 'id', _apply_student_doc, _delete_students),
+    'kiosks': ('kiosks_fs', 'fs_id', _apply_kiosk_doc, _delete_kiosks),
+    'rooms': ('rooms_fs', 'fs_id', _apply_room_doc, _delete_rooms),
+}
+
+
+def _full_reconcile_interval():
+    try:
+        return int(os.environ.get('BACKGROUND_FULL_RECONCILE_INTERVAL', '300'))
+    except Exception:
+        return 300
+
+
+def _fetch_partial_collection(name, force_full=False):
+    """Read one collection's changes from Firestore (no database access).
+
+    Uses a `where('updatedAt', '>', cursor)` delta query when a cursor is
+    known; falls back to a full scan (which also lets the apply step remove
+    rows deleted in Firestore) when there is no cursor or the reconcile
+    interval elapsed. Returns (docs, full, started_at).
+    """
+    cursor = _partial_last_update.get(name)
+    now = time.time()
+    last_full = _partial_last_full.get(name)
+    full = force_full or cursor is None or last_full is None or (now - last_full) >= _full_reconcile_interval()
+
+    if full:
+        stream = db_fs.collection(name).stream()
+    else:
+        stream = db_fs.collection(name).where('updatedAt', '>', cursor).stream()
+    docs = [(doc.id, doc.to_dict() or {}) for doc in stream]
+    return docs, full, now
+
+
+def _apply_partial_collection(cur, name, docs, full, started_at, synced, regen=None):
+    """Apply fetched documents to the local table (runs on the writer).
+
+    Returns True when the collection's cursor row needs saving.
+    """
+    table, id_col, apply_fn, delete_fn = _PARTIAL_HANDLERS[name]
+    cursor = _partial_last_update.get(name)
+    fs_ids = set()
+    count = 0
+    new_cursor = cursor
+    for doc_id, data in docs:
+        fs_ids.add(doc_id)
         try:
-            fs_ids = set()
-            count = 0
-            for doc in db_fs.collection('kiosks').stream():
-                fs_ids.add(doc.id)
-                data = doc.to_dict() or {}
-                fs_id = doc.id
-                try:
-                    raw_json = json.dumps(data, default=str)
-                    name = data.get('name') or data.get('displayName')
-                    serial = data.get('serialNumber') or data.get('serial_number') or data.get('serial')
-                    assignedRoomId = data.get('assignedRoomId') or data.get('assigned_room_id') or data.get('assignedRoom')
-                    ip = data.get('ipAddress') or data.get('ip_address') or data.get('ip')
-                    mac = data.get('macAddress') or data.get('mac_address') or data.get('mac')
-                    status_val = data.get('status')
-                    installedAt = str(data.get('installedAt')) if data.get('installedAt') is not None else None
-                    updatedAt = str(data.get('updatedAt')) if data.get('updatedAt') is not None else None
-                    cur.execute(
-                        "INSERT OR REPLACE INTO kiosks_fs (fs_id, name, serialNumber, assignedRoomId, ipAddress, macAddress, status, installedAt, updatedAt, raw_doc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                        (fs_id, name, serial, assignedRoomId, ip, mac, status_val, installedAt, updatedAt, raw_json),
-                    )
-                    synced['kiosks'] += 1
-                    count += 1
-                except Exception:
-                    pass
-            # remove local kiosks that are no longer in Firestore
-            try:
-                cur.execute("SELECT fs_id FROM kiosks_fs")
-                local_ids = set([r[0] for r in cur.fetchall() if r and r[0]])
-                to_remove = local_ids - fs_ids
-                if to_remove:
-                    cur.executemany("DELETE FROM kiosks_fs WHERE fs_id = ?", [(i,) for i in to_remove])
-            except Exception:
-                pass
-            _partial_last_synced['kiosks'] = count
+            links = apply_fn(cur, doc_id, data, regen)
+            synced[name] += 1
+            if links:
+                synced['class_students'] += links
+            count += 1
         except Exception:
-            pass
+            continue
+        new_cursor = _advance_cursor(new_cursor, data.get('updatedAt'))
 
+    if full:
+        # remove local rows that are not in Firestore anymore
         try:
-            conn.commit()
+            cur.execute(f"SELECT {id_col} FROM {table}")
+            local_ids = set([r[0] for r in cur.fetchall() if r and r[0]])
+            to_remove = local_ids - fs_ids
+            if to_remove:
+                delete_fn(cur, to_remove)
         except Exception:
             pass
+        _partial_last_full[name] = started_at
+
+    _partial_last_synced[name] = count
+    changed = full or new_cursor != cursor
+    _partial_last_update[name] = new_cursor
+    return changed
+
+
+@metrics.SYNC_SECONDS.time(("partial",))
+def _sync_partial_collections(force_full=False):
+    """Pull changes for the target Firestore collections into local DB tables.
+
+    Firestore is read first; the results are then applied in one command on
+    the database writer so the network never holds the write lock.
+    Returns a dict summary or {'error': ...} on failure.
+    """
+    global _partial_last_run
+    if not db_fs:
+        return {'error': 'firestore_not_configured'}
+
+    try:
+        state.ensure_schema(_ensure_cursor_table)
+        state.ensure_schema(_ensure_registry_tables)
+        conn = state.get_read_db()
         try:
+            _load_cursors(conn.cursor())
+        finally:
             conn.close()
-        except Exception:
-            pass
 
+        fetched = []
+        for name in PARTIAL_COLLECTIONS:
+            try:
+                fetched.append((name,) + _fetch_partial_collection(name, force_full=force_full))
+            except Exception as e:
+                print(f'partial sync of {name} failed: {e}')
+
+        synced = {'students': 0, 'teachers': 0, 'classes': 0, 'kiosks': 0, 'rooms': 0, 'class_students': 0}
+        regen = []
+
+        def _apply(conn):
+            cur = conn.cursor()
+            for name, docs, full, started_at in fetched:
+                try:
+                    if _apply_partial_collection(cur, name, docs, full, started_at, synced, regen=regen):
+                        _save_cursor(cur, name)
+                except Exception as e:
+                    print(f'partial sync of {name} failed: {e}')
+
+        if fetched:
+            state.run_write(_apply)
+
+        # photo download/inference happens outside the sync transaction
+        if regen:
+            synced['embeddings'] = _regenerate_embeddings(regen)
+
+        _partial_last_run = time.time()
         return {'status': 'ok', 'synced': synced}
     except Exception as e:
-        try:
-            if conn:
-                conn.rollback()
-                conn.close()
-        except Exception:
-            pass
         return {'error': str(e)}
 
 
@@ -865,7 +1323,12 @@ def start_partial_background_sync():
     """Start a daemon thread that polls Firestore for the target collections.
 
     Controlled by env var ENABLE_BACKGROUND_SYNC (default '1') and interval
-    by BACKGROUND_PARTIAL_SYNC_INTERVAL (seconds, default 3).
+    by BACKGROUND_PARTIAL_SYNC_INTERVAL (seconds, default 3). Each tick is a
+    delta query per collection; a full scan that also applies deletions runs
+    every BACKGROUND_FULL_RECONCILE_INTERVAL seconds (default 300).
+
+    SYNC_MODE=listen uses Firestore on_snapshot listeners (see
+    api/realtime_sync.py) instead of polling.
     """
     global _partial_bg_thread, _partial_bg_started
     try:
@@ -883,13 +1346,25 @@ def start_partial_background_sync():
     if _partial_bg_started:
         return _partial_bg_thread
 
+    mode = str(os.environ.get('SYNC_MODE', 'poll')).strip().lower()
+    if mode == 'listen' and db_fs:
+        try:
+            from . import realtime_sync
+            t = realtime_sync.start()
+            if t is not None:
+                _partial_bg_thread = t
+                _partial_bg_started = True
+                return t
+        except Exception as e:
+            print(f'realtime sync unavailable, falling back to polling: {e}')
+
     try:
         interval = int(os.environ.get('BACKGROUND_PARTIAL_SYNC_INTERVAL', '3'))
     except Exception:
         interval = 3
 
     try:
-        _partial_bg_thread = threading.Thread(target=_partial_bg_loop, args=(interval,), daemon=True)
+        _partial_bg_thread = threading.Thread(target=_partial_bg_loop, args=(interval,), name='sync-partial', daemon=True)
         _partial_bg_thread.start()
         _partial_bg_started = True
         return _partial_bg_thread
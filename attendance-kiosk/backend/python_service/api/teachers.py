@@ -20,7 +20,7 @@ def get_teachers_by_ids(ids: str = ""):
         if not id_list:
             return {"teachers": []}
 
-        conn = state.get_db()
+        conn = state.get_read_db()
         cur = conn.cursor()
         placeholders = ",".join(["?" for _ in id_list])
         query = f"SELECT id, firstname, lastname, profilePicUrl FROM teachers WHERE id IN ({placeholders})"
@@ -0,0 +1,43 @@
+"""Backend entry point used by benchmarks/load_test.py.
+
+Runs main:app under uvicorn against the SQLite file in LOADTEST_DB with
+the in-process fake Firestore (FIRESTORE_BACKEND=fake, configured through
+the FAKE_FIRESTORE_* variables, see api/fake_firestore.py). The startup
+sync fills the local database from the fake's seeded school, and outbox
+and notification writes pay FAKE_FIRESTORE_LATENCY_MS per round trip.
+
+    LOADTEST_DB=/tmp/load.db FAKE_FIRESTORE_SEED=school python benchmarks/load_server.py --port 8765
+"""
+import argparse
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="kiosk backend for load tests")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    args = p.parse_args(argv)
+
+    db_path = os.environ.get("LOADTEST_DB")
+    if not db_path:
+        print("LOADTEST_DB is required", file=sys.stderr)
+        return 2
+    os.environ.setdefault("ENABLE_BACKGROUND_SYNC", "0")
+    os.environ.setdefault("FIRESTORE_BACKEND", "fake")
+
+    from api import state
+    state.DB_PATH = os.path.abspath(db_path)
+
+    import main as service
+
+    import uvicorn
+    uvicorn.run(service.app, host=args.host, port=args.port, log_level="warning", access_log=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
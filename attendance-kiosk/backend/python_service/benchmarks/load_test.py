@@ -0,0 +1,372 @@
+"""HTTP load test replaying the kiosk frontend's polling mix.
+
+Each simulated kiosk display issues the same requests, at the same
+intervals, as the React frontend's system-service screen (setInterval
+semantics: a request fires every tick whether or not the previous one has
+returned), plus the /camera-feed loop that refetches 66 ms after each
+frame. One display also sends bursts of /session/mark for the active
+session. Displays are added in stages (--kiosks 1,2,4,8) to find how many
+one backend can serve.
+
+By default the backend is started for the run (benchmarks/load_server.py)
+against a fresh SQLite file, the in-process fake Firestore seeded with a
+one-class school (pulled into SQLite by the startup sync) and a fake
+camera (a looping replay of generated frames, or --camera PATH), so
+inference runs while the API is under load. --url targets an already
+running backend instead; start it with FIRESTORE_BACKEND=fake,
+FAKE_FIRESTORE_SEED=school and the FAKE_FIRESTORE_SCHOOL printed in meta.
+
+Output is one JSON document: per stage and per route, latency percentiles
+and histogram (ms), status counts and error rate, plus /session/mark on
+its own, the server's /debug/pipeline summary and the fake Firestore's
+round-trip counters.
+
+    python benchmarks/load_test.py --kiosks 1,2,4,8 --duration 30 --out load.json
+"""
+import argparse
+import asyncio
+from bisect import bisect_right
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import httpx
+except Exception:
+    httpx = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(HERE)
+
+# (path, interval seconds, frontend component) for one kiosk display
+POLLERS = (
+    ("/detect", 0.7, "cameraFeed"),
+    ("/detect", 0.8, "bottomInfo"),
+    ("/recognize-camera", 0.8, "cameraFeed"),
+    ("/recognize-teacher", 1.0, "topInfo"),
+    ("/recognize-teacher", 1.5, "cameraFeed"),
+    ("/recognize-teacher", 1.5, "bottomInfo"),
+    ("/unrecognized", 1.2, "cameraFeed"),
+    ("/session", 3.0, "topInfo"),
+    ("/session", 3.0, "bottomInfo"),
+    ("/session", 3.0, "cameraFeed"),
+    ("/session/attendance", 1.5, "cameraFeed"),
+    ("/session/attendance", 3.0, "bottomInfo"),
+    ("/monitor/status", 5.0, "networkStatus"),
+    ("/device/info", 3.0, "App"),
+)
+# cameraFeed.jsx schedules the next frame 66 ms after the previous one finished
+CAMERA_FEED_GAP = 0.066
+REQUEST_TIMEOUT = 5.0
+HIST_BOUNDS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    p.add_argument("--kiosks", default="1,2,4,8", help="comma-separated display counts, one stage each")
+    p.add_argument("--duration", type=float, default=30.0, help="seconds per stage")
+    p.add_argument("--url", help="use a running backend instead of starting one")
+    p.add_argument("--students", type=int, default=60, help="students seeded into the class")
+    p.add_argument("--burst-size", type=int, default=10, help="marks per burst")
+    p.add_argument("--burst-every", type=float, default=10.0, help="seconds between mark bursts")
+    p.add_argument("--no-camera-feed", action="store_true", help="leave out the /camera-feed loop")
+    p.add_argument("--camera", help="video file or image directory for the fake camera")
+    p.add_argument("--firestore-fail-rate", type=float, default=0.0, help="fake Firestore injected failure rate")
+    p.add_argument("--firestore-latency-ms", type=float, default=50.0, help="fake Firestore round-trip latency")
+    p.add_argument("--slo-p99-ms", type=float, default=500.0, help="p99 target used for max_kiosks_within_slo")
+    p.add_argument("--max-error-rate", type=float, default=0.01)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--out", help="also write the JSON result to this file")
+    return p.parse_args(argv)
+
+
+# --- setup ------------------------------------------------------------------
+
+def school_spec(students):
+    return f"teachers=1,classes=1,rooms=1,students={students},per_class={students}"
+
+
+def school(students):
+    """The fake Firestore's seeded school: (teacher, class, student ids) of its one class."""
+    sys.path.insert(0, SERVICE_DIR)
+    from api import fake_firestore
+    data = fake_firestore.school_dataset(**fake_firestore.parse_school_spec(school_spec(students)))
+    class_id, cls = next(iter(data["classes"].items()))
+    teacher = data["teachers"][cls["teacherId"]]
+    student_ids = sorted(sid for sid, doc in data["students"].items() if class_id in doc["classes"])
+    return {
+        "teacher_id": cls["teacherId"], "teacher_name": f"{teacher['firstname']} {teacher['lastname']}",
+        "class_id": class_id, "class_name": cls["name"],
+    }, student_ids
+
+
+def fake_camera_dir(path, frames=30):
+    """Write noise frames for the replay camera; None when OpenCV is missing."""
+    try:
+        import cv2
+        import numpy as np
+    except Exception:
+        return None
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(0)
+    for i in range(frames):
+        cv2.imwrite(os.path.join(path, f"frame{i:03d}.jpg"), rng.integers(0, 255, (480, 640, 3), dtype=np.uint8))
+    return path
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(db_path, camera, args):
+    port = _free_port()
+    env = dict(os.environ)
+    env.update({
+        "LOADTEST_DB": db_path,
+        "FIRESTORE_BACKEND": "fake",
+        "FAKE_FIRESTORE_SEED": "school",
+        "FAKE_FIRESTORE_SCHOOL": school_spec(args.students),
+        "FAKE_FIRESTORE_LATENCY_MS": str(args.firestore_latency_ms),
+        "FAKE_FIRESTORE_FAIL_RATE": str(args.firestore_fail_rate),
+        "CAM_INDEX": "-1",
+        "CAM_REPLAY_LOOP": "1",
+    })
+    if camera:
+        env["CAM_DEVICE"] = camera
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "load_server.py"), "--port", str(port)],
+        cwd=SERVICE_DIR, env=env, stdout=sys.stderr,  # keep our stdout a single JSON document
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 90
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"backend exited with {proc.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                pass
+            if httpx.get(url + "/health", timeout=2.0).status_code == 200:
+                return proc, url
+        except Exception:
+            pass
+        time.sleep(0.5)
+    proc.terminate()
+    raise RuntimeError("backend did not become healthy")
+
+
+# --- load -------------------------------------------------------------------
+
+class Recorder:
+    def __init__(self):
+        self.routes = {}
+        self.max_lag = 0.0
+
+    def add(self, route, ms, status):
+        r = self.routes.setdefault(route, {"lat": [], "status": {}})
+        r["lat"].append(ms)
+        r["status"][status] = r["status"].get(status, 0) + 1
+
+    def lag(self, seconds):
+        self.max_lag = max(self.max_lag, seconds)
+
+
+async def _request(client, rec, method, path, route=None, **kwargs):
+    start = time.perf_counter()
+    try:
+        resp = await client.request(method, path, timeout=REQUEST_TIMEOUT, **kwargs)
+        await resp.aread()
+        status = str(resp.status_code)
+    except httpx.TimeoutException:
+        status = "timeout"
+    except Exception:
+        status = "error"
+    rec.add(route or path, (time.perf_counter() - start) * 1000.0, status)
+
+
+async def _poller(client, rec, path, interval, stop_at, pending):
+    # displays do not start in lockstep
+    next_at = time.perf_counter() + random.uniform(0, interval)
+    while True:
+        now = time.perf_counter()
+        if now < next_at:
+            await asyncio.sleep(next_at - now)
+        if time.perf_counter() >= stop_at:
+            return
+        rec.lag(time.perf_counter() - next_at)
+        pending.add(asyncio.ensure_future(_request(client, rec, "GET", path)))
+        next_at += interval
+
+
+async def _camera_feed(client, rec, stop_at):
+    await asyncio.sleep(random.uniform(0, CAMERA_FEED_GAP))
+    while time.perf_counter() < stop_at:
+        await _request(client, rec, "GET", "/camera-feed")
+        await asyncio.sleep(CAMERA_FEED_GAP)
+
+
+async def _marks(client, rec, student_ids, size, every, stop_at):
+    cursor = 0
+    while True:
+        await asyncio.sleep(every)
+        if time.perf_counter() >= stop_at:
+            return
+        burst = []
+        for _ in range(size):
+            sid = student_ids[cursor % len(student_ids)]
+            cursor += 1
+            burst.append(_request(client, rec, "POST", "/session/mark", route="/session/mark",
+                                  json={"student_id": sid, "student_name": sid}))
+        await asyncio.gather(*burst)
+
+
+def _percentile(sorted_vals, pct):
+    idx = min(len(sorted_vals) - 1, max(0, int(round(pct / 100.0 * (len(sorted_vals) - 1)))))
+    return sorted_vals[idx]
+
+
+def _route_summary(data, duration):
+    lat = sorted(data["lat"])
+    total = len(lat)
+    errors = sum(n for s, n in data["status"].items() if not s.startswith("2"))
+    # cumulative, like Prometheus "le" buckets
+    hist = {f"le_{bound}": bisect_right(lat, bound) for bound in HIST_BOUNDS_MS}
+    hist["le_inf"] = total
+    return {
+        "requests": total,
+        "rps": round(total / duration, 2) if duration else None,
+        "p50_ms": round(_percentile(lat, 50), 2) if lat else None,
+        "p90_ms": round(_percentile(lat, 90), 2) if lat else None,
+        "p99_ms": round(_percentile(lat, 99), 2) if lat else None,
+        "max_ms": round(lat[-1], 2) if lat else None,
+        "status": data["status"],
+        "error_rate": round(errors / total, 4) if total else None,
+        "histogram_ms": hist,
+    }
+
+
+async def run_stage(url, kiosks, args, student_ids):
+    rec = Recorder()
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=64 * kiosks)
+    async with httpx.AsyncClient(base_url=url, limits=limits) as client:
+        started = time.perf_counter()
+        stop_at = started + args.duration
+        pending = set()
+        tasks = []
+        for _k in range(kiosks):
+            for path, interval, _src in POLLERS:
+                tasks.append(asyncio.ensure_future(_poller(client, rec, path, interval, stop_at, pending)))
+            if not args.no_camera_feed:
+                tasks.append(asyncio.ensure_future(_camera_feed(client, rec, stop_at)))
+        if args.burst_size > 0:
+            tasks.append(asyncio.ensure_future(
+                _marks(client, rec, student_ids, args.burst_size, args.burst_every, stop_at)))
+        await asyncio.gather(*tasks)
+        if pending:
+            await asyncio.gather(*pending)
+        elapsed = time.perf_counter() - started
+
+    routes = {route: _route_summary(data, elapsed) for route, data in sorted(rec.routes.items())}
+    all_lat = {"lat": [v for d in rec.routes.values() for v in d["lat"]], "status": {}}
+    for d in rec.routes.values():
+        for s, n in d["status"].items():
+            all_lat["status"][s] = all_lat["status"].get(s, 0) + n
+    overall = _route_summary(all_lat, elapsed)
+    overall.pop("histogram_ms", None)
+    return {
+        "kiosks": kiosks,
+        "duration_s": round(elapsed, 2),
+        "overall": overall,
+        "mark": routes.get("/session/mark"),
+        "routes": routes,
+        # a large value means the load generator itself could not keep up
+        "client_max_lag_ms": round(rec.max_lag * 1000.0, 1),
+    }
+
+
+def _get_json(url, path):
+    try:
+        return httpx.get(url + path, timeout=REQUEST_TIMEOUT).json()
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if httpx is None:
+        print(json.dumps({"error": "missing_dependency", "detail": "httpx is required"}))
+        return 2
+    random.seed(args.seed)
+    stages = [int(k) for k in str(args.kiosks).split(",") if k.strip()]
+
+    proc = None
+    camera = args.camera
+    session_body, student_ids = school(args.students)
+    tmpdir = None
+    url = args.url
+    if not url:
+        tmpdir = tempfile.mkdtemp(prefix="kiosk-load-")
+        db_path = os.path.join(tmpdir, "load.db")
+        camera = camera or fake_camera_dir(os.path.join(tmpdir, "camera"))
+        if not camera:
+            # without OpenCV the backend has no frames; /camera-feed would only measure 503s
+            args.no_camera_feed = True
+        proc, url = start_server(db_path, camera, args)
+
+    result = {"meta": {
+        "url": url,
+        "spawned_backend": proc is not None,
+        "camera": camera or "none",
+        "stages": stages,
+        "duration_s": args.duration,
+        "mark_burst": {"size": args.burst_size, "every_s": args.burst_every},
+        "pollers_per_kiosk": [{"path": p, "interval_s": i, "source": s} for p, i, s in POLLERS],
+        "camera_feed_loop": not args.no_camera_feed,
+        "fake_firestore": {"school": school_spec(args.students), "latency_ms": args.firestore_latency_ms,
+                           "fail_rate": args.firestore_fail_rate},
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }}
+    try:
+        start = httpx.post(url + "/session/start", json=session_body, timeout=REQUEST_TIMEOUT)
+        result["meta"]["session_start_status"] = start.status_code
+
+        result["stages"] = []
+        for kiosks in stages:
+            result["stages"].append(asyncio.run(run_stage(url, kiosks, args, student_ids)))
+
+        within = [s["kiosks"] for s in result["stages"]
+                  if s["overall"]["p99_ms"] is not None
+                  and s["overall"]["p99_ms"] <= args.slo_p99_ms
+                  and (s["overall"]["error_rate"] or 0) <= args.max_error_rate]
+        result["max_kiosks_within_slo"] = max(within) if within else 0
+        result["slo"] = {"p99_ms": args.slo_p99_ms, "max_error_rate": args.max_error_rate}
+        result["server"] = {
+            "pipeline": _get_json(url, "/debug/pipeline"),
+            "outbox": _get_json(url, "/sync/outbox/status"),
+            "firestore": _get_json(url, "/debug/fake-firestore"),
+        }
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except Exception:
+                proc.kill()
+
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,306 @@
+"""Offline benchmark for the face recognition pipeline.
+
+Replays a recorded video file or an image directory through the same code
+the kiosk runs (recognition._process_frame, or the real capture -> infer
+threads with --mode pipeline) against a synthetic gallery, and prints one
+JSON document with per-stage latency percentiles, end-to-end FPS, match
+accuracy against ground truth and peak RSS. Keep the JSON files to compare
+commits and model packs.
+
+    python benchmarks/recognition_bench.py --source /data/bench/faces --gallery 1000 --out bench.json
+
+Ground truth:
+  image directory  <source>/<identity>/<image>.jpg -- the first directory
+                   component names the identity (images at the top level
+                   are unlabelled impostor frames)
+  --labels FILE    JSON mapping frame names (image path relative to the
+                   source, or a video frame index) or inclusive "start-end"
+                   frame-index ranges to an identity
+
+The first --enroll labelled frames of each identity are used to build its
+gallery embedding and are left out of the accuracy figures. The gallery is
+padded with --gallery random student embeddings (and --teachers random
+teacher embeddings) so matching cost scales like a real school.
+
+Needs the kiosk's runtime dependencies (opencv, numpy, insightface).
+Database lookups done while handling matches go to a throwaway SQLite file.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(HERE)
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    p.add_argument("--source", required=True, help="video file or image directory to replay")
+    p.add_argument("--labels", help="JSON ground-truth file (see module docstring)")
+    p.add_argument("--mode", choices=("sequential", "pipeline"), default="sequential",
+                   help="sequential: every frame through _process_frame; pipeline: real capture/encode/infer threads")
+    p.add_argument("--gallery", type=int, default=500, help="synthetic student identities added to the gallery")
+    p.add_argument("--teachers", type=int, default=50, help="synthetic teacher identities")
+    p.add_argument("--enroll", type=int, default=1, help="labelled frames per identity used for enrollment")
+    p.add_argument("--frames", type=int, default=0, help="stop after this many evaluated frames (0 = all)")
+    p.add_argument("--warmup", type=int, default=5, help="leading frames left out of the latency figures")
+    p.add_argument("--model-pack", help="insightface model pack (default FACE_MODEL_PACK or buffalo_l)")
+    p.add_argument("--cap-fps", type=int, help="pipeline mode capture rate (CAP_FPS)")
+    p.add_argument("--infer-fps", type=int, help="pipeline mode inference rate (INFER_FPS)")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--out", help="also write the JSON result to this file")
+    return p.parse_args(argv)
+
+
+def _configure_env(args):
+    # must happen before the api modules are imported: they read these at import
+    os.environ["RECOGNITION_WORKERS"] = "0"
+    os.environ["AUTO_MARK"] = "0"
+    os.environ["CAM_REPLAY_LOOP"] = "0"
+    os.environ["PIPELINE_TRACE_SIZE"] = str(10 ** 6)
+    os.environ["CAM_DEVICE"] = args.source
+    os.environ["CAM_INDEX"] = "-1"
+    if args.model_pack:
+        os.environ["FACE_MODEL_PACK"] = args.model_pack
+    if args.cap_fps:
+        os.environ["CAP_FPS"] = str(args.cap_fps)
+    if args.infer_fps:
+        os.environ["INFER_FPS"] = str(args.infer_fps)
+
+
+def load_labels(path):
+    """Return label_for(name) built from a --labels file (or None)."""
+    if not path:
+        return None
+    with open(path) as f:
+        data = json.load(f)
+    exact, ranges = {}, []
+    for key, ident in data.items():
+        key = str(key)
+        lo, sep, hi = key.partition("-")
+        if sep and lo.isdigit() and hi.isdigit():
+            ranges.append((int(lo), int(hi), ident))
+        else:
+            exact[key] = ident
+
+    def label_for(name):
+        if name in exact:
+            return exact[name]
+        if name is not None and name.isdigit():
+            idx = int(name)
+            for lo, hi, ident in ranges:
+                if lo <= idx <= hi:
+                    return ident
+        return None
+    return label_for
+
+
+def _dir_label(name):
+    parts = (name or "").replace("\\", "/").split("/")
+    return parts[0] if len(parts) > 1 else None
+
+
+def _largest_face_embedding(recognition, mdl, frame):
+    faces = mdl.get(frame)
+    if not faces:
+        return None
+    face = max(faces, key=lambda f: float((f.bbox[2] - f.bbox[0]) * (f.bbox[3] - f.bbox[1])))
+    emb = getattr(face, "embedding", None)
+    return None if emb is None else emb.astype(recognition.np.float32)
+
+
+def build_gallery(recognition, state, mdl, args, label_for):
+    """Enroll real identities from the source and pad with random embeddings."""
+    np = recognition.np
+    src = recognition.ReplaySource(args.source, loop=False)
+    per_ident, enrolled_frames = {}, set()
+    while True:
+        ok, frame = src.read()
+        if not ok:
+            if src.exhausted:
+                break
+            continue
+        ident = label_for(src.name)
+        if ident is None or len(per_ident.get(ident, [])) >= args.enroll:
+            continue
+        emb = _largest_face_embedding(recognition, mdl, frame)
+        if emb is None:
+            continue
+        per_ident.setdefault(ident, []).append(emb / np.linalg.norm(emb))
+        enrolled_frames.add(src.name)
+    src.release()
+
+    dim = next((v[0].shape[0] for v in per_ident.values()), 512)
+    rng = np.random.default_rng(args.seed)
+
+    def _random(n, prefix):
+        vecs = rng.standard_normal((n, dim)).astype(np.float32)
+        vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+        return [(f"{prefix}-{i}", f"{prefix} {i}", vecs[i]) for i in range(n)]
+
+    students = [(ident, ident, np.mean(embs, axis=0).astype(np.float32)) for ident, embs in per_ident.items()]
+    students += _random(args.gallery, "synthetic-student")
+    teachers = _random(args.teachers, "synthetic-teacher")
+    with state.emb_lock:
+        state.student_embeddings = students
+        state.teacher_embeddings = teachers
+    return sorted(per_ident), enrolled_frames
+
+
+def run_sequential(recognition, pipeline_trace, mdl, args, enrolled_frames):
+    src = recognition.ReplaySource(args.source, loop=False)
+    evaluated = 0
+    while not args.frames or evaluated < args.frames:
+        ok, frame = src.read()
+        if not ok:
+            if src.exhausted:
+                break
+            continue
+        if src.name in enrolled_frames:
+            continue
+        trace = pipeline_trace.start()
+        trace["frame"] = src.name
+        trace["enqueue"] = trace["dequeue"] = trace["capture"]
+        recognition._process_frame(mdl, frame, trace)
+        evaluated += 1
+    src.release()
+    return {"captured": evaluated}
+
+
+def run_pipeline(recognition, pipeline_trace, args):
+    recognition.start_workers()
+    cap = None
+    while True:
+        cap = recognition._cap
+        if cap is not None and getattr(cap, "exhausted", False):
+            break
+        if args.frames and len(pipeline_trace._ring) >= args.frames:
+            break
+        time.sleep(0.05)
+    # let the frame already queued for inference finish
+    time.sleep(2.0 / max(1, recognition.INFER_FPS) + 0.5)
+    return {"captured": recognition.pipeline_stats["captured"], "cap_fps": recognition.TARGET_FPS,
+            "infer_fps": recognition.INFER_FPS}
+
+
+def accuracy(records, label_for, enrolled_frames):
+    res = {"labelled": 0, "correct": 0, "wrong": 0, "missed": 0, "unlabelled": 0, "unlabelled_matched": 0}
+    for r in records:
+        name = r.get("frame")
+        if name in enrolled_frames:
+            continue
+        truth = label_for(name)
+        got = r.get("match_id")
+        if truth is None:
+            res["unlabelled"] += 1
+            if got is not None:
+                res["unlabelled_matched"] += 1
+            continue
+        res["labelled"] += 1
+        if got is None:
+            res["missed"] += 1
+        elif got == truth:
+            res["correct"] += 1
+        else:
+            res["wrong"] += 1
+    if res["labelled"]:
+        for key in ("correct", "wrong", "missed"):
+            res[f"{key}_rate"] = round(res[key] / res["labelled"], 4)
+    if res["unlabelled"]:
+        res["false_accept_rate"] = round(res["unlabelled_matched"] / res["unlabelled"], 4)
+    return res
+
+
+def _peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0, 1)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    _configure_env(args)
+    sys.path.insert(0, SERVICE_DIR)
+    from api import state, recognition, pipeline_trace
+
+    if recognition.cv2 is None or recognition.np is None or recognition.insightface is None:
+        print(json.dumps({"error": "missing_dependency", "detail": "opencv, numpy and insightface are required"}))
+        return 2
+    if not os.path.exists(args.source):
+        print(json.dumps({"error": "source_not_found", "source": args.source}))
+        return 2
+
+    tmpdir = tempfile.mkdtemp(prefix="recog-bench-")
+    state.DB_PATH = os.path.join(tmpdir, "bench.db")
+
+    label_for = load_labels(args.labels) or _dir_label
+    t0 = time.perf_counter()
+    mdl = recognition._init_model()
+    if mdl is None:
+        print(json.dumps({"error": "model_unavailable", "model_pack": recognition.MODEL_PACK}))
+        return 2
+    model_load_s = time.perf_counter() - t0
+    rss_model_mb = _peak_rss_mb()
+    identities, enrolled_frames = build_gallery(recognition, state, mdl, args, label_for)
+
+    with pipeline_trace._ring_lock:
+        pipeline_trace._ring.clear()
+    started = time.perf_counter()
+    if args.mode == "pipeline":
+        run_info = run_pipeline(recognition, pipeline_trace, args)
+    else:
+        run_info = run_sequential(recognition, pipeline_trace, mdl, args, enrolled_frames)
+    wall_s = time.perf_counter() - started
+
+    # blank filler frames the capture thread emits once the source is exhausted carry no name
+    records = [r for r in pipeline_trace.snapshot() if r.get("frame") is not None]
+    timed = records[args.warmup:] if len(records) > args.warmup else records
+    span_s = (timed[-1]["published"] - timed[0]["capture"]) if timed else 0.0
+    summary = pipeline_trace.summarize(timed)
+
+    result = {
+        "meta": {
+            "commit": _git_commit(),
+            "model_pack": recognition.MODEL_PACK,
+            "mode": args.mode,
+            "source": os.path.abspath(args.source),
+            "gallery": {"identities": len(identities), "synthetic_students": args.gallery,
+                        "synthetic_teachers": args.teachers, "enroll_per_identity": args.enroll},
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "frames": {"processed": len(records), "timed": len(timed), "warmup": args.warmup, **run_info},
+        "fps": round(len(timed) / span_s, 3) if span_s > 0 else None,
+        "wall_s": round(wall_s, 3),
+        "model_load_s": round(model_load_s, 3),
+        "latency": summary["segments"],
+        "outcomes": summary["outcomes"],
+        "accuracy": accuracy(records, label_for, enrolled_frames),
+        "rss_mb": {"after_model_load": rss_model_mb, "peak": _peak_rss_mb()},
+    }
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
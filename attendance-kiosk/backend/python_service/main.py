@@ -18,6 +18,11 @@ async def lifespan(app: FastAPI):
             state.load_embeddings()
         except Exception:
             pass
+        # resume a session that was active when the service stopped
+        try:
+            session.restore_active_session()
+        except Exception:
+            pass
     except Exception:
         pass
 
@@ -36,7 +41,7 @@ async def lifespan(app: FastAPI):
                             kiosk_id_local = None
                             room_id_local = None
                             try:
-                                conn_loc = state.get_db()
+                                conn_loc = state.get_read_db()
                                 cur_loc = conn_loc.cursor()
                                 try:
                                     cur_loc.execute("SELECT fs_id, assignedRoomId FROM kiosks_fs LIMIT 1")
@@ -102,7 +107,7 @@ async def lifespan(app: FastAPI):
                     kiosk_id_local = None
                     room_id_local = None
                     try:
-                        conn_loc = state.get_db()
+                        conn_loc = state.get_read_db()
                         cur_loc = conn_loc.cursor()
                         try:
                             cur_loc.execute("SELECT fs_id, assignedRoomId FROM kiosks_fs LIMIT 1")
@@ -187,7 +192,7 @@ app.add_middleware(
 )
 
 # Import and include routers from the api package
-from api import state, recognition, sync, session, outbox, media, students, registry, device, teachers, kiosk_notifications, monitor
+from api import state, recognition, sync, session, outbox, media, students, registry, device, teachers, kiosk_notifications, monitor, realtime_sync, metrics, pipeline_trace, profiler, fake_firestore
 import threading
 import os
 import time
@@ -204,6 +209,16 @@ app.include_router(registry.router)
 app.include_router(device.router)
 app.include_router(kiosk_notifications.router)
 app.include_router(monitor.router)
+app.include_router(realtime_sync.router)
+app.include_router(metrics.router)
+app.include_router(pipeline_trace.router)
+app.include_router(profiler.router)
+# the fake Firestore's counters exist only when it is the data source
+if sync.FIRESTORE_BACKEND == "fake":
+    app.include_router(fake_firestore.router)
+
+# per-route latency histograms for /metrics
+app.add_middleware(metrics.HTTPMetricsMiddleware)
 
 
 @app.get("/health")